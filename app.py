@@ -3,14 +3,16 @@ import pandas as pd
 import re
 import streamlit as st
 
-from src_ollama_rag.pipeline import run_pipeline as executa_pipeline
-from reportlab.lib.utils import simpleSplit
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
 from io import BytesIO
-from similarity.embedding_indexer import EmbeddingIndexer
-from similarity.patient_text_builder import build_patient_texts
-from similarity.patient_search import find_most_similar_patient
+from similarity.attribute_filter import ATTRIBUTE_COLUMNS
+from similarity.patient_text_builder import PATIENT_TEXT_COLUMNS
+from similarity.similarity_service import SimilarityService
+from src_ollama_rag.utils import REPORT_COLUMNS
+from dataset_cache import DatasetCache, merge_columns
+
+# Streamlit reruns this script on every interaction, and every new worker pays for its imports
+# before drawing the form. The report pipeline (Ollama, ChromaDB) and the PDF library are only
+# imported when a report is requested; python -m benchmarks.startup_budget checks the budget.
 
 # --- Constants for PDF layout ---
 LEFT_MARGIN = 40
@@ -19,6 +21,19 @@ BOTTOM_MARGIN = 100
 LINE_HEIGHT = 20
 MAX_LINE_WIDTH = 500
 
+# Number of similar patients shown with a report
+SIMILAR_PATIENTS = 5
+
+# Attributes that the similar patients can be required to share (see similarity/attribute_filter.py)
+SIMILAR_FILTERS = {
+    "Sexe": "sexo",
+    "Franja d'edat": "age_band",
+    "Diagnòstic principal": "diagnostico_principal",
+    "Tipus d'episodi": "tipo_episodio",
+    "Nacionalitat": "nacionalidad",
+    "Àrea de salut": "area_salud",
+}
+
 # Regular expressions to identify report sections
 _HEADINGS = [
     ("dades_identificatives", r"DADES IDENTIFICATIVES"),
@@ -65,36 +80,45 @@ def read_report(patient_id: str, base_path="output_informe_"):
     except FileNotFoundError:
         return None
 
-def create_text_object(c: canvas.Canvas, font_name="Helvetica"):
+def executa_pipeline(patient_id: str, store=None):
+    """Runs the report pipeline (imported on the first request)."""
+    from src_ollama_rag.pipeline import run_pipeline
+    return run_pipeline(patient_id, store)
+
+def create_text_object(c: "canvas.Canvas", font_name="Helvetica"):
     """Creates a new canvas text object."""
     t = c.beginText(LEFT_MARGIN, TOP_START_Y)
     t.setFont(font_name, 11, leading=LINE_HEIGHT)
     t.setLeading(LINE_HEIGHT)
     return t
 
-def similar_patient(patient_id: str):
-    """Finds the most similar patient using embedding similarity."""
+@st.cache_resource
+def get_dataset_cache() -> DatasetCache:
+    """Process-wide cache of the preprocessed tables, shared by all sessions and reloaded when the files change."""
+    cache = DatasetCache(columns=merge_columns(REPORT_COLUMNS, PATIENT_TEXT_COLUMNS, ATTRIBUTE_COLUMNS))
+    cache.get()
+    cache.start_watching()
+    return cache
+
+@st.cache_resource
+def get_similarity_service() -> SimilarityService:
+    """Process-wide similarity index, loaded at startup and refreshed in the background when the data changes."""
+    service = SimilarityService()
+    service.start_background_refresh(get_dataset_cache())
+    return service
+
+def similar_patient(patient_id: str, same_as: list = None):
+    """Finds the most similar patients (with their similarity) in the precomputed index, optionally sharing some attributes."""
     try:
-        path = "dades/dades_preprocessades"
-        pac = pd.read_csv(f"{path}/Pacientes.csv", dtype={'id_paciente': str})
-        epi = pd.read_csv(f"{path}/Episodios.csv", dtype={'id_paciente': str})
-        mov = pd.read_csv(f"{path}/Movimientos.csv", dtype={'id_paciente': str})
-        dia = pd.read_csv(f"{path}/Diagnosticos.csv", dtype={'id_paciente': str})
-        tex = pd.read_csv(f"{path}/Textos.csv", dtype={'id_paciente': str})
-
-        texts = build_patient_texts(pac, epi, mov, dia, tex)
-        if patient_id not in texts:
-            return None
-
-        indexer = EmbeddingIndexer()
-        embeddings = indexer.build_embeddings(texts)
-        return find_most_similar_patient(patient_id, embeddings)
+        return get_similarity_service().top_k(patient_id, k=SIMILAR_PATIENTS, same_as=same_as)
     except Exception as e:
         print("Error en similaritat:", e)
         return None
     
-def add_bold_text(text_obj, line: str, c: canvas.Canvas):
+def add_bold_text(text_obj, line: str, c: "canvas.Canvas"):
     """Adds a line of text with optional bold sections to the canvas."""
+    from reportlab.lib.utils import simpleSplit
+
     parts = re.split(r"(\*\*.*?\*\*)", line)
     for part in parts:
         is_bold = part.startswith("**") and part.endswith("**")
@@ -114,6 +138,9 @@ def add_bold_text(text_obj, line: str, c: canvas.Canvas):
 
 def generate_pdf(name, age, gender, birth_date, death_date, timeline_text, clinical_summary, patient_id, chunks: list[str] = None):
     """Generate a structured clinical report in PDF format."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
     buffer = BytesIO()
     c = canvas.Canvas(buffer, pagesize=A4)
     c.drawImage("logo.jpg", x=450, y=770, width=110, height=55, preserveAspectRatio=True)
@@ -176,18 +203,21 @@ with col2:
 
     with st.form("formulari_pacient", clear_on_submit=False):
         patient_id = st.text_input("Identificador del pacient", placeholder="Ex: 123456")
+        same_as = st.multiselect("Pacients similars amb el mateix/la mateixa", list(SIMILAR_FILTERS))
         submitted = st.form_submit_button("Generar informe")
 
     if submitted and patient_id:
         st.markdown("---")
+        # One version of the data for the whole request
+        store = get_dataset_cache().get()
         with st.spinner("Generant l’informe clínic amb el model..."):
-            resultat_ok = executa_pipeline(patient_id)
+            resultat_ok = executa_pipeline(patient_id, store)
 
         if not resultat_ok:
             st.error("⚠️ No s'ha trobat cap pacient amb aquest ID. Torna a indicar-ne un altre.")
             st.stop()
 
-        similar_result = similar_patient(patient_id)
+        similar_result = similar_patient(patient_id, [SIMILAR_FILTERS[label] for label in same_as])
         st.success(f"Document generat per al pacient amb ID: **{patient_id}**")
 
         # Read sections from .txt file
@@ -256,8 +286,13 @@ with col2:
             mime="application/pdf",
         )
 
-        if similar_result is None:
+        if not similar_result:
             st.warning("No s'ha pogut calcular el pacient més similar.")
         else:
-            best_id, best_score = similar_result
-            st.success(f"Pacient més similar: **{best_id}**")
\ No newline at end of file
+            best_id, best_score = similar_result[0]
+            st.success(f"Pacient més similar: **{best_id}** (similitud: {best_score:.2%})")
+            st.table(pd.DataFrame(similar_result, columns=["Pacient", "Similitud"]).style.format({"Similitud": "{:.2%}"}))
+
+# Load the datasets and the similarity index once the form is drawn (later sessions reuse them)
+get_dataset_cache()
+get_similarity_service()
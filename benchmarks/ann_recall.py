@@ -0,0 +1,127 @@
+'''
+BENCHMARK DE CERCA APROXIMADA
+
+Measures recall@k and query latency of the approximate similarity indexes
+(similarity/ann_index.py) against the exact search of PatientSearchIndex, for a sweep of
+their recall/latency parameters (nprobe for IVF, ef for HNSW).
+
+The embeddings are synthetic: patients drawn around a set of random "profiles", which gives
+the clustered structure of real patient embeddings without running the embedding model.
+
+Usage (from the repository root):
+    python -m benchmarks.ann_recall --patients 100000 --output ann_results.json
+    python -m benchmarks.ann_recall --patients 20000 --nprobe 4 8 16 --ef 32 64 128
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+import numpy as np
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Function to generate clustered embeddings as a dict {id_paciente: embedding}
+def synthetic_embeddings(n_patients, dim, n_profiles, noise, seed):
+    rng = np.random.default_rng(seed)
+    profiles = rng.normal(size=(n_profiles, dim))
+    vectors = profiles[rng.integers(0, n_profiles, n_patients)] + noise * rng.normal(size=(n_patients, dim))
+    vectors = vectors.astype(np.float32)
+    return {str(pid): vectors[pid] for pid in range(n_patients)}
+
+
+# Function to time a batch of searches; returns the results and the mean latency in ms
+def timed_search(index, query_ids, k):
+    start = time.perf_counter()
+    results = {pid: index.search(pid, k) for pid in query_ids}
+    return results, 1000 * (time.perf_counter() - start) / len(query_ids)
+
+
+# Function to compute the mean recall@k of approximate results against the exact ones
+def recall_at_k(results, exact, k):
+    recalls = [
+        len({pid for pid, _ in results[query]} & {pid for pid, _ in exact[query]}) / max(min(k, len(exact[query])), 1)
+        for query in exact
+    ]
+    return float(np.mean(recalls))
+
+
+# Function to benchmark one backend for every value of its tuning parameter
+def benchmark_backend(backend, parameter, values, embeddings, query_ids, exact, args):
+    from similarity.ann_index import build_ann_index
+
+    start = time.perf_counter()
+    index = build_ann_index(embeddings, backend)
+    build_seconds = time.perf_counter() - start
+    print(f"  {backend}: built in {build_seconds:.2f}s")
+
+    runs = []
+    for value in values:
+        setattr(index, parameter, value)
+        results, latency = timed_search(index, query_ids, args.k)
+        run = {parameter: value, "recall": round(recall_at_k(results, exact, args.k), 4), "query_ms": round(latency, 4)}
+        print(f"    {run}")
+        runs.append(run)
+    return {"build_seconds": round(build_seconds, 4), "runs": runs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall and latency of the approximate similarity indexes against exact search.")
+    parser.add_argument("--patients", type=int, default=100000, help="Number of patients (default: 100000)")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding size (default: 768)")
+    parser.add_argument("--profiles", type=int, default=200, help="Number of patient profiles (clusters) (default: 200)")
+    parser.add_argument("--noise", type=float, default=0.5, help="Spread of the patients around their profile (default: 0.5)")
+    parser.add_argument("--queries", type=int, default=200, help="Number of query patients (default: 200)")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query (default: 10)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32], help="IVF nprobe values")
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256], help="HNSW ef values")
+    parser.add_argument("--backends", nargs="+", choices=["ivf", "hnsw"], default=["ivf", "hnsw"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="ann_results.json", help="Results file (default: ann_results.json)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_FOLDER)
+    from similarity.ann_index import hnsw_available
+    from similarity.patient_search import PatientSearchIndex
+
+    print(f"Generating {args.patients} embeddings of size {args.dim}")
+    embeddings = synthetic_embeddings(args.patients, args.dim, args.profiles, args.noise, args.seed)
+    rng = np.random.default_rng(args.seed)
+    query_ids = [str(pid) for pid in rng.choice(args.patients, min(args.queries, args.patients), replace=False)]
+
+    start = time.perf_counter()
+    exact_index = PatientSearchIndex(embeddings)
+    exact_build = time.perf_counter() - start
+    exact, exact_latency = timed_search(exact_index, query_ids, args.k)
+    print(f"  exact: built in {exact_build:.2f}s, {exact_latency:.3f} ms/query")
+
+    backends = {"exact": {"build_seconds": round(exact_build, 4), "query_ms": round(exact_latency, 4)}}
+    for backend in args.backends:
+        if backend == "hnsw" and not hnsw_available():
+            backends[backend] = {"skipped": "hnswlib is not installed"}
+            print("  hnsw: skipped (hnswlib is not installed)")
+            continue
+        parameter, values = ("nprobe", args.nprobe) if backend == "ivf" else ("ef", args.ef)
+        backends[backend] = benchmark_backend(backend, parameter, values, embeddings, query_ids, exact, args)
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "patients": args.patients,
+        "dim": args.dim,
+        "k": args.k,
+        "queries": len(query_ids),
+        "backends": backends,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+'''
+BENCHMARK D'EMMAGATZEMATGE COMPACTE
+
+Memory and recall of the compact storage options of the similarity index, against exact
+float32 search:
+    dict_float32     {id_paciente: float32 array}, as returned by EmbeddingIndexer
+    matrix_float32   PatientSearchIndex (one contiguous float32 matrix)
+    matrix_float16   PatientSearchIndex(dtype=np.float16)
+    pq               PQSearchIndex with ADC only (codes and codebooks in memory)
+    pq_rerank        PQSearchIndex re-ranking its shortlist with the full vectors; the full
+                     vectors stay in a memory-mapped file, so they are not counted as resident
+
+Usage (from the repository root):
+    python -m benchmarks.compact_storage --patients 100000 --output compact_results.json
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.ann_recall import recall_at_k, synthetic_embeddings, timed_search
+from similarity.patient_search import PatientSearchIndex, PQSearchIndex
+
+
+# Function to estimate the memory of a dict of per-patient arrays (arrays, their headers and the keys)
+def dict_nbytes(patient_embeddings):
+    return sys.getsizeof(patient_embeddings) + sum(
+        sys.getsizeof(pid) + sys.getsizeof(emb) + (0 if emb.base is None else emb.nbytes)
+        for pid, emb in patient_embeddings.items()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory saved and recall of float16 and product-quantized embeddings.")
+    parser.add_argument("--patients", type=int, default=100000, help="Number of patients (default: 100000)")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding size (default: 768)")
+    parser.add_argument("--profiles", type=int, default=200, help="Number of patient profiles (clusters) (default: 200)")
+    parser.add_argument("--noise", type=float, default=0.5, help="Spread of the patients around their profile (default: 0.5)")
+    parser.add_argument("--queries", type=int, default=200, help="Number of query patients (default: 200)")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query (default: 10)")
+    parser.add_argument("--m", type=int, help="PQ sub-vectors (default: dim / 8)")
+    parser.add_argument("--rerank", type=int, nargs="+", default=[50, 100, 200], help="PQ shortlist sizes to re-rank")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="compact_results.json", help="Results file (default: compact_results.json)")
+    args = parser.parse_args()
+
+    print(f"Generating {args.patients} embeddings of size {args.dim}")
+    embeddings = synthetic_embeddings(args.patients, args.dim, args.profiles, args.noise, args.seed)
+    ids = list(embeddings)
+    rng = np.random.default_rng(args.seed)
+    query_ids = [str(pid) for pid in rng.choice(args.patients, min(args.queries, args.patients), replace=False)]
+
+    # The full vectors as the EmbeddingStore keeps them: a memory-mapped .npy file
+    folder = tempfile.mkdtemp(prefix="compact_storage_")
+    path = os.path.join(folder, "embeddings.npy")
+    np.save(path, np.vstack([embeddings[pid] for pid in ids]))
+    full_vectors = np.load(path, mmap_mode="r")
+
+    exact_index = PatientSearchIndex(embeddings)
+    exact, exact_latency = timed_search(exact_index, query_ids, args.k)
+    results = {
+        "dict_float32": {"bytes": dict_nbytes(embeddings)},
+        "matrix_float32": {"bytes": exact_index.matrix.nbytes, "recall": 1.0, "query_ms": round(exact_latency, 4)},
+    }
+
+    half_index = PatientSearchIndex.from_matrix(ids, full_vectors, dtype=np.float16)
+    found, latency = timed_search(half_index, query_ids, args.k)
+    results["matrix_float16"] = {"bytes": half_index.matrix.nbytes, "recall": round(recall_at_k(found, exact, args.k), 4), "query_ms": round(latency, 4)}
+
+    start = time.perf_counter()
+    pq_index = PQSearchIndex.from_matrix(ids, full_vectors, m=args.m, rerank=max(args.rerank), seed=args.seed)
+    train_seconds = time.perf_counter() - start
+    for rerank in [0] + args.rerank:
+        pq_index.rerank = rerank
+        if not rerank:
+            full, pq_index.full_vectors = pq_index.full_vectors, None
+        found, latency = timed_search(pq_index, query_ids, args.k)
+        name = f"pq_rerank_{rerank}" if rerank else "pq"
+        results[name] = {"bytes": pq_index.nbytes, "recall": round(recall_at_k(found, exact, args.k), 4),
+                         "query_ms": round(latency, 4), "train_seconds": round(train_seconds, 2)}
+        if not rerank:
+            pq_index.full_vectors = full
+
+    baseline = results["dict_float32"]["bytes"]
+    for name, result in results.items():
+        result["bytes_per_patient"] = round(result["bytes"] / args.patients, 1)
+        result["saved"] = round(1 - result["bytes"] / baseline, 4)
+        print(f"  {name}: {result}")
+
+    del full_vectors, pq_index, half_index
+    os.remove(path)
+    os.rmdir(folder)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"patients": args.patients, "dim": args.dim, "k": args.k, "queries": len(query_ids), "storage": results}, f, indent=2)
+    print(f"\nResults saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
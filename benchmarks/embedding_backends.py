@@ -0,0 +1,56 @@
+'''
+BENCHMARK DELS BACKENDS D'INFERÈNCIA
+
+Embeds a sample of patient texts with every EmbeddingIndexer backend (torch fp32, torch int8,
+ONNX Runtime, ONNX Runtime int8) on CPU and reports, for each one, the speed-up over fp32 torch
+and the cosine similarity of its embeddings with the fp32 ones (see compare_backends).
+
+Needs torch and transformers (and onnxruntime for the ONNX backends) and the preprocessed tables.
+
+Usage (from the repository root):
+    python -m benchmarks.embedding_backends --sample 200 --threads 8
+'''
+
+import argparse
+import json
+import numpy as np
+
+from data_io import TABLE_NAMES, read_tables
+from similarity.embedding_indexer import EMBEDDING_BACKENDS, compare_backends
+from similarity.patient_text_builder import PATIENT_TEXT_COLUMNS, build_patient_texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed and cosine drift of the EmbeddingIndexer backends against fp32 torch.")
+    parser.add_argument("--model", default="xlm-roberta-base")
+    parser.add_argument("--backends", nargs="+", choices=EMBEDDING_BACKENDS[1:], default=EMBEDDING_BACKENDS[1:])
+    parser.add_argument("--sample", type=int, default=200, help="Number of patient texts (default: 200)")
+    parser.add_argument("--threads", type=int, help="Intra-op threads of every backend (default: library default)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--min-cosine", type=float, default=0.99,
+                        help="Lowest accepted cosine with fp32; the command exits with status 1 below it (default: 0.99)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Optional JSON results file")
+    args = parser.parse_args()
+
+    tables = read_tables(columns=PATIENT_TEXT_COLUMNS)
+    patient_texts = build_patient_texts(*(tables[name] for name in TABLE_NAMES))
+    rng = np.random.default_rng(args.seed)
+    sample = rng.choice(list(patient_texts), min(args.sample, len(patient_texts)), replace=False)
+    sample_texts = {pid: patient_texts[pid] for pid in sample}
+
+    results = compare_backends(sample_texts, args.model, args.backends, args.threads, args.batch_size)
+    for backend, result in results.items():
+        print(f"  {backend}: {result}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    drifted = [backend for backend, result in results.items() if result["min_cosine"] < args.min_cosine]
+    if drifted:
+        print(f"Backends per sota de la similitud mínima ({args.min_cosine}): {', '.join(drifted)}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+'''
+BENCHMARKS D'ESCALABILITAT
+
+Times and memory-profiles every stage of the project on synthetic datasets of several
+sizes (see synthetic_data.py). The LLM, the vector store and the embedding model are
+replaced by local stand-ins, so only our own code is measured.
+
+Stages:
+    preprocessing         preprocessing.py on the source workbooks (all tables rebuilt)
+    load_datasets         utils.load_patient_store with the report columns
+    clinical_record       build_structured_info + build_clinical_record for sample patients
+    patient_texts         similarity.build_patient_texts for all patients
+    embeddings            stand-in embeddings (hashed bag of words) of all patient texts
+    patient_search        find_most_similar_patient for sample patients
+    run_pipeline          pipeline.run_pipeline for sample patients (Ollama / ChromaDB stand-ins)
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --scales 1 10 --output benchmark_results.json
+    python -m benchmarks.run_benchmarks --scales 1 10 --baseline benchmark_results.json
+
+With --baseline the results are compared with a previous run and the command exits
+with status 1 if a stage got slower than the allowed tolerance.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic_data import fits_in_excel, write_dataset
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_SIZE = 768
+
+STAGES = ["preprocessing", "load_datasets", "clinical_record", "patient_texts", "embeddings", "patient_search", "run_pipeline"]
+
+
+class StageSkipped(Exception):
+    """
+    Raised by a stage that cannot run in this environment (the reason is stored in the results).
+    """
+
+
+# LOCAL STAND-INS
+
+# Function to embed a text as a normalized hashed bag of words (stand-in for EmbeddingIndexer)
+def standin_embedding(text: str) -> np.ndarray:
+    emb = np.zeros(EMBEDDING_SIZE, dtype=np.float32)
+    for word in text.lower().split():
+        emb[zlib.crc32(word.encode()) % EMBEDDING_SIZE] += 1
+    norm = np.linalg.norm(emb)
+    return emb / norm if norm else emb
+
+
+# Function to replace Ollama and ChromaDB in the pipeline module by in-memory stand-ins
+def patch_pipeline(pipeline):
+    collections = {}
+
+    def index_patient_texts(id_paciente, clinical_record):
+        collections[id_paciente] = list(clinical_record["text_entries"])
+
+    def retrieve_relevant_chunks(patient_id, query_text, n_results=5):
+        return collections.get(patient_id, [])[:n_results]
+
+    def generate_summary_with_rag(retrieved_chunks):
+        return "\n".join(chunk[:80] for chunk in retrieved_chunks)
+
+    pipeline.is_ollama_running = lambda: True
+    pipeline.index_patient_texts = index_patient_texts
+    pipeline.retrieve_relevant_chunks = retrieve_relevant_chunks
+    pipeline.generate_summary_with_rag = generate_summary_with_rag
+
+
+# STAGES (every stage receives and updates a shared state dictionary)
+
+def stage_preprocessing(state):
+    import code_dictionaries
+    import preprocessing
+
+    # Dictionaries are compiled again in every run
+    shutil.rmtree(code_dictionaries.CACHE_FOLDER, ignore_errors=True)
+    code_dictionaries._loaded.clear()
+
+    if state["excel_sources"]:
+        plan = {name: "rebuild" for name in preprocessing.file_paths}
+        preprocessing.run_sequential(plan, state["format"], lambda name, report: None, state["batch_rows"])
+    else:
+        # Too many rows for an .xlsx sheet: the generated tables are cleaned directly
+        from cleaning_engine import clean_table
+        from data_io import write_table
+
+        for name, source in state["sources"].items():
+            df = preprocessing.normalize_column_names(source.copy())
+            df, _ = clean_table(df, preprocessing.TABLE_RULES[name])
+            write_table(df, name, preprocessing.output_folder, state["format"])
+
+
+def stage_load_datasets(state):
+    from src_ollama_rag.utils import REPORT_COLUMNS, load_patient_store
+
+    state["store"] = load_patient_store(columns=REPORT_COLUMNS)
+
+
+def stage_clinical_record(state):
+    from src_ollama_rag.build_structured_report import build_structured_info
+    from src_ollama_rag.utils import build_clinical_record, extract_free_texts
+
+    for patient_key in state["sample_patients"]:
+        build_structured_info(patient_key, state["store"])
+        record = build_clinical_record(patient_key, state["store"])
+        extract_free_texts(record)
+
+
+def stage_patient_texts(state):
+    from data_io import TABLE_NAMES, read_tables
+    from similarity.patient_text_builder import PATIENT_TEXT_COLUMNS, build_patient_texts
+
+    tables = read_tables(columns=PATIENT_TEXT_COLUMNS)
+    state["patient_texts"] = build_patient_texts(*(tables[name] for name in TABLE_NAMES))
+
+
+def stage_embeddings(state):
+    state["embeddings"] = {
+        pid: standin_embedding(text) for pid, text in state["patient_texts"].items() if text.strip()
+    }
+
+
+def stage_patient_search(state):
+    from similarity.patient_search import find_most_similar_patient
+
+    # The patient texts (and so the embeddings) are keyed by the text id
+    for patient_key in state["sample_patients"]:
+        if str(patient_key) in state["embeddings"]:
+            find_most_similar_patient(str(patient_key), state["embeddings"])
+
+
+def stage_run_pipeline(state):
+    try:
+        from src_ollama_rag import pipeline
+    except ImportError as e:
+        raise StageSkipped(f"pipeline dependencies not installed ({e})")
+
+    patch_pipeline(pipeline)
+    for patient_key in state["sample_patients"]:
+        pipeline.run_pipeline(str(patient_key))
+
+
+STAGE_FUNCTIONS = {name: globals()[f"stage_{name}"] for name in STAGES}
+
+
+# RUNNING THE BENCHMARKS
+
+# Function to run a stage once and return its duration (and its peak of allocated memory)
+def measure(function, state, memory):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        function(state)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+# Function to benchmark all the stages on a synthetic dataset of the given scale
+def benchmark_scale(scale, args):
+    workdir = tempfile.mkdtemp(prefix=f"benchmark_{scale}_", dir=args.workdir)
+    previous_dir = os.getcwd()
+    try:
+        print(f"\nScale {scale}: generating data in {workdir}")
+        start = time.perf_counter()
+        sources = write_dataset(workdir, scale, args.seed, write_sources=not args.no_excel)
+        excel_sources = not args.no_excel and fits_in_excel(sources)
+        generation_seconds = time.perf_counter() - start
+
+        os.chdir(workdir)
+        rng = np.random.default_rng(args.seed)
+        patient_ids = sources["Pacientes"]["Paciente_ID"].to_numpy()
+        state = {
+            "format": args.format,
+            "batch_rows": args.batch_rows,
+            "excel_sources": excel_sources,
+            "sources": sources,
+            "sample_patients": [int(pid) for pid in rng.choice(patient_ids, min(args.sample_patients, len(patient_ids)), replace=False)],
+        }
+
+        # Stages depend on the previous ones: the stages before the last selected one
+        # are always run, but only the selected ones are measured
+        selected = args.stages or STAGES
+        last = max(STAGES.index(name) for name in selected)
+
+        stages = {}
+        for name in STAGES[:last + 1]:
+            if name not in selected:
+                STAGE_FUNCTIONS[name](state)
+                continue
+            try:
+                seconds, _ = measure(STAGE_FUNCTIONS[name], state, memory=False)
+                result = {"seconds": round(seconds, 4)}
+                if not args.no_memory:
+                    # Second run under tracemalloc (it slows the stage down, so it is not timed)
+                    _, peak = measure(STAGE_FUNCTIONS[name], state, memory=True)
+                    result["peak_mb"] = round(peak / 2**20, 2)
+            except StageSkipped as e:
+                result = {"skipped": str(e)}
+            stages[name] = result
+            print(f"  {name}: {result}")
+
+        return {
+            "scale": scale,
+            "rows": {name: len(df) for name, df in sources.items()},
+            "excel_sources": excel_sources,
+            "generation_seconds": round(generation_seconds, 4),
+            "stages": stages,
+        }
+    finally:
+        os.chdir(previous_dir)
+        if not args.keep_data:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Function to compare the results with a previous run; returns the stages that got slower
+def compare_results(results, baseline, tolerance):
+    previous = {entry["scale"]: entry["stages"] for entry in baseline["scales"]}
+    regressions = []
+    for entry in results["scales"]:
+        for name, stage in entry["stages"].items():
+            before = previous.get(entry["scale"], {}).get(name, {})
+            if "seconds" not in stage or "seconds" not in before:
+                continue
+            ratio = stage["seconds"] / max(before["seconds"], 1e-9)
+            status = "SLOWER" if ratio > 1 + tolerance else "ok"
+            print(f"  scale {entry['scale']} {name}: {before['seconds']}s -> {stage['seconds']}s ({ratio:.2f}x) {status}")
+            if status == "SLOWER":
+                regressions.append((entry["scale"], name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the project on synthetic data.")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10],
+                        help="Dataset sizes relative to the sample extract (default: 1 10)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, help="Only measure these stages (default: all)")
+    parser.add_argument("--format", choices=["csv", "parquet", "arrow"], default="csv",
+                        help="Format of the preprocessed tables (default: csv)")
+    parser.add_argument("--batch-rows", type=int, default=0, help="Passed to preprocessing (default: whole tables)")
+    parser.add_argument("--sample-patients", type=int, default=5,
+                        help="Patients used by the per-patient stages (default: 5)")
+    parser.add_argument("--no-memory", action="store_true", help="Only measure time")
+    parser.add_argument("--no-excel", action="store_true",
+                        help="Do not write the source workbooks; preprocessing cleans the generated tables directly")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Folder for the generated datasets (default: system temporary folder)")
+    parser.add_argument("--keep-data", action="store_true", help="Do not delete the generated datasets")
+    parser.add_argument("--output", default="benchmark_results.json", help="Results file (default: benchmark_results.json)")
+    parser.add_argument("--baseline", help="Previous results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown against the baseline (default: 0.25 = 25%%)")
+    args = parser.parse_args()
+
+    # The project modules use paths relative to the repository layout
+    sys.path.insert(0, REPO_FOLDER)
+    args.output = os.path.abspath(args.output)
+    if args.workdir:
+        args.workdir = os.path.abspath(args.workdir)
+        os.makedirs(args.workdir, exist_ok=True)
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "format": args.format,
+        "scales": [benchmark_scale(scale, args) for scale in args.scales],
+    }
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\nComparison with {args.baseline}:")
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than the baseline.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+'''
+PRESSUPOST D'ARRENCADA DE L'APLICACIÓ
+
+Checks that the module-level imports of app.py stay cheap: they are run in a fresh interpreter
+(as a new Streamlit worker would) and the check fails if
+    - they take longer than the time budget, or
+    - they load one of the heavy libraries that must only be imported on first use
+      (models, vector store, LLM client, PDF library).
+
+Only the imports are measured, not the data loading of the first session.
+
+Usage (from the repository root):
+    python -m benchmarks.startup_budget --budget 2.0
+'''
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries that app.py must not import at startup
+HEAVY_MODULES = ["torch", "transformers", "onnxruntime", "chromadb", "ollama", "reportlab", "hnswlib", "sklearn"]
+
+# Line written to stderr before the imports (the interpreter startup imports come before it)
+MARKER = "--- app imports ---"
+
+# Code run in the fresh interpreter: times the imports and lists the heavy modules loaded
+PROBE = """
+import json, sys, time
+print({marker!r}, file=sys.stderr, flush=True)
+start = time.perf_counter()
+exec(compile({imports!r}, "app_imports", "exec"))
+seconds = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+# Function to extract the module-level import statements of a script
+def module_imports(path):
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+# Function to run the imports in a fresh interpreter; returns the probe result and the slowest imports
+def measure_imports(imports, top=10):
+    code = PROBE.format(imports=imports, heavy=HEAVY_MODULES, marker=MARKER)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_FOLDER,
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "import failed")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    times = []
+    for line in process.stderr.split(MARKER, 1)[-1].splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            times.append((int(parts[1]), parts[2].rstrip()))
+    result["slowest"] = [(name.strip(), round(us / 1e6, 3)) for us, name in sorted(times, reverse=True) if not name.startswith("  ")][:top]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fails if the imports of app.py exceed the startup budget.")
+    parser.add_argument("--script", default=os.path.join(REPO_FOLDER, "app.py"), help="Script to check (default: app.py)")
+    parser.add_argument("--budget", type=float, default=2.0, help="Maximum import time in seconds (default: 2.0)")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters measured; the fastest counts (default: 3)")
+    args = parser.parse_args()
+
+    imports = module_imports(args.script)
+    try:
+        results = [measure_imports(imports) for _ in range(args.runs)]
+    except RuntimeError as e:
+        print(f"No s'han pogut importar els mòduls de {args.script}: {e}")
+        sys.exit(2)
+    best = min(results, key=lambda result: result["seconds"])
+
+    print(f"Import time of {os.path.basename(args.script)}: {best['seconds']:.3f}s (budget {args.budget}s)")
+    print("Slowest top-level imports:")
+    for name, seconds in best["slowest"]:
+        print(f"  {name}: {seconds}s")
+
+    failed = False
+    if best["heavy"]:
+        print(f"Mòduls pesants importats a l'arrencada: {', '.join(best['heavy'])}")
+        failed = True
+    if best["seconds"] > args.budget:
+        print(f"L'arrencada supera el pressupost de {args.budget}s.")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+'''
+GENERADOR DE DADES CLÍNIQUES SINTÈTIQUES
+
+Generates the five source tables (Pacientes, Episodios, Movimientos, Diagnosticos, Textos)
+and the code dictionaries with the same columns as the real extract, at any scale.
+Cardinalities follow the sample extract (scale 1 = 76 patients): about 30 episodes per
+patient, 7.8 movements and 7.6 diagnoses per episode and 470 clinical notes per patient.
+
+Usage (from the repository root):
+    python -m benchmarks.synthetic_data --scale 10 --output /tmp/synthetic
+'''
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# Means of the sample extract
+PATIENTS_PER_SCALE = 76
+EPISODES_PER_PATIENT = 30
+MOVEMENTS_PER_EPISODE = 7.8
+DIAGNOSES_PER_EPISODE = 7.6
+TEXTS_PER_PATIENT = 470
+
+# Maximum number of data rows of an .xlsx sheet
+EXCEL_MAX_ROWS = 1_048_575
+
+WORDS = (
+    "pacient refereix dolor toràcic dispnea febre tos abdominal cefalea nàusees vòmits "
+    "exploració auscultació normal murmuri vesicular conservat sense edemes analítica "
+    "hemograma bioquímica radiografia tòrax electrocardiograma ritme sinusal tractament "
+    "paracetamol ibuprofèn omeprazol amoxicil·lina control evolució favorable alta "
+    "domicili revisió consultes externes antecedents hipertensió diabetis dislipèmia "
+    "al·lèrgia asma MPOC insuficiència cardíaca renal crònica fumador exfumador"
+).split()
+
+EPISODE_TYPES = ["AP", "CE", "CM", "CU", "DO", "HD", "HO", "UR", "UC", "TE", "RH", "PS", "IQ", "HA", "EX", "LA", "RX", "SM"]
+MOVEMENT_CLASSES = ["AA", "AD", "AH", "AI", "AM", "AT", "AV", "CA", "CU", "IN", "TR", "UR"]
+
+
+def _count(rng, mean, size):
+    # Over-dispersed counts (negative binomial) with the given mean, at least 1
+    return np.maximum(rng.negative_binomial(2, 2 / (2 + mean), size=size), 1)
+
+
+def _phrases(rng, n, mean_words):
+    lengths = np.maximum(rng.poisson(mean_words, size=n), 1)
+    words = np.array(WORDS, dtype=object)[rng.integers(0, len(WORDS), size=int(lengths.sum()))]
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    return [" ".join(words[bounds[i]:bounds[i + 1]]) for i in range(n)]
+
+
+def _yyyymmdd(dates):
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype("int64")
+
+
+def generate_dictionaries(rng, n_diagnosis_codes=50000):
+    """
+    Returns the code dictionaries as {file name: DataFrame}.
+    Maestro 1 and Maestro 2 overlap, so the precedence between them is exercised.
+    """
+    services = [f"S-{i:03d}" for i in range(91)]
+    units = [f"C-{i:03d}" for i in range(222)]
+    movement_types = [(tipo, clase) for tipo in range(1, 5) for clase in MOVEMENT_CLASSES][:50]
+    diagnosis_codes = [f"12{chr(65 + i % 26)}{i // 26 % 100:02d}.{i % 97:02d}" for i in range(n_diagnosis_codes)]
+    diagnosis_codes = list(dict.fromkeys(diagnosis_codes))
+
+    def master(codes, label):
+        return pd.DataFrame({
+            "Catalogo": 12,
+            "Catalogo_Diag_Codi": codes,
+            "Diagnostico_Codigo": [code[2:] for code in codes],
+            "Diagnostico_Descripcion": [f"{label} {code}" for code in codes],
+        })
+
+    split = len(diagnosis_codes) // 5
+    return {
+        "Tipos Episodio.xlsx": pd.DataFrame({
+            "Tipo_Episodio": EPISODE_TYPES,
+            "Tipo_Episodio_Desc": [f"Tipus episodi {code}" for code in EPISODE_TYPES],
+        }),
+        "Servicios Médicos.xlsx": pd.DataFrame({
+            "Servicio_Medico": services,
+            "Servicio_Medico_Desc": [f"Servei {code}" for code in services],
+        }),
+        "Unidad Tratamiento.xlsx": pd.DataFrame({
+            "Unidad_Tratamiento": units,
+            "Unidad_Tratamiento_Desc": [f"Unitat {code}" for code in units],
+        }),
+        "Clases Movimiento.xlsm": pd.DataFrame({
+            "Clase_Movimiento": [clase for _, clase in movement_types],
+            "Clase_Movimiento_desc": [f"Moviment {tipo}{clase}" for tipo, clase in movement_types],
+            "Tipo_Mov_Clase_Mov": [f"{tipo}{clase}" for tipo, clase in movement_types],
+            "Tipo_Movimiento": [tipo for tipo, _ in movement_types],
+        }),
+        "Maestro de Diagnosticos 1.xlsx": master(diagnosis_codes[: 2 * split], "DIAGNÒSTIC"),
+        "Maestro de Diagnosticos 2.xlsx": master(diagnosis_codes[split:], "DIAGNÒSTIC (MESTRE 2)"),
+    }
+
+
+def generate_sources(rng, scale, dictionaries):
+    """
+    Returns the five source tables as {table name: DataFrame}, with the columns of the original workbooks.
+    """
+    today = pd.Timestamp.today().normalize()
+    n_patients = max(int(round(PATIENTS_PER_SCALE * scale)), 1)
+
+    # Pacientes
+    patient_ids = 6_000_000 + np.arange(n_patients)
+    birth = pd.to_datetime("1930-01-01") + pd.to_timedelta(rng.integers(0, 90 * 365, n_patients), unit="D")
+    dead = rng.random(n_patients) < 0.08
+    death = pd.Series(birth + pd.to_timedelta(rng.integers(20 * 365, 95 * 365, n_patients), unit="D"))
+    death = death.where(dead & (death < today))
+    nationality = rng.choice(["ES", "MA", "RO", "CO", "PK", "CN", "FR", "IT"], n_patients, p=[.8, .06, .03, .03, .02, .02, .02, .02])
+    pacientes = pd.DataFrame({
+        "Area_Salud": rng.integers(1, 60, n_patients),
+        "Fecha_Fallecimiento": death,
+        "Fecha_Nacimiento": birth,
+        "Nacionalidad": nationality,
+        "Pac_Fallecido": np.where(death.notna(), "X", None),
+        "Paciente_ID": patient_ids,
+        "Pais_Nac": nationality,
+        "Sexo": rng.integers(1, 3, n_patients),
+    })
+
+    # Episodios
+    episodes_per_patient = _count(rng, EPISODES_PER_PATIENT, n_patients)
+    n_episodes = int(episodes_per_patient.sum())
+    episode_patient = np.repeat(np.arange(n_patients), episodes_per_patient)
+    first_day = np.maximum((birth - pd.Timestamp("1995-01-01")).days.to_numpy(), 0)
+    span = np.maximum((today - pd.Timestamp("1995-01-01")).days - first_day, 1)
+    start_offset = first_day[episode_patient] + (rng.random(n_episodes) * span[episode_patient]).astype(int)
+    start = pd.Timestamp("1995-01-01") + pd.to_timedelta(start_offset, unit="D")
+    end = pd.Series(start + pd.to_timedelta(rng.geometric(0.2, n_episodes) - 1, unit="D"))
+    end = end.where((rng.random(n_episodes) > 0.1) & (end <= today))
+    episode_ids = 100_000_000 + np.arange(n_episodes)
+    episodios = pd.DataFrame({
+        "Clase_Episodio": rng.integers(1, 4, n_episodes),
+        "Episodio": episode_ids,
+        "Fin_Episodio": end,
+        "Inicio_Episodio": start,
+        "Paciente_ID": patient_ids[episode_patient],
+        "Tipo_Episodio": rng.choice(EPISODE_TYPES, n_episodes),
+    })
+
+    # Movimientos
+    movement_dict = dictionaries["Clases Movimiento.xlsm"]
+    services = dictionaries["Servicios Médicos.xlsx"]["Servicio_Medico"].to_numpy()
+    units = dictionaries["Unidad Tratamiento.xlsx"]["Unidad_Tratamiento"].to_numpy()
+    movements_per_episode = _count(rng, MOVEMENTS_PER_EPISODE, n_episodes)
+    n_movements = int(movements_per_episode.sum())
+    movement_episode = np.repeat(np.arange(n_episodes), movements_per_episode)
+    movement_number = np.arange(n_movements) - np.repeat(np.cumsum(movements_per_episode) - movements_per_episode, movements_per_episode) + 1
+    movement_type = rng.integers(0, len(movement_dict), n_movements)
+    movement_day = pd.Series(start[movement_episode]) + pd.to_timedelta(rng.integers(0, 3, n_movements), unit="D")
+    # About 10% of the service / unit codes are not in the dictionaries
+    service_codes = np.where(rng.random(n_movements) < 0.9, rng.choice(services, n_movements), "S-UNKNOWN")
+    unit_codes = np.where(rng.random(n_movements) < 0.9, rng.choice(units, n_movements), "C-UNKNOWN")
+    movimientos = pd.DataFrame({
+        "Clase_Mov": movement_dict["Clase_Movimiento"].to_numpy()[movement_type],
+        "Episodio": episode_ids[movement_episode],
+        "Fecha_Mov": _yyyymmdd(movement_day),
+        "Hora_Mov": rng.integers(0, 24, n_movements) * 10000 + rng.integers(0, 60, n_movements) * 100 + rng.integers(0, 60, n_movements),
+        "Numero_Movimiento": movement_number,
+        "Servicio_Medico": service_codes,
+        "Tipo_Mov_Clase_Mov": movement_dict["Tipo_Mov_Clase_Mov"].to_numpy()[movement_type],
+        "Tipo_Movimiento": movement_dict["Tipo_Movimiento"].to_numpy()[movement_type],
+        "Unidad_Tratamiento": unit_codes,
+    })
+
+    # Diagnosticos
+    diagnosis_codes = pd.concat([
+        dictionaries["Maestro de Diagnosticos 1.xlsx"]["Catalogo_Diag_Codi"],
+        dictionaries["Maestro de Diagnosticos 2.xlsx"]["Catalogo_Diag_Codi"],
+    ]).unique()
+    diagnoses_per_episode = _count(rng, DIAGNOSES_PER_EPISODE, n_episodes)
+    n_diagnoses = int(diagnoses_per_episode.sum())
+    diagnosis_episode = np.repeat(np.arange(n_episodes), diagnoses_per_episode)
+    coded = rng.random(n_diagnoses) < 0.7
+    codes = np.where(coded, rng.choice(diagnosis_codes, n_diagnoses), None)
+
+    def flag(probability):
+        return np.where(rng.random(n_diagnoses) < probability, "X", None)
+
+    diagnosticos = pd.DataFrame({
+        "Catalogo": np.where(coded, 12, np.nan),
+        "Catalogo_Diag_Codi": codes,
+        "Diagnostico_Codigo": [code[2:] if code else None for code in codes],
+        "Episodio": episode_ids[diagnosis_episode],
+        "Fecha_Diagnostico": start[diagnosis_episode],
+        "Indica_Diag_IQ": flag(0.05),
+        "Indica_Diag_Principal": flag(0.2),
+        "Indica_Diag_Tratamiento": flag(0.3),
+        "Indica_Motivo_Consulta": flag(0.2),
+        "Movimiento_Asociado": rng.integers(1, 5, n_diagnoses),
+        "Texto_Libre": np.where(rng.random(n_diagnoses) < 0.5, np.array(_phrases(rng, n_diagnoses, 6), dtype=object), None),
+    })
+
+    # Textos: notes of a patient spread over their episodes
+    texts_per_patient = _count(rng, TEXTS_PER_PATIENT, n_patients)
+    n_texts = int(texts_per_patient.sum())
+    text_patient = np.repeat(np.arange(n_patients), texts_per_patient)
+    first_episode = np.cumsum(episodes_per_patient) - episodes_per_patient
+    text_episode = first_episode[text_patient] + (rng.random(n_texts) * episodes_per_patient[text_patient]).astype(int)
+    textos = pd.DataFrame({
+        "Categoria": np.where(rng.random(n_texts) < 0.1, "Evolutiu", None),
+        "Episodio": episode_ids[text_episode],
+        "Paciente_ID": patient_ids[text_patient],
+        "Texto": _phrases(rng, n_texts, 30),
+    })
+
+    return {
+        "Pacientes": pacientes,
+        "Episodios": episodios,
+        "Movimientos": movimientos,
+        "Diagnosticos": diagnosticos,
+        "Textos": textos,
+    }
+
+
+def fits_in_excel(sources: dict) -> bool:
+    """
+    Checks that every source table fits in one .xlsx sheet.
+    """
+    return all(len(df) <= EXCEL_MAX_ROWS for df in sources.values())
+
+
+def write_dataset(folder, scale=1, seed=0, n_diagnosis_codes=50000, write_sources=True):
+    """
+    Generates a synthetic dataset under `folder` with the layout of the repository
+    (dades/dades_originals and dades/diccionaris). Returns the source tables.
+    The source workbooks are only written if every table fits in one sheet.
+    """
+    rng = np.random.default_rng(seed)
+    dictionaries = generate_dictionaries(rng, n_diagnosis_codes)
+    sources = generate_sources(rng, scale, dictionaries)
+
+    dictionary_folder = os.path.join(folder, "dades", "diccionaris")
+    os.makedirs(dictionary_folder, exist_ok=True)
+    for file, df in dictionaries.items():
+        df.to_excel(os.path.join(dictionary_folder, file), index=False)
+
+    if write_sources and not fits_in_excel(sources):
+        print("The source tables do not fit in an .xlsx sheet, only the dictionaries are written.")
+    elif write_sources:
+        source_folder = os.path.join(folder, "dades", "dades_originals")
+        os.makedirs(source_folder, exist_ok=True)
+        for name, df in sources.items():
+            df.to_excel(os.path.join(source_folder, f"{name}.xlsx"), index=False)
+
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic clinical dataset.")
+    parser.add_argument("--scale", type=float, default=1, help="Size relative to the sample extract (default: 1)")
+    parser.add_argument("--output", required=True, help="Folder where the dades/ tree is created")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sources = write_dataset(args.output, args.scale, args.seed)
+    for name, df in sources.items():
+        print(f"{name}: {len(df)} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+'''
+MOTOR DE REGLES DE NETEJA
+
+Applies the declarative cleaning rules of a table (see TABLE_RULES in preprocessing.py)
+with one vectorized pass per rule, and counts how many values every rule changed.
+
+Rules of a table (all of them optional):
+    rename        {old column: new column}
+    drop          [columns removed from the table (source names)]
+    ids           [id columns, converted to integer text]
+    combine       {new column: (date column YYYYMMDD, time column HHMMSS)}
+    dates         [columns converted to datetime]
+    no_future     {date column: "today" | "now"}
+    ordering      [(start column, end column)]: the end is cleared if it is before the start
+    value_maps    {column: {value: new value}}
+    flags         [Si/No columns: X -> Si, empty -> No]
+    decode        {column: dictionary name}, see code_dictionaries.py
+'''
+
+from collections import Counter
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from code_dictionaries import decode_column
+
+
+def _ids(series):
+    # Same text as astype('Int64').astype(str): missing ids become "<NA>"
+    ids = series.astype("Int64")
+    return ids.astype(str), int(ids.isna().sum() - series.isna().sum())
+
+
+def _combine_date_time(dates, times):
+    # YYYYMMDD and HHMMSS integers are split arithmetically (no string round trip)
+    dates = pd.to_numeric(dates, errors="coerce")
+    times = pd.to_numeric(times, errors="coerce")
+    days = pd.to_datetime(
+        pd.DataFrame({"year": dates // 10000, "month": dates // 100 % 100, "day": dates % 100}),
+        errors="coerce",
+    )
+    hours, minutes, seconds = times // 10000, times // 100 % 100, times % 100
+    valid_time = (hours < 24) & (minutes < 60) & (seconds < 60)
+    offset = pd.to_timedelta(hours * 3600 + minutes * 60 + seconds, unit="s")
+    return (days + offset).where(valid_time)
+
+
+def _dates(series):
+    parsed = pd.to_datetime(series, errors="coerce")
+    return parsed, int((series.notna() & parsed.isna()).sum())
+
+
+def _value_map(series, mapping):
+    mask = series.isin(list(mapping))
+    return series.map(mapping).where(mask, series), int(mask.sum())
+
+
+def _flags(series):
+    values = series.to_numpy(dtype=object)
+    missing = series.isna().to_numpy()
+    flagged = values == "X"
+    result = np.where(missing, "No", np.where(flagged, "Si", values))
+    return pd.Series(result, index=series.index, name=series.name), int(missing.sum() + flagged.sum())
+
+
+def clean_table(df: pd.DataFrame, rules: dict):
+    """
+    Applies the cleaning rules of a table.
+    Returns the cleaned table and a Counter with the number of values changed by each rule.
+    """
+    report = Counter()
+    today = pd.Timestamp(datetime.today().date())
+    now = pd.Timestamp(datetime.now())
+
+    # Column-level rules (no values are changed, so they are not reported)
+    drop = [col for col in rules.get("drop", []) if col in df.columns]
+    df = df.drop(columns=drop).rename(columns=rules.get("rename", {}))
+
+    for col in rules.get("ids", []):
+        df[col], report[f"ids {col}"] = _ids(df[col])
+
+    for col, (date_col, time_col) in rules.get("combine", {}).items():
+        df[col] = _combine_date_time(df[date_col], df[time_col])
+        report[f"combine {col}"] = int((df[date_col].notna() & df[col].isna()).sum())
+        df = df.drop(columns=[date_col, time_col])
+
+    for col in rules.get("dates", []):
+        df[col], report[f"dates {col}"] = _dates(df[col])
+
+    for col, limit in rules.get("no_future", {}).items():
+        future = df[col] > (now if limit == "now" else today)
+        df.loc[future, col] = pd.NaT
+        report[f"no_future {col}"] = int(future.sum())
+
+    for start, end in rules.get("ordering", []):
+        wrong = df[start].notna() & df[end].notna() & (df[end] < df[start])
+        df.loc[wrong, end] = pd.NaT
+        report[f"ordering {start} <= {end}"] = int(wrong.sum())
+
+    for col, mapping in rules.get("value_maps", {}).items():
+        df[col], report[f"value_map {col}"] = _value_map(df[col], mapping)
+
+    for col in rules.get("flags", []):
+        df[col], report[f"flags {col}"] = _flags(df[col])
+
+    for col, dictionary in rules.get("decode", {}).items():
+        decoded = decode_column(df[col], dictionary)
+        report[f"decode {col}"] = int((decoded.notna() & decoded.ne(df[col])).sum())
+        df[col] = decoded
+
+    return df, report
+
+
+def print_report(name: str, report: Counter):
+    """
+    Prints how many values each cleaning rule changed.
+    """
+    print(f"{name}:")
+    for rule, count in report.items():
+        print(f"  {rule}: {count}")
@@ -0,0 +1,159 @@
+'''
+DICCIONARIS DE CODIS
+
+Compiles the Excel files of dades/diccionaris into compact lookups (code -> description)
+that are cached on disk and only rebuilt when a source file changes, and decodes whole
+columns with them.
+
+Usage (optional, the lookups are also compiled on first use):
+    python code_dictionaries.py
+'''
+
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+from data_io import file_sha256
+
+DICTIONARY_FOLDER = "dades/diccionaris"
+CACHE_FOLDER = os.path.join(DICTIONARY_FOLDER, "compilats")
+
+# Sources of every dictionary: (file, code column, description column).
+# When a code appears in several files, the first file of the list takes precedence.
+DICTIONARIES = {
+    "tipo_episodio": [
+        ("Tipos Episodio.xlsx", "Tipo_Episodio", "Tipo_Episodio_Desc"),
+    ],
+    "unidad_tratamiento": [
+        ("Unidad Tratamiento.xlsx", "Unidad_Tratamiento", "Unidad_Tratamiento_Desc"),
+    ],
+    "servicio_medico": [
+        ("Servicios Médicos.xlsx", "Servicio_Medico", "Servicio_Medico_Desc"),
+    ],
+    "clase_tipo_movimiento": [
+        ("Clases Movimiento.xlsm", "Tipo_Mov_Clase_Mov", "Clase_Movimiento_desc"),
+    ],
+    "diagnostico": [
+        ("Maestro de Diagnosticos 1.xlsx", "Catalogo_Diag_Codi", "Diagnostico_Descripcion"),
+        ("Maestro de Diagnosticos 2.xlsx", "Catalogo_Diag_Codi", "Diagnostico_Descripcion"),
+    ],
+}
+
+# Lookups already loaded by this process
+_loaded = {}
+
+
+def source_paths(name: str) -> list:
+    """
+    Returns the paths of the source files of a dictionary.
+    """
+    return [os.path.join(DICTIONARY_FOLDER, file) for file, _, _ in DICTIONARIES[name]]
+
+
+def _source_state(path: str) -> dict:
+    """
+    Returns the modification time and size of a source file (None if it does not exist).
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+def compile_dictionary(name: str) -> dict:
+    """
+    Reads the source files of a dictionary and merges them into one lookup.
+    Missing source files are skipped.
+    """
+    parts = []
+    sources = {}
+    for (file, code_col, desc_col), path in zip(DICTIONARIES[name], source_paths(name)):
+        state = _source_state(path)
+        if state is not None:
+            state["sha256"] = file_sha256(path)
+            df = pd.read_excel(path, usecols=[code_col, desc_col])
+            df = df.dropna(subset=[code_col]).rename(columns={code_col: "code", desc_col: "description"})
+            # Inside a file the last occurrence of a code wins (as with dict(zip(...)))
+            parts.append(df.drop_duplicates(subset="code", keep="last"))
+        sources[path] = state
+
+    if not parts:
+        raise FileNotFoundError(f"No source file found for dictionary '{name}': {source_paths(name)}")
+
+    # Between files the first one of the list wins
+    merged = pd.concat(parts, ignore_index=True).drop_duplicates(subset="code", keep="first")
+    lookup = pd.Series(merged["description"].to_numpy(dtype=object), index=pd.Index(merged["code"], dtype=object))
+    return {"sources": sources, "lookup": lookup}
+
+
+def _is_up_to_date(compiled: dict, name: str) -> bool:
+    """
+    Checks that the source files have not changed since the dictionary was compiled.
+    A file whose modification time changed but whose content did not is still valid.
+    """
+    if set(compiled["sources"]) != set(source_paths(name)):
+        return False
+    for path, cached in compiled["sources"].items():
+        state = _source_state(path)
+        if state is None or cached is None:
+            if state != cached:
+                return False
+            continue
+        if (state["mtime"], state["size"]) == (cached["mtime"], cached["size"]):
+            continue
+        if state["size"] != cached["size"] or file_sha256(path) != cached["sha256"]:
+            return False
+        cached["mtime"] = state["mtime"]
+    return True
+
+
+def load_dictionary(name: str) -> pd.Series:
+    """
+    Returns the lookup (code -> description) of a dictionary, compiling it again
+    only if its source files changed.
+    """
+    cache_path = os.path.join(CACHE_FOLDER, f"{name}.pkl")
+
+    compiled = _loaded.get(name)
+    if compiled is None and os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            compiled = pickle.load(f)
+
+    sources = None if compiled is None else {path: dict(state) if state else state for path, state in compiled["sources"].items()}
+    if compiled is None or not _is_up_to_date(compiled, name):
+        compiled = compile_dictionary(name)
+
+    # Save the compiled lookup if it was rebuilt or only its modification times were refreshed.
+    # Other worker processes may be reading the cache: write a private file and swap it in.
+    if compiled["sources"] != sources:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(compiled, f)
+        os.replace(tmp_path, cache_path)
+
+    _loaded[name] = compiled
+    return compiled["lookup"]
+
+
+def decode_column(series: pd.Series, name: str) -> pd.Series:
+    """
+    Replaces the codes of a column by their description. Codes are upper-cased and
+    stripped first; codes without description are kept as they are.
+    Every distinct code is looked up only once.
+    """
+    lookup = load_dictionary(name)
+    positions, uniques = pd.factorize(series.str.upper().str.strip())
+    uniques = np.asarray(uniques, dtype=object)
+
+    found = lookup.index.get_indexer(uniques)
+    decoded = np.where(found >= 0, lookup.to_numpy()[found], uniques)
+
+    values = np.append(decoded, np.nan).astype(object)[positions]
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+if __name__ == "__main__":
+    for name in DICTIONARIES:
+        print(f"{name}: {len(load_dictionary(name))} codes")
@@ -0,0 +1,400 @@
+'''
+LECTURA I ESCRIPTURA DE LES TAULES PREPROCESSADES
+
+Shared by preprocessing.py (writer) and the report / similarity code (readers).
+Tables can be stored as CSV (default) or in a columnar format (Parquet or
+Arrow IPC) with an explicit schema, which can be read back with column
+projection instead of re-parsing and guessing dtypes from text.
+They can also be stored in one embedded SQLite database (dades.sqlite) with
+indexes on the id columns, from which the rows of a single patient can be
+read without loading the whole tables (see read_patient_tables()).
+
+In memory every table uses a compact representation (integer ids, categorical
+codes and descriptions, boolean Si/No flags). Ids are only turned into text at
+the edges (user input, file names, reports), see parse_id().
+'''
+
+import hashlib
+import os
+import sqlite3
+from contextlib import closing
+import pandas as pd
+
+DATA_FOLDER = "dades/dades_preprocessades"
+
+TABLE_NAMES = ["Pacientes", "Episodios", "Movimientos", "Diagnosticos", "Textos"]
+
+# File extension of every supported output format
+FORMATS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+    "sqlite": ".sqlite",
+}
+
+# All the tables of the SQLite format are stored in this one file
+SQLITE_FILE = "dades"
+
+# Columns indexed in the SQLite database (when the table has them)
+SQLITE_INDEXES = ["id_paciente", "id_episodio", "movimiento_asociado"]
+
+# Explicit schema of every preprocessed table.
+#   id       -> nullable integer ids (Int64)
+#   datetime -> real datetime64 columns
+#   category -> dictionary-encoded code / description columns
+#   flag     -> Si/No columns as nullable booleans
+#   string   -> free text
+#   int      -> nullable integer
+TABLE_SCHEMAS = {
+    "Pacientes": {
+        "id_paciente": "id",
+        "area_salud": "category",
+        "fecha_nacimiento": "datetime",
+        "fecha_fallecimiento": "datetime",
+        "nacionalidad": "category",
+        "pais_nacimiento": "category",
+        "sexo": "category",
+    },
+    "Episodios": {
+        "id_episodio": "id",
+        "id_paciente": "id",
+        "clase_episodio": "category",
+        "fecha_inicio_episodio": "datetime",
+        "fecha_fin_episodio": "datetime",
+        "tipo_episodio": "category",
+    },
+    "Movimientos": {
+        "id_episodio": "id",
+        "numero_movimiento": "int",
+        "servicio_medico": "category",
+        "clase_tipo_movimiento": "category",
+        "unidad_tratamiento": "category",
+        "fecha_hora_movimiento": "datetime",
+    },
+    "Diagnosticos": {
+        "id_episodio": "id",
+        "movimiento_asociado": "id",
+        "diagnostico": "category",
+        "fecha_diagnostico": "datetime",
+        "indica_diag_iq": "flag",
+        "indica_diag_principal": "flag",
+        "indica_diag_tratamiento": "flag",
+        "indica_motivo_consulta": "flag",
+        "texto_libre": "string",
+    },
+    "Textos": {
+        "id_episodio": "id",
+        "id_paciente": "id",
+        "categoria": "category",
+        "texto_clinico": "string",
+    },
+}
+
+
+def file_sha256(path: str) -> str:
+    """
+    Returns the sha256 hash of the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_id(value):
+    """
+    Converts an id given as text (user input, file names) to the integer used in the tables.
+    Returns None if the value is not a valid id.
+    """
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+
+def flag_mask(series: pd.Series) -> pd.Series:
+    """
+    Returns a boolean mask of the Si/No flag values that are set.
+    Works on boolean flags, on the 0/1 integers of SQLite and on the "Si"/"No" text of the CSV files.
+    """
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return series.fillna(False).astype(bool)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series == 1
+    return series.astype(object) == "Si"
+
+
+def id_columns(name: str) -> list:
+    """
+    Returns the id columns of a table.
+    """
+    return [col for col, kind in TABLE_SCHEMAS.get(name, {}).items() if kind == "id"]
+
+
+def apply_schema(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    """
+    Casts the columns of a preprocessed table to the compact dtypes of its schema.
+    Columns that are not in the schema are left untouched.
+    """
+    df = df.copy()
+    for col, kind in TABLE_SCHEMAS.get(name, {}).items():
+        if col not in df.columns:
+            continue
+        if kind == "id":
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+        elif kind == "datetime":
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+        elif kind == "category":
+            df[col] = df[col].astype("category")
+        elif kind == "flag":
+            df[col] = flag_mask(df[col]).mask(df[col].isna()).astype("boolean")
+        elif kind == "string":
+            df[col] = df[col].astype("string")
+        elif kind == "int":
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+    return df
+
+
+def table_path(name: str, folder: str = DATA_FOLDER, fmt: str = "csv") -> str:
+    """
+    Returns the path of a table stored in the given format.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown table format '{fmt}'. Expected one of {list(FORMATS)}.")
+    if fmt == "sqlite":
+        name = SQLITE_FILE
+    return os.path.join(folder, f"{name}{FORMATS[fmt]}")
+
+
+def _connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    # Read-only connections can be shared by many processes; writers wait for each other
+    if read_only:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=300)
+    return sqlite3.connect(path, timeout=300)
+
+
+def table_exists(name: str, folder: str = DATA_FOLDER, fmt: str = "csv") -> bool:
+    """
+    Checks that a table has been written in the given format.
+    """
+    path = table_path(name, folder, fmt)
+    if not os.path.exists(path):
+        return False
+    if fmt != "sqlite":
+        return True
+    with closing(_connect(path, read_only=True)) as con:
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return con.execute(query, (name,)).fetchone() is not None
+
+
+def detect_format(name: str, folder: str = DATA_FOLDER) -> str:
+    """
+    Returns the format of the most recently written copy of a table.
+    """
+    available = [
+        (os.path.getmtime(table_path(name, folder, fmt)), fmt)
+        for fmt in FORMATS
+        if table_exists(name, folder, fmt)
+    ]
+    if not available:
+        raise FileNotFoundError(f"No preprocessed file found for table '{name}' in '{folder}'.")
+    return max(available)[1]
+
+
+def _sqlite_append(con: sqlite3.Connection, df: pd.DataFrame, name: str, table: str, replace: bool):
+    # Categorical columns are stored as text, flags as 0/1 and dates as ISO text
+    df = apply_schema(df, name)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    df.to_sql(table, con, if_exists="replace" if replace else "append", index=False)
+
+
+def _sqlite_publish(con: sqlite3.Connection, name: str, table: str):
+    # Replace the previous table (and build its indexes) in one transaction
+    columns = [row[1] for row in con.execute(f'PRAGMA table_info("{table}")')]
+    con.isolation_level = None
+    con.execute("BEGIN IMMEDIATE")
+    con.execute(f'DROP TABLE IF EXISTS "{name}"')
+    con.execute(f'ALTER TABLE "{table}" RENAME TO "{name}"')
+    for col in SQLITE_INDEXES:
+        if col in columns:
+            con.execute(f'CREATE INDEX "{name}_{col}" ON "{name}" ("{col}")')
+    con.execute("COMMIT")
+
+
+def write_table(df: pd.DataFrame, name: str, folder: str = DATA_FOLDER, fmt: str = "csv") -> str:
+    """
+    Writes a preprocessed table in the given format and returns its path.
+    CSV output is written as is; columnar formats and SQLite are written with the table schema.
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = table_path(name, folder, fmt)
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "parquet":
+        apply_schema(df, name).to_parquet(path, index=False)
+    elif fmt == "arrow":
+        apply_schema(df, name).reset_index(drop=True).to_feather(path)
+    elif fmt == "sqlite":
+        with closing(_connect(path)) as con:
+            _sqlite_append(con, df, name, f"{name}__tmp", replace=True)
+            _sqlite_publish(con, name, f"{name}__tmp")
+    return path
+
+
+class TableStreamWriter:
+    """
+    Writes a preprocessed table batch by batch, so only one batch has to be in memory.
+    The file (or SQLite table) is written under a temporary name and moved into place by close().
+    Columnar batches share one schema: categorical columns keep a growing list of
+    categories, so every batch extends the dictionary of the previous ones.
+    """
+
+    def __init__(self, name: str, folder: str = DATA_FOLDER, fmt: str = "csv"):
+        os.makedirs(folder, exist_ok=True)
+        self.name = name
+        self.fmt = fmt
+        self.path = table_path(name, folder, fmt)
+        self.tmp_path = self.path + ".tmp"
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._categories = {}
+
+    def _arrow_table(self, df: pd.DataFrame):
+        import pyarrow as pa
+
+        df = apply_schema(df, self.name)
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                known = self._categories.get(col, pd.Index([], dtype=df[col].cat.categories.dtype))
+                categories = known.append(df[col].cat.categories.difference(known))
+                self._categories[col] = categories
+                df[col] = df[col].cat.set_categories(categories)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        if self._schema is None:
+            # Fix the schema on the first batch: wide dictionary indices, no null-typed columns
+            fields = []
+            for field in table.schema:
+                field_type = field.type
+                if pa.types.is_dictionary(field_type):
+                    value_type = pa.string() if pa.types.is_null(field_type.value_type) else field_type.value_type
+                    field_type = pa.dictionary(pa.int32(), value_type)
+                elif pa.types.is_null(field_type):
+                    field_type = pa.string()
+                fields.append(pa.field(field.name, field_type))
+            self._schema = pa.schema(fields, metadata=table.schema.metadata)
+        return table.cast(self._schema)
+
+    def write(self, df: pd.DataFrame):
+        if self.fmt == "csv":
+            df.to_csv(self.tmp_path, index=False, mode="w" if self.rows == 0 else "a", header=self.rows == 0)
+        elif self.fmt == "sqlite":
+            if self._writer is None:
+                self._writer = _connect(self.path)
+            _sqlite_append(self._writer, df, self.name, f"{self.name}__tmp", replace=self.rows == 0)
+        else:
+            table = self._arrow_table(df)
+            if self._writer is None:
+                if self.fmt == "parquet":
+                    import pyarrow.parquet as pq
+                    self._writer = pq.ParquetWriter(self.tmp_path, self._schema)
+                else:
+                    import pyarrow.ipc as ipc
+                    options = ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+                    self._writer = ipc.new_file(self.tmp_path, self._schema, options=options)
+            self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self) -> str:
+        if self.fmt == "sqlite" and self._writer is not None:
+            _sqlite_publish(self._writer, self.name, f"{self.name}__tmp")
+        if self._writer is not None:
+            self._writer.close()
+        if os.path.exists(self.tmp_path):
+            os.replace(self.tmp_path, self.path)
+        return self.path
+
+
+def _read_sqlite(path: str, name: str, columns: list = None, where: str = None, params: tuple = ()) -> pd.DataFrame:
+    selected = ", ".join(f'"{col}"' for col in columns) if columns else "*"
+    query = f'SELECT {selected} FROM "{name}"' + (f" WHERE {where}" if where else "") + " ORDER BY rowid"
+    # Ids are read as integers directly (not through float, which cannot hold every 64-bit id)
+    ids = [col for col in id_columns(name) if not columns or col in columns]
+    with closing(_connect(path, read_only=True)) as con:
+        df = pd.read_sql_query(query, con, params=params, dtype={col: "Int64" for col in ids})
+    return apply_schema(df, name)
+
+
+def read_table(name: str, folder: str = DATA_FOLDER, columns: list = None, fmt: str = None) -> pd.DataFrame:
+    """
+    Reads a preprocessed table in its compact representation. Only the requested columns are read.
+    If no format is given, the most recently written copy of the table is used.
+    """
+    fmt = fmt or detect_format(name, folder)
+    path = table_path(name, folder, fmt)
+    if fmt == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    if fmt == "arrow":
+        return pd.read_feather(path, columns=columns)
+    if fmt == "sqlite":
+        return _read_sqlite(path, name, columns)
+    df = pd.read_csv(path, usecols=columns, dtype={col: str for col in id_columns(name)})
+    return apply_schema(df, name)
+
+
+def read_tables(folder: str = DATA_FOLDER, columns: dict = None, fmt: str = None) -> dict:
+    """
+    Reads all preprocessed tables. `columns` maps a table name to the columns to read
+    (tables that are not in the mapping are read completely).
+    """
+    columns = columns or {}
+    return {name: read_table(name, folder, columns.get(name), fmt) for name in TABLE_NAMES}
+
+
+# Columns that link the rows of every table to a patient
+PATIENT_KEYS = {
+    "Pacientes": ["id_paciente"],
+    "Episodios": ["id_paciente"],
+    "Movimientos": ["id_episodio"],
+    "Diagnosticos": ["id_episodio"],
+    "Textos": ["id_paciente", "id_episodio"],
+}
+
+
+def read_patient_tables(id_paciente: int, folder: str = DATA_FOLDER, columns: dict = None, fmt: str = None) -> dict:
+    """
+    Reads only the rows of one patient from every table (their episodes and the movements,
+    diagnoses and notes of those episodes). `columns` works as in read_tables().
+    From SQLite the rows are fetched through the id indexes, so the cost does not depend on
+    the size of the tables; the other formats are read completely and then filtered.
+    """
+    columns = columns or {}
+    fmt = fmt or detect_format("Episodios", folder)
+    episodes_query = 'SELECT id_episodio FROM "Episodios" WHERE id_paciente = ?'
+
+    if fmt == "sqlite":
+        path = table_path("Episodios", folder, fmt)
+        conditions = {"id_paciente": "id_paciente = ?", "id_episodio": f"id_episodio IN ({episodes_query})"}
+        tables = {}
+        for name in TABLE_NAMES:
+            where = " OR ".join(conditions[key] for key in PATIENT_KEYS[name])
+            tables[name] = _read_sqlite(path, name, columns.get(name), where, (id_paciente,) * len(PATIENT_KEYS[name]))
+        return tables
+
+    episodes = read_table("Episodios", folder, ["id_episodio", "id_paciente"], fmt)
+    episode_ids = episodes.loc[episodes["id_paciente"] == id_paciente, "id_episodio"]
+    tables = {}
+    for name in TABLE_NAMES:
+        keys = PATIENT_KEYS[name]
+        wanted = columns.get(name)
+        df = read_table(name, folder, None if wanted is None else list(dict.fromkeys(wanted + keys)), fmt)
+        mask = pd.Series(False, index=df.index)
+        for key in keys:
+            mask |= (df[key] == id_paciente).fillna(False) if key == "id_paciente" else df[key].isin(episode_ids)
+        df = df[mask].reset_index(drop=True)
+        tables[name] = df if wanted is None else df[wanted]
+    return tables
@@ -0,0 +1,132 @@
+'''
+MEMÒRIA CAU DE LES DADES PREPROCESSADES
+
+One copy of the preprocessed tables (as a PatientStore) shared by every thread of the
+process, e.g. by all the Streamlit sessions of app.py. The tables are loaded once and
+reloaded only when the files of dades/dades_preprocessades change on disk.
+
+A reload builds a complete new PatientStore and then replaces the previous one with a
+single assignment, so a request always works with one consistent version of the data
+(the one it got from get()), even while another version is being loaded.
+'''
+
+import os
+import threading
+import time
+
+from data_io import DATA_FOLDER, FORMATS, TABLE_NAMES, read_tables, table_path
+from patient_store import PatientStore
+
+
+def merge_columns(*column_sets: dict) -> dict:
+    """
+    Merges several {table: [columns]} projections into one that reads all of them.
+    """
+    merged = {}
+    for columns in column_sets:
+        for name, cols in columns.items():
+            merged.setdefault(name, [])
+            merged[name] += [col for col in cols if col not in merged[name]]
+    return merged
+
+
+def files_signature(folder: str = DATA_FOLDER) -> tuple:
+    """
+    Returns the path, modification time and size of every preprocessed table file of a folder.
+    """
+    signature = []
+    for name in TABLE_NAMES:
+        for fmt in FORMATS:
+            path = table_path(name, folder, fmt)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+    # The SQLite file holds all the tables
+    return tuple(dict.fromkeys(signature))
+
+
+class DatasetCache:
+    """
+    Thread-safe cache of the preprocessed tables of a folder.
+
+    get() returns the current PatientStore. At most every `check_interval` seconds it also
+    checks whether the files changed; if they did, one thread reloads them while the others
+    keep using the previous store. start_watching() does the checks in a background thread
+    instead, so no request has to wait for a reload.
+    """
+
+    def __init__(self, folder: str = DATA_FOLDER, columns: dict = None, check_interval: float = 2.0):
+        self.folder = folder
+        self.columns = columns
+        self.check_interval = check_interval
+        self._store = None
+        self._signature = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def _load(self) -> bool:
+        """
+        Loads the tables and swaps the store. Returns False (and keeps the previous store)
+        if the files changed while they were being read, e.g. while preprocessing.py writes them.
+        """
+        signature = files_signature(self.folder)
+        tables = read_tables(self.folder, self.columns)
+        if files_signature(self.folder) != signature:
+            return False
+        store = PatientStore(*(tables[name] for name in TABLE_NAMES))
+        self._store, self._signature = store, signature
+        return True
+
+    def refresh(self, blocking: bool = False) -> bool:
+        """
+        Reloads the tables if their files changed. Returns True if a new store was loaded.
+        Without `blocking`, nothing is done if another thread is already reloading.
+        """
+        if not self._lock.acquire(blocking=blocking):
+            return False
+        try:
+            self._last_check = time.monotonic()
+            if self._store is not None and files_signature(self.folder) == self._signature:
+                return False
+            return self._load()
+        finally:
+            self._lock.release()
+
+    def get(self) -> PatientStore:
+        """
+        Returns the current PatientStore (loading it on the first call).
+        """
+        if self._store is None:
+            self.refresh(blocking=True)
+            if self._store is None:
+                # The files kept changing while they were read: there is no previous version
+                # to fall back to, so read them once more and use whatever that returns
+                with self._lock:
+                    tables = read_tables(self.folder, self.columns)
+                    self._store = PatientStore(*(tables[name] for name in TABLE_NAMES))
+                    self._signature = None
+        elif self._watcher is None and time.monotonic() - self._last_check >= self.check_interval:
+            self.refresh()
+        return self._store
+
+    def start_watching(self, interval: float = None):
+        """
+        Checks the files for changes every `interval` seconds in a daemon thread.
+        """
+        if self._watcher is not None:
+            return
+        interval = interval or self.check_interval
+
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Error recarregant les dades: {e}")
+
+        self._watcher = threading.Thread(target=watch, name="dataset-cache-watcher", daemon=True)
+        self._watcher.start()
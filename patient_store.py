@@ -0,0 +1,96 @@
+'''
+MAGATZEM INDEXAT DE PACIENTS
+
+Groups the preprocessed tables by patient and episode once, when they are loaded,
+so the rows of one patient (or episode) are a contiguous slice of its table.
+The report builders take their rows from these slices instead of filtering the
+whole tables with boolean masks, so the cost of a report does not grow with the
+size of the tables.
+'''
+
+import numpy as np
+import pandas as pd
+
+# Key column of every table in the store: {table: [columns the table is grouped by]}
+# Textos is grouped twice (notes of an episode and notes of a patient).
+STORE_KEYS = {
+    "Pacientes": ["id_paciente"],
+    "Episodios": ["id_paciente"],
+    "Movimientos": ["id_episodio"],
+    "Diagnosticos": ["id_episodio"],
+    "Textos": ["id_episodio", "id_paciente"],
+}
+
+
+class GroupedTable:
+    """
+    A table sorted by a key column, with the positional range [start, stop) of every key.
+    Rows with the same key keep their original order.
+    """
+
+    def __init__(self, df: pd.DataFrame, key: str):
+        # Rows without key can never be requested
+        self.df = df[df[key].notna()].sort_values(key, kind="stable")
+        self.key = key
+
+        values, starts, counts = np.unique(self.df[key].to_numpy(), return_index=True, return_counts=True)
+        self._ranges = {value: (start, start + count) for value, start, count in zip(values.tolist(), starts.tolist(), counts.tolist())}
+
+    def __contains__(self, value) -> bool:
+        return value in self._ranges
+
+    def rows(self, value) -> pd.DataFrame:
+        """
+        Returns the rows of a key (an empty table if the key has no rows).
+        """
+        start, stop = self._ranges.get(value, (0, 0))
+        return self.df.iloc[start:stop]
+
+
+class PatientStore:
+    """
+    The five preprocessed tables grouped by id_paciente / id_episodio.
+    Tables (or key columns) that were not loaded are simply not available.
+    """
+
+    def __init__(self, pacientes, episodios, movimientos, diagnosticos, textos):
+        self.tables = {
+            "Pacientes": pacientes,
+            "Episodios": episodios,
+            "Movimientos": movimientos,
+            "Diagnosticos": diagnosticos,
+            "Textos": textos,
+        }
+        self._groups = {}
+        for name, keys in STORE_KEYS.items():
+            df = self.tables[name]
+            for key in keys:
+                if df is not None and key in df.columns:
+                    self._groups[(name, key)] = GroupedTable(df, key)
+
+    def _rows(self, name: str, key: str, value) -> pd.DataFrame:
+        group = self._groups.get((name, key))
+        if group is None:
+            raise KeyError(f"Table '{name}' was not loaded with column '{key}'.")
+        return group.rows(value)
+
+    def has_patient(self, id_paciente) -> bool:
+        return id_paciente in self._groups[("Pacientes", "id_paciente")]
+
+    def patient(self, id_paciente) -> pd.DataFrame:
+        return self._rows("Pacientes", "id_paciente", id_paciente)
+
+    def episodes(self, id_paciente) -> pd.DataFrame:
+        return self._rows("Episodios", "id_paciente", id_paciente)
+
+    def movements(self, id_episodio) -> pd.DataFrame:
+        return self._rows("Movimientos", "id_episodio", id_episodio)
+
+    def diagnoses(self, id_episodio) -> pd.DataFrame:
+        return self._rows("Diagnosticos", "id_episodio", id_episodio)
+
+    def episode_texts(self, id_episodio) -> pd.DataFrame:
+        return self._rows("Textos", "id_episodio", id_episodio)
+
+    def patient_texts(self, id_paciente) -> pd.DataFrame:
+        return self._rows("Textos", "id_paciente", id_paciente)
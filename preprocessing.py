@@ -4,9 +4,18 @@ UNIFICACIÓ I PREPROCESSAMENT DE TAULES
 '''
 
 import pandas as pd
-from datetime import datetime
+import argparse
+import json
 import os
 import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl import load_workbook
+from pandas.io.parsers import TextParser
+
+from data_io import FORMATS, TABLE_SCHEMAS, TableStreamWriter, file_sha256, table_exists, write_table
+from code_dictionaries import source_paths
+from cleaning_engine import clean_table, print_report
 
 # AUXILIAR FUNCTIONS
 
@@ -24,214 +33,332 @@ def normalize_column_names(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-# Function to preprocess the Pacientes table
-def preprocess_pacientes(df):
-    
-    # Rename columns manually
-    df = df.rename(columns={
-            'paciente_id': 'id_paciente',
-            'pais_nac': 'pais_nacimiento'
-        })
-
-    # Convert id_paciente to string
-    df['id_paciente'] = df['id_paciente'].astype('Int64').astype(str)
-    
-    # Checl if dates are not future dates
-    today = pd.Timestamp(datetime.today().date())
-    df.loc[df['fecha_nacimiento'] > today, 'fecha_nacimiento'] = pd.NaT
-    df.loc[df['fecha_fallecimiento'] > today, 'fecha_fallecimiento'] = pd.NaT
-
-    # Check if fecha_nacimiento is before fecha_fallecimiento
-    mask = (df['fecha_fallecimiento'].notna()) & (df['fecha_nacimiento'].notna())
-    df.loc[mask & (df['fecha_fallecimiento'] < df['fecha_nacimiento']), 'fecha_fallecimiento'] = pd.NaT
+# CLEANING RULES OF EVERY TABLE (applied by cleaning_engine.clean_table)
 
-    # Change 1/2 to Home/Dona
-    df['sexo'] = df['sexo'].replace({1: 'Home', 2: 'Dona'})     
-
-    # Remove column pac_fallecido
-    if 'pac_fallecido' in df.columns:
-        df = df.drop(columns=['pac_fallecido'])    
-
-    return df
-
-
-# Function to preprocess the Episodios table
-def preprocess_episodios(df):
-
-    # Rename columns manually
-    df = df.rename(columns={
+TABLE_RULES = {
+    "Pacientes": {
+        "rename": {
+            'paciente_id': 'id_paciente',
+            'pais_nac': 'pais_nacimiento',
+        },
+        "drop": ['pac_fallecido'],
+        "ids": ['id_paciente'],
+        "dates": ['fecha_nacimiento', 'fecha_fallecimiento'],
+        "no_future": {'fecha_nacimiento': "today", 'fecha_fallecimiento': "today"},
+        "ordering": [('fecha_nacimiento', 'fecha_fallecimiento')],
+        # Change 1/2 to Home/Dona
+        "value_maps": {'sexo': {1: 'Home', 2: 'Dona'}},
+    },
+    "Episodios": {
+        "rename": {
             'episodio': 'id_episodio',
             'paciente_id': 'id_paciente',
             'inicio_episodio': 'fecha_inicio_episodio',
-            'fin_episodio': 'fecha_fin_episodio'
-        })
-    
-    # Convert ids to string
-    df['id_episodio'] = df['id_episodio'].astype('Int64').astype(str)
-    df['id_paciente'] = df['id_paciente'].astype('Int64').astype(str)
-
-    # Convert dates to datetime
-    df['fecha_inicio_episodio'] = pd.to_datetime(df['fecha_inicio_episodio'], errors='coerce')
-    df['fecha_fin_episodio'] = pd.to_datetime(df['fecha_fin_episodio'], errors='coerce')
-
-    # Check if dates are not future dates
-    today = pd.Timestamp(datetime.today().date())
-    df.loc[df['fecha_inicio_episodio'] > today, 'fecha_inicio_episodio'] = pd.NaT
-    df.loc[df['fecha_fin_episodio'] > today, 'fecha_fin_episodio'] = pd.NaT
-
-    # Check if fecha_inicio_episodio is before fecha_fin_episodio
-    mask = (df['fecha_inicio_episodio'].notna()) & (df['fecha_fin_episodio'].notna())
-    df.loc[mask & (df['fecha_inicio_episodio'] > df['fecha_fin_episodio']), 'fecha_fin_episodio'] = pd.NaT
-
-    # Convert tipo_episodio code to description
-    df_tipos = pd.read_excel('dades/diccionaris/Tipos Episodio.xlsx')
-    tipo_episodio_dict = dict(zip(df_tipos['Tipo_Episodio'], df_tipos['Tipo_Episodio_Desc']))
-    df['tipo_episodio'] = df['tipo_episodio'].str.upper().str.strip().replace(tipo_episodio_dict)
+            'fin_episodio': 'fecha_fin_episodio',
+        },
+        "ids": ['id_episodio', 'id_paciente'],
+        "dates": ['fecha_inicio_episodio', 'fecha_fin_episodio'],
+        "no_future": {'fecha_inicio_episodio': "today", 'fecha_fin_episodio': "today"},
+        "ordering": [('fecha_inicio_episodio', 'fecha_fin_episodio')],
+        "decode": {'tipo_episodio': 'tipo_episodio'},
+    },
+    "Movimientos": {
+        "rename": {
+            'episodio': 'id_episodio',
+            'fecha_mov': 'fecha_movimiento',
+            'hora_mov': 'hora_movimiento',
+            'tipo_mov_clase_mov': 'clase_tipo_movimiento',
+        },
+        "drop": ['clase_mov', 'tipo_movimiento'],
+        "ids": ['id_episodio'],
+        # Unify date and time in one variable
+        "combine": {'fecha_hora_movimiento': ('fecha_movimiento', 'hora_movimiento')},
+        "no_future": {'fecha_hora_movimiento': "now"},
+        "decode": {
+            'unidad_tratamiento': 'unidad_tratamiento',
+            'servicio_medico': 'servicio_medico',
+            'clase_tipo_movimiento': 'clase_tipo_movimiento',
+        },
+    },
+    "Diagnosticos": {
+        "rename": {
+            'episodio': 'id_episodio',
+            'catalogo_diag_codi': 'diagnostico',
+        },
+        "drop": ['catalogo', 'diagnostico_codigo'],
+        "ids": ['id_episodio', 'movimiento_asociado'],
+        "dates": ['fecha_diagnostico'],
+        "no_future": {'fecha_diagnostico': "today"},
+        # Convert variables Si/No (X -> Si, NaN -> No)
+        "flags": ['indica_diag_iq', 'indica_diag_principal', 'indica_diag_tratamiento', 'indica_motivo_consulta'],
+        # Maestro 1 and 2 merged, Maestro 1 takes precedence
+        "decode": {'diagnostico': 'diagnostico'},
+    },
+    "Textos": {
+        "rename": {
+            'texto': 'texto_clinico',
+            'episodio': 'id_episodio',
+            'paciente_id': 'id_paciente',
+        },
+        "ids": ['id_episodio', 'id_paciente'],
+    },
+}
 
-    return df
 
+# PROCESSING THE DATA 
 
-# Function to preprocess the Movimientos table
-def preprocess_movimientos(df):
+data_folder = "dades/dades_originals"
+output_folder = "dades/dades_preprocessades"
+manifest_path = os.path.join(output_folder, "manifest.json")
 
-    # Rename columns manually
-    df = df.rename(columns={
-            'episodio': 'id_episodio',
-            'fecha_mov': 'fecha_movimiento',
-            'hora_mov': 'hora_movimiento',
-            'tipo_mov_clase_mov': 'clase_tipo_movimiento'
-        })
-    
-    # Convert id_episodio to string
-    df['id_episodio'] = df['id_episodio'].astype('Int64').astype(str)
-    
-    # Unify date ans time in one variable
-    df['fecha_movimiento'] = pd.to_datetime(df['fecha_movimiento'].dropna().astype('Int64').astype(str), format='%Y%m%d', errors='coerce')
-    df['hora_movimiento'] = pd.to_datetime(df['hora_movimiento'].dropna().astype('Int64').astype(str), format='%H%M%S', errors='coerce').dt.time
-    df['fecha_hora_movimiento'] = pd.to_datetime(
-        df['fecha_movimiento'].astype(str) + ' ' +
-        df['hora_movimiento'].astype(str),
-        errors='coerce'
-    )
-    df = df.drop(['fecha_movimiento', 'hora_movimiento'], axis=1)
-
-    # Cehck if dates are not future dates
-    today = pd.Timestamp(datetime.now())
-    df.loc[df['fecha_hora_movimiento'] > today, 'fecha_hora_movimiento'] = pd.NaT
-
-    # Convert variable codes to description
-    df_unidades = pd.read_excel('dades/diccionaris/Unidad Tratamiento.xlsx')
-    df_servicios = pd.read_excel('dades/diccionaris/Servicios Médicos.xlsx')
-    df_movimientos = pd.read_excel('dades/diccionaris/Clases Movimiento.xlsm')
-    unidades_dict = dict(zip(df_unidades['Unidad_Tratamiento'], df_unidades['Unidad_Tratamiento_Desc']))
-    servicios_dict = dict(zip(df_servicios['Servicio_Medico'], df_servicios['Servicio_Medico_Desc']))
-    movimientos_dict = dict(zip(df_movimientos['Tipo_Mov_Clase_Mov'], df_movimientos['Clase_Movimiento_desc']))
-    df['unidad_tratamiento'] = df['unidad_tratamiento'].str.upper().str.strip().replace(unidades_dict)
-    df['servicio_medico'] = df['servicio_medico'].str.upper().str.strip().replace(servicios_dict)
-    df['clase_tipo_movimiento'] = df['clase_tipo_movimiento'].str.upper().str.strip().replace(movimientos_dict)
-
-    # Remove columns that are not needed
-    df = df.drop(['clase_mov', 'tipo_movimiento'], axis=1)
+file_paths = {
+    "Pacientes": os.path.join(data_folder, "Pacientes.xlsx"),
+    "Episodios": os.path.join(data_folder, "Episodios.xlsx"),
+    "Movimientos": os.path.join(data_folder, "Movimientos.xlsx"),
+    "Diagnosticos": os.path.join(data_folder, "Diagnosticos.xlsx"),
+    "Textos": os.path.join(data_folder, "Textos.xlsx"),
+}
 
-    return df
+# Large tables that can be split in row ranges (all their cleaning rules are row by row)
+sharded_tables = ["Movimientos", "Diagnosticos"]
 
 
-# Function to preprocess the Diagnosticos table
-def preprocess_diagnosticos(df):
+# Function to hash a list of input files (None for missing files)
+def hash_files(paths):
+    return {path: file_sha256(path) if os.path.exists(path) else None for path in paths}
 
-    # Rename columns manually
-    df = df.rename(columns={
-            'episodio': 'id_episodio',
-            'catalogo_diag_codi': 'diagnostico'
-        })
-    
-    df['id_episodio'] = df['id_episodio'].astype('Int64').astype(str)
-    df['movimiento_asociado'] = df['movimiento_asociado'].astype('Int64').astype(str)
 
-    # Check if dates are not future dates
-    df['fecha_diagnostico'] = pd.to_datetime(df['fecha_diagnostico'], errors='coerce')
-    today = pd.Timestamp(datetime.today().date())
-    df.loc[df['fecha_diagnostico'] > today, 'fecha_diagnostico'] = pd.NaT
+# Function to compute the content hashes of the inputs of a table
+def table_inputs(name):
+    dictionaries = TABLE_RULES[name].get("decode", {}).values()
+    dictionary_paths = [path for dictionary in dictionaries for path in source_paths(dictionary)]
+    return {
+        "source": hash_files([file_paths[name]]),
+        "dictionaries": hash_files(dictionary_paths),
+    }
 
-    # Convert diagnostic codes to descriptions
-    df_maestro1 = pd.read_excel('dades/diccionaris/Maestro de Diagnosticos 1.xlsx')
-    df_maestro2 = pd.read_excel('dades/diccionaris/Maestro de Diagnosticos 2.xlsx')
 
-    diagnosticos_dict1 = dict(zip(df_maestro1['Catalogo_Diag_Codi'], df_maestro1['Diagnostico_Descripcion']))
-    diagnosticos_dict2 = dict(zip(df_maestro2['Catalogo_Diag_Codi'], df_maestro2['Diagnostico_Descripcion']))
-    df['diagnostico'] = df['diagnostico'].str.upper().str.strip()
-    df['diagnostico'] = df['diagnostico'].replace(diagnosticos_dict1)
-    df['diagnostico'] = df['diagnostico'].replace(diagnosticos_dict2)
+def load_manifest():
+    if not os.path.exists(manifest_path):
+        return {"format": None, "tables": {}}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-    # Remove columns that are not needed
-    df = df.drop(['catalogo', 'diagnostico_codigo'], axis=1)
 
-    # Convert variables Si/No (X -> Si, NaN -> No)
-    variables_a_tractar = ['indica_diag_iq', 'indica_diag_principal', 'indica_diag_tratamiento', 'indica_motivo_consulta']
+def save_manifest(manifest):
+    os.makedirs(output_folder, exist_ok=True)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
 
-    for var in variables_a_tractar:
-        df[var] = df[var].fillna('No')
-        df[var] = df[var].replace({'X': 'Si'})
 
-    return df
+# Function to decide what to do with every table: None (unchanged) or "rebuild".
+# A changed table is always rebuilt from its whole workbook: the workbook has to be read and
+# cleaned anyway to find its changed rows, and a rebuild also drops the rows deleted from it.
+def plan_tables(manifest, inputs, fmt, incremental):
+    plan = {}
+    for name in file_paths:
+        previous = manifest["tables"].get(name)
+        output_exists = table_exists(name, output_folder, fmt)
+        if incremental and output_exists and manifest["format"] == fmt and previous == inputs[name]:
+            plan[name] = None
+        else:
+            plan[name] = "rebuild"
+    return plan
 
-# Function to preprocess the Textos table
-def preprocess_textos(df):
 
-    # Rename columns manually
-    df = df.rename(columns={
-            'texto': 'texto_clinico',
-            'episodio': 'id_episodio',
-            'paciente_id': 'id_paciente'
-        })
-    
-    # Convert ids to string
-    df['id_episodio'] = df['id_episodio'].astype('Int64').astype(str)
-    df['id_paciente'] = df['id_paciente'].astype('Int64').astype(str)
+# Function to save a processed table
+def save_table(df, name, fmt):
+    return write_table(df, name, output_folder, fmt)
 
-    return df
 
+# Function to count the data rows of a workbook (header excluded), as reported by the
+# dimension of its sheet: it only plans the shards, the last shard reads up to the real end
+def count_rows(path):
+    wb = load_workbook(path, read_only=True)
+    try:
+        ws = wb.worksheets[0]
+        n_rows = ws.max_row
+        if n_rows is None:
+            n_rows = sum(1 for _ in ws.iter_rows(values_only=True))
+    finally:
+        wb.close()
+    return max(n_rows - 1, 0)
 
 
+# Function to get the source columns of a table that are kept as text in every batch or shard
+# (code columns decoded with a dictionary and free text columns), by their normalized name
+def source_text_columns(name):
+    rules = TABLE_RULES[name]
+    source_names = {new: old for old, new in rules.get("rename", {}).items()}
+    text = list(rules.get("decode", {})) + [col for col, kind in TABLE_SCHEMAS[name].items() if kind == "string"]
+    return {source_names.get(col, col) for col in text}
 
-# PROCESSING THE DATA 
 
-data_folder = "dades/dades_originals"
+# Function to get the dtypes that keep the text columns of a table as they are (object),
+# keyed by the column names of the workbook header
+def text_dtypes(names, text_columns):
+    normalized = normalize_column_names(pd.DataFrame(columns=list(names))).columns
+    return {col: object for col, norm in zip(names, normalized) if norm in text_columns}
 
-file_paths = {
-    "Pacientes": os.path.join(data_folder, "Pacientes.xlsx"),
-    "Episodios": os.path.join(data_folder, "Episodios.xlsx"),
-    "Movimientos": os.path.join(data_folder, "Movimientos.xlsx"),
-    "Diagnosticos": os.path.join(data_folder, "Diagnosticos.xlsx"),
-    "Textos": os.path.join(data_folder, "Textos.xlsx"),
-}
 
-datasets = {}
+# Function to read the header of a workbook and get its text dtypes (see text_dtypes)
+def source_dtypes(name, path):
+    return text_dtypes(pd.read_excel(path, nrows=0).columns, source_text_columns(name))
 
-for name, path in file_paths.items():
-    df = pd.read_excel(path)
+
+# Function to read, normalize and preprocess a table (or a range of its rows; nrows=None reads
+# up to the end of the sheet). The text columns are never inferred, so every shard gets the same
+# dtypes as the whole table (a shard where a code column is empty would become a float column).
+def process_table(name, path, start=None, nrows=None, dtypes=None):
+    dtypes = source_dtypes(name, path) if dtypes is None else dtypes
+    if start is None:
+        df = pd.read_excel(path, dtype=dtypes)
+    else:
+        # Keep the header row and skip the rows of the previous shards
+        df = pd.read_excel(path, skiprows=range(1, start + 1), nrows=nrows, dtype=dtypes)
 
     # Normalize column names
     df = normalize_column_names(df)
 
-    # Preprocess the data based on the table
-    if name == "Pacientes":
-        df = preprocess_pacientes(df)
-    elif name == "Episodios":
-        df = preprocess_episodios(df)
-    elif name == "Movimientos":
-        df = preprocess_movimientos(df)
-    elif name == "Diagnosticos":
-        df = preprocess_diagnosticos(df)
-    elif name == "Textos":
-        df = preprocess_textos(df)
-
-    datasets[name] = df
-
-# Save the processed datasets to CSV files
-output_folder = "dades/dades_preprocessades"
-os.makedirs(output_folder, exist_ok=True)
-
-for name, df in datasets.items():
-    output_path = os.path.join(output_folder, f"{name}.csv")
-    df.to_csv(output_path, index=False)
\ No newline at end of file
+    # Apply the cleaning rules of the table (returns the table and the rule report)
+    return clean_table(df, TABLE_RULES[name])
+
+
+# Function to read the first sheet of a workbook in batches of rows
+# (values are converted with the same parser as pd.read_excel)
+def iter_excel_batches(path, batch_rows, text_columns=()):
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        # Columns and dtypes are fixed once from the header, so every batch has the same ones:
+        # columns without a name are skipped by position, and text columns are never inferred
+        # (a batch where a code column is empty would otherwise become a float column)
+        positions = [i for i, col in enumerate(header) if col is not None]
+        names = [str(header[i]) for i in positions]
+        dtypes = text_dtypes(names, text_columns)
+
+        def parse(batch):
+            return TextParser([names] + batch, header=0, dtype=dtypes).read()
+
+        batch = []
+        for row in rows:
+            row = [row[i] if i < len(row) else None for i in positions]
+            # Skip empty rows (as pd.read_excel does)
+            if all(value is None for value in row):
+                continue
+            # Integer-valued floats are read as integers (as pd.read_excel does)
+            batch.append([int(v) if isinstance(v, float) and v.is_integer() else v for v in row])
+            if len(batch) == batch_rows:
+                yield parse(batch)
+                batch = []
+        if batch:
+            yield parse(batch)
+    finally:
+        wb.close()
+
+
+# Function to process a table batch by batch, writing every batch as soon as it is cleaned
+def stream_and_save_table(name, path, fmt, batch_rows):
+    writer = TableStreamWriter(name, output_folder, fmt)
+    report = Counter()
+    for df in iter_excel_batches(path, batch_rows, source_text_columns(name)):
+        df = normalize_column_names(df)
+        df, batch_report = clean_table(df, TABLE_RULES[name])
+        writer.write(df)
+        report.update(batch_report)
+    writer.close()
+    return report
+
+
+# Function to process a whole table and save it (one process pool task); returns the rule report
+def process_and_save_table(name, path, fmt, batch_rows=0):
+    if batch_rows:
+        return stream_and_save_table(name, path, fmt, batch_rows)
+    df, report = process_table(name, path)
+    save_table(df, name, fmt)
+    return report
+
+
+def run_sequential(plan, fmt, on_saved, batch_rows=0):
+    for name in plan:
+        report = process_and_save_table(name, file_paths[name], fmt, batch_rows)
+        on_saved(name, report)
+
+
+def run_parallel(plan, fmt, on_saved, workers, shard_rows, batch_rows=0):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        table_tasks = {}
+        shard_tasks = {}
+
+        for name in plan:
+            path = file_paths[name]
+            n_rows = count_rows(path) if shard_rows and not batch_rows and name in sharded_tables else 0
+            if n_rows > shard_rows:
+                # The last shard has no row limit, so rows past an under-reported dimension are kept
+                dtypes = source_dtypes(name, path)
+                starts = list(range(0, n_rows, shard_rows))
+                shard_tasks[name] = [
+                    executor.submit(process_table, name, path, start, shard_rows if start != starts[-1] else None, dtypes)
+                    for start in starts
+                ]
+            else:
+                table_tasks[name] = executor.submit(process_and_save_table, name, path, fmt, batch_rows)
+
+        # Join the shards of each table in row order
+        for name, shards in shard_tasks.items():
+            results = [shard.result() for shard in shards]
+            df = pd.concat([shard_df for shard_df, _ in results], ignore_index=True)
+            save_table(df, name, fmt)
+            report = Counter()
+            for _, shard_report in results:
+                report.update(shard_report)
+            on_saved(name, report)
+
+        for name, task in table_tasks.items():
+            on_saved(name, task.result())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess the original clinical tables.")
+    parser.add_argument("--format", choices=list(FORMATS), default="csv",
+                        help="Output format of the preprocessed tables (default: csv)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes; 1 processes the tables one after another (default: 1)")
+    parser.add_argument("--shard-rows", type=int, default=0,
+                        help="Split Movimientos and Diagnosticos in shards of this many rows when running in parallel (default: no sharding)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process the tables whose source or dictionary files changed since the last run "
+                             "(a changed table is rebuilt, so rows deleted from its source are removed too)")
+    parser.add_argument("--batch-rows", type=int, default=0,
+                        help="Stream the source workbooks in batches of this many rows, writing the output "
+                             "incrementally so memory is bounded by the batch size (default: whole tables)")
+    args = parser.parse_args()
+
+    manifest = load_manifest()
+    inputs = {name: table_inputs(name) for name in file_paths}
+    plan = plan_tables(manifest, inputs, args.format, args.incremental)
+
+    for name, mode in plan.items():
+        print(f"{name}: {mode or 'unchanged'}")
+    plan = {name: mode for name, mode in plan.items() if mode}
+
+    if manifest["format"] != args.format:
+        manifest = {"format": args.format, "tables": {}}
+
+    # Record the inputs of every table as soon as its output is saved
+    def on_saved(name, report):
+        print_report(name, report)
+        manifest["tables"][name] = inputs[name]
+        save_manifest(manifest)
+
+    if args.workers > 1:
+        run_parallel(plan, args.format, on_saved, args.workers, args.shard_rows, args.batch_rows)
+    else:
+        run_sequential(plan, args.format, on_saved, args.batch_rows)
+
+
+if __name__ == "__main__":
+    main()
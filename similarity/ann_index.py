@@ -0,0 +1,397 @@
+import json
+import os
+import numpy as np
+
+from similarity.file_lock import file_lock, remove_files, tmp_path
+from similarity.patient_search import SCORE_BLOCK_ROWS, PatientSearchIndex
+
+# Approximate nearest-neighbour indexes with the same search API as PatientSearchIndex
+# (search, search_vector, search_batch), plus incremental add / remove and save / load.
+# update_ann_index() keeps a saved index up to date with the embedding store.
+#
+#   HNSWIndex  graph index of hnswlib (optional dependency: pip install hnswlib)
+#   IVFIndex   inverted-file index in pure NumPy (always available)
+#
+# Both return [(id_paciente, cosine similarity)] sorted by similarity, like the exact engine.
+
+_normalize = PatientSearchIndex._normalize
+
+
+def _best(ids, scores, k):
+    # Sorted by similarity; ties keep the order of the candidates
+    order = np.lexsort((np.arange(len(scores)), -scores))[:k]
+    return [(ids[i], float(scores[i])) for i in order]
+
+
+class IVFIndex:
+    """
+    Inverted-file index: the vectors are grouped around `nlist` centroids (spherical k-means)
+    and a query only scores the vectors of its `nprobe` closest groups.
+    Higher nprobe means better recall and slower queries (nprobe = nlist is an exact search).
+
+    nlist: number of groups (None: sqrt of the number of vectors when the index is trained).
+    The centroids are trained on a random sample of at most `sample` vectors, and vectors are
+    assigned to their group in row blocks, so memory does not grow with nlist x N.
+    When the index grows past `retrain_factor` times the size it was trained on (e.g. it was
+    first built from a small delta), the centroids are trained again and the groups rebuilt.
+    """
+
+    backend = "ivf"
+
+    def __init__(self, nlist=None, nprobe=8, iterations=10, seed=0, sample=50000, retrain_factor=4):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.sample = sample
+        self.retrain_factor = retrain_factor
+        self.trained_size = 0
+        self.centroids = None
+        self.ids = []
+        self._positions = {}
+        self._vectors = None
+        self._alive = np.zeros(0, dtype=bool)
+        self._lists = []
+        self._list_arrays = {}
+        self._count = 0
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, pid):
+        return pid in self._positions
+
+    @staticmethod
+    def _assign(vectors, centroids):
+        # Closest centroid of every vector, in row blocks (a block x nlist score matrix at a time)
+        return np.concatenate([
+            np.argmax(vectors[start:start + SCORE_BLOCK_ROWS] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), SCORE_BLOCK_ROWS)
+        ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+    def _sample_rows(self, n):
+        # Sorted random rows of the training sample (at most `sample` of n)
+        rng = np.random.default_rng(self.seed)
+        return np.sort(rng.choice(n, min(self.sample, n), replace=False))
+
+    def _train(self, training, size):
+        """
+        Trains the centroids on a sample of vectors, for an index of `size` vectors.
+        """
+        rng = np.random.default_rng(self.seed)
+        nlist = min(self.nlist or max(int(np.sqrt(size)), 1), len(training))
+        centroids = training[rng.choice(len(training), nlist, replace=False)]
+        for _ in range(self.iterations):
+            assignment = self._assign(training, centroids)
+            for c in range(nlist):
+                members = training[assignment == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = _normalize(centroids)
+        self.centroids = centroids
+        self.trained_size = size
+        self._lists = [[] for _ in range(nlist)]
+        self._list_arrays = {}
+
+    def _retrain(self):
+        # Trains again on the live vectors and rebuilds the groups (the vectors keep their positions)
+        alive = np.flatnonzero(self._alive[:self._count])
+        self._train(self._vectors[alive[self._sample_rows(len(alive))]], len(alive))
+        for start in range(0, len(alive), SCORE_BLOCK_ROWS):
+            rows = alive[start:start + SCORE_BLOCK_ROWS]
+            for position, c in zip(rows, self._assign(self._vectors[rows], self.centroids)):
+                self._lists[c].append(position)
+
+    def add(self, patient_embeddings):
+        """
+        Adds (or replaces) the embeddings of a dict {id_paciente: embedding}.
+        The centroids are trained with the first vectors added (and again when the index outgrows them).
+        """
+        if not patient_embeddings:
+            return
+        self.remove([pid for pid in patient_embeddings if pid in self._positions])
+        vectors = _normalize(np.vstack([np.ravel(emb) for emb in patient_embeddings.values()]))
+        if self.centroids is None:
+            self._train(vectors[self._sample_rows(len(vectors))], len(vectors))
+            self._vectors = np.empty((0, vectors.shape[1]), dtype=vectors.dtype)
+
+        # Grow the storage by doubling, so inserts are amortized O(1)
+        needed = self._count + len(vectors)
+        if needed > len(self._vectors):
+            grown = np.empty((max(needed, 2 * len(self._vectors)), vectors.shape[1]), dtype=self._vectors.dtype)
+            grown[:self._count] = self._vectors[:self._count]
+            self._vectors = grown
+            self._alive = np.concatenate([self._alive, np.zeros(len(grown) - len(self._alive), dtype=bool)])
+        self._vectors[self._count:needed] = vectors
+        self._alive[self._count:needed] = True
+
+        assignment = self._assign(vectors, self.centroids)
+        for offset, (pid, c) in enumerate(zip(patient_embeddings, assignment)):
+            position = self._count + offset
+            self.ids.append(pid)
+            self._positions[pid] = position
+            self._lists[c].append(position)
+            self._list_arrays.pop(c, None)
+        self._count = needed
+        if len(self) > self.retrain_factor * max(self.trained_size, 1):
+            self._retrain()
+
+    def remove(self, patient_ids):
+        """
+        Removes patients from the index (their rows are only marked as deleted).
+        """
+        for pid in patient_ids:
+            position = self._positions.pop(pid, None)
+            if position is not None:
+                self.ids[position] = None
+                self._alive[position] = False
+
+    def _list_array(self, c):
+        # Positions of a list as an array (cached until the list changes)
+        if c not in self._list_arrays:
+            self._list_arrays[c] = np.array(self._lists[c], dtype=np.int64)
+        return self._list_arrays[c]
+
+    def _candidates(self, query):
+        probes = np.argsort(-(self.centroids @ query))[:self.nprobe]
+        positions = np.sort(np.concatenate([self._list_array(c) for c in probes]))
+        return positions[self._alive[positions]]
+
+    def search_vector(self, embedding, k=5, exclude_id=None):
+        if not self._positions:
+            return []
+        query = _normalize(np.ravel(embedding)).astype(self._vectors.dtype)
+        candidates = self._candidates(query)
+        if exclude_id in self._positions:
+            candidates = candidates[candidates != self._positions[exclude_id]]
+        scores = self._vectors[candidates] @ query
+        return _best([self.ids[p] for p in candidates], scores, k)
+
+    def search(self, query_id, k=5, exclude_self=True):
+        query = self._vectors[self._positions[query_id]]
+        return self.search_vector(query, k, query_id if exclude_self else None)
+
+    def search_batch(self, query_ids, k=5, exclude_self=True):
+        return {pid: self.search(pid, k, exclude_self) for pid in query_ids}
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        alive = np.flatnonzero(self._alive[:self._count])
+        np.save(os.path.join(folder, "vectors.npy"), self._vectors[alive])
+        np.save(os.path.join(folder, "centroids.npy"), self.centroids)
+        with open(os.path.join(folder, "ann.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "backend": self.backend,
+                "params": {"nlist": self.nlist, "nprobe": self.nprobe, "iterations": self.iterations, "seed": self.seed,
+                           "sample": self.sample, "retrain_factor": self.retrain_factor},
+                "trained_size": self.trained_size,
+                "ids": [self.ids[p] for p in alive],
+            }, f)
+
+    @classmethod
+    def load(cls, folder):
+        with open(os.path.join(folder, "ann.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(**meta["params"])
+        index.centroids = np.load(os.path.join(folder, "centroids.npy"))
+        index.trained_size = meta.get("trained_size", len(meta["ids"]))
+        index._lists = [[] for _ in range(len(index.centroids))]
+        vectors = np.load(os.path.join(folder, "vectors.npy"))
+        index._vectors = np.empty((0, vectors.shape[1]), dtype=vectors.dtype)
+        index.add(dict(zip(meta["ids"], vectors)))
+        return index
+
+
+class HNSWIndex:
+    """
+    Hierarchical navigable small-world graph (hnswlib).
+    `M` and `ef_construction` set the quality of the graph; `ef` (search breadth) trades
+    recall for latency at query time and can be changed at any moment.
+    """
+
+    backend = "hnsw"
+
+    def __init__(self, M=16, ef_construction=200, ef=64):
+        import hnswlib
+
+        self._hnswlib = hnswlib
+        self.M = M
+        self.ef_construction = ef_construction
+        self._ef = ef
+        self._index = None
+        self.ids = []
+        self._labels = {}
+
+    @property
+    def ef(self):
+        return self._ef
+
+    @ef.setter
+    def ef(self, value):
+        self._ef = value
+        if self._index is not None:
+            self._index.set_ef(value)
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, pid):
+        return pid in self._labels
+
+    def _init_index(self, dim, capacity):
+        self._index = self._hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(max_elements=capacity, ef_construction=self.ef_construction, M=self.M)
+        self._index.set_ef(self._ef)
+
+    def add(self, patient_embeddings):
+        """
+        Adds (or replaces) the embeddings of a dict {id_paciente: embedding}.
+        """
+        if not patient_embeddings:
+            return
+        self.remove([pid for pid in patient_embeddings if pid in self._labels])
+        vectors = np.vstack([np.ravel(emb) for emb in patient_embeddings.values()]).astype(np.float32)
+        if self._index is None:
+            self._init_index(vectors.shape[1], len(vectors))
+        needed = len(self.ids) + len(vectors)
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+
+        labels = np.arange(len(self.ids), needed)
+        self._index.add_items(vectors, labels)
+        for pid, label in zip(patient_embeddings, labels.tolist()):
+            self.ids.append(pid)
+            self._labels[pid] = label
+
+    def remove(self, patient_ids):
+        for pid in patient_ids:
+            label = self._labels.pop(pid, None)
+            if label is not None:
+                self._index.mark_deleted(label)
+                self.ids[label] = None
+
+    def search_vector(self, embedding, k=5, exclude_id=None):
+        if not self._labels:
+            return []
+        k_query = min(k + (exclude_id in self._labels), len(self._labels))
+        self._index.set_ef(max(self._ef, k_query))
+        labels, distances = self._index.knn_query(np.ravel(embedding).astype(np.float32), k=k_query)
+        exclude = self._labels.get(exclude_id)
+        results = [(self.ids[label], 1 - float(d)) for label, d in zip(labels[0], distances[0]) if label != exclude]
+        return sorted(results, key=lambda result: -result[1])[:k]
+
+    def search(self, query_id, k=5, exclude_self=True):
+        query = self._index.get_items([self._labels[query_id]])[0]
+        return self.search_vector(query, k, query_id if exclude_self else None)
+
+    def search_batch(self, query_ids, k=5, exclude_self=True):
+        return {pid: self.search(pid, k, exclude_self) for pid in query_ids}
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self._index.save_index(os.path.join(folder, "hnsw.bin"))
+        with open(os.path.join(folder, "ann.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "backend": self.backend,
+                "params": {"M": self.M, "ef_construction": self.ef_construction, "ef": self._ef},
+                "dim": self._index.dim,
+                "ids": self.ids,
+            }, f)
+
+    @classmethod
+    def load(cls, folder):
+        with open(os.path.join(folder, "ann.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(**meta["params"])
+        index._index = index._hnswlib.Index(space="cosine", dim=meta["dim"])
+        index._index.load_index(os.path.join(folder, "hnsw.bin"))
+        index._index.set_ef(index._ef)
+        index.ids = meta["ids"]
+        index._labels = {pid: label for label, pid in enumerate(index.ids) if pid is not None}
+        return index
+
+
+ANN_BACKENDS = {"hnsw": HNSWIndex, "ivf": IVFIndex}
+
+
+def hnsw_available():
+    try:
+        import hnswlib  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _resolve_backend(backend):
+    if backend == "auto":
+        return "hnsw" if hnsw_available() else "ivf"
+    return backend
+
+
+def build_ann_index(patient_embeddings, backend="auto", **params):
+    """
+    Builds an approximate index of a dict {id_paciente: embedding}.
+    backend: "hnsw", "ivf" or "auto" (HNSW if hnswlib is installed, otherwise IVF).
+    params: M / ef_construction / ef for HNSW, nlist / nprobe for IVF.
+    """
+    index = ANN_BACKENDS[_resolve_backend(backend)](**params)
+    index.add(patient_embeddings)
+    return index
+
+
+def load_ann_index(folder):
+    """
+    Loads an index saved with save(folder), whatever its backend.
+    """
+    with open(os.path.join(folder, "ann.json"), "r", encoding="utf-8") as f:
+        backend = json.load(f)["backend"]
+    return ANN_BACKENDS[backend].load(folder)
+
+
+def update_ann_index(folder, ids, hashes, vectors, version=None, backend="auto", **params):
+    """
+    Loads the index saved in `folder`, applies the changes of a set of embeddings since it was
+    saved (removed, new and changed patients) and saves it again, so it is only built from
+    scratch the first time or when the version, backend or params change.
+    ids / hashes: patient ids and a content hash of each embedding (e.g. the text hashes of an
+    EmbeddingStore); vectors: their embeddings, one row each (only the changed rows are read);
+    version: anything else the embeddings depend on (e.g. the model name).
+    Processes sharing the folder are serialized by a lock file.
+    Returns (index, stats) with the number of patients added, updated and removed.
+    """
+    settings = {"backend": _resolve_backend(backend), "params": params, "version": version}
+    current = dict(zip(ids, hashes))
+    state_path = os.path.join(folder, "state.json")
+    with file_lock(os.path.join(folder, "ann.lock")):
+        index, saved = None, {}
+        if os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state["settings"] == settings:
+                index = load_ann_index(folder)
+                saved = dict(zip(state["ids"], state["hashes"]))
+        if index is None:
+            index = build_ann_index({}, settings["backend"], **params)
+
+        removed = [pid for pid, h in saved.items() if current.get(pid) != h]
+        changed = [i for i, pid in enumerate(ids) if saved.get(pid) != current[pid]]
+        stats = {
+            "added": sum(ids[i] not in saved for i in changed),
+            "updated": sum(ids[i] in saved for i in changed),
+            "removed": sum(pid not in current for pid in removed),
+        }
+        if not removed and not changed:
+            return index, stats
+        index.remove(removed)
+        index.add({ids[i]: vectors[i] for i in changed})
+        if not len(index):
+            # Nothing to save: the next call builds the index again
+            remove_files([state_path])
+            return index, stats
+
+        index.save(folder)
+        path = tmp_path(state_path)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "ids": list(ids), "hashes": list(hashes)}, f)
+        os.replace(path, state_path)
+    return index, stats
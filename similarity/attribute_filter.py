@@ -0,0 +1,173 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from data_io import flag_mask
+
+# Columns of the preprocessed tables used by the attribute filters
+ATTRIBUTE_COLUMNS = {
+    "Pacientes": ["id_paciente", "sexo", "fecha_nacimiento", "nacionalidad", "area_salud"],
+    "Episodios": ["id_episodio", "id_paciente", "tipo_episodio"],
+    "Diagnosticos": ["id_episodio", "diagnostico", "indica_diag_principal"],
+}
+
+# Attributes that can be filtered on
+ATTRIBUTES = ["sexo", "age_band", "nacionalidad", "area_salud", "tipo_episodio", "diagnostico_principal"]
+
+
+class PatientAttributeIndex:
+    """
+    Structured attributes of the patients of a similarity index, to narrow the candidates
+    of a search before any vector is scored.
+
+    Every attribute value has the set of patients (row numbers of `ids`) that have it:
+      - a bitmap (np.packbits, one bit per patient) for attributes with few values
+        (sexo, age band, nacionalidad, ...): AND / OR of bitmaps cost n / 8 bytes each;
+      - a sorted array of row numbers for attributes with many values (diagnoses), so a rare
+        value costs only its own patients.
+    The ages are kept as a sorted array too, for range predicates (edat=(40, 59)).
+
+    candidates(**predicates) returns the sorted row numbers that satisfy all the predicates;
+    a list of values means any of them. Starting from the most selective sorted array, the
+    cost of a query is proportional to its result when a selective predicate is given.
+    """
+
+    def __init__(self, ids, pacientes_df, episodios_df, diagnosticos_df, age_band=10, bitmap_max_values=256):
+        self.ids = list(ids)
+        self.n = len(self.ids)
+        self.age_band = age_band
+        self.bitmap_max_values = bitmap_max_values
+        self._rows = pd.Series(np.arange(self.n), index=pd.Index(self.ids, dtype=object))
+        self.attributes = {}
+
+        pacientes = pacientes_df.drop_duplicates("id_paciente")
+        ages = self._ages(pacientes["fecha_nacimiento"])
+        bands = pd.Series([
+            f"{age // age_band * age_band}-{age // age_band * age_band + age_band - 1}" if age >= 0 else None for age in ages
+        ], index=pacientes.index, dtype=object)
+        self._add("sexo", pacientes["id_paciente"], pacientes["sexo"])
+        self._add("age_band", pacientes["id_paciente"], bands)
+        self._add("nacionalidad", pacientes["id_paciente"], pacientes["nacionalidad"])
+        self._add("area_salud", pacientes["id_paciente"], pacientes["area_salud"])
+        self._add("tipo_episodio", episodios_df["id_paciente"], episodios_df["tipo_episodio"])
+
+        episodes = episodios_df[["id_episodio", "id_paciente"]].drop_duplicates()
+        principal = diagnosticos_df[flag_mask(diagnosticos_df["indica_diag_principal"])][["id_episodio", "diagnostico"]]
+        principal = principal.merge(episodes, on="id_episodio")
+        self._add("diagnostico_principal", principal["id_paciente"], principal["diagnostico"])
+
+        # Ages: sorted array of (age, row) for range predicates
+        rows = self._row_numbers(pacientes["id_paciente"])
+        known = (rows >= 0) & (ages >= 0)
+        order = np.lexsort((rows[known], ages[known]))
+        self._sorted_ages = ages[known][order]
+        self._age_rows = rows[known][order]
+
+    @staticmethod
+    def _ages(fechas):
+        # Age in whole years (-1 if unknown), as in the patient texts
+        fechas = pd.to_datetime(fechas, errors="coerce")
+        days = (pd.Timestamp(datetime.now()) - fechas).dt.days
+        return (days // 365).fillna(-1).astype(np.int64).to_numpy()
+
+    def _row_numbers(self, patient_ids):
+        # Row of every patient id in `ids` (-1 if the patient is not in the index)
+        keys = pd.Series(patient_ids).astype("string").astype(object)
+        return self._rows.reindex(keys.to_numpy()).fillna(-1).astype(np.int64).to_numpy()
+
+    def _add(self, name, patient_ids, values):
+        """
+        Indexes a (possibly multi-valued) attribute from parallel series of patient ids and values.
+        """
+        rows = self._row_numbers(patient_ids)
+        codes, uniques = pd.factorize(pd.Series(values).reset_index(drop=True))
+        keep = (rows >= 0) & (codes >= 0)
+        rows, codes = rows[keep], codes[keep]
+
+        # Unique (value, row) pairs grouped by value, rows sorted
+        pairs = np.unique(np.stack([codes, rows]), axis=1) if len(rows) else np.empty((2, 0), dtype=np.int64)
+        codes, rows = pairs[0], pairs[1]
+        bounds = np.searchsorted(codes, np.arange(len(uniques) + 1))
+        use_bitmap = len(uniques) <= self.bitmap_max_values
+        sets = {}
+        for code, value in enumerate(uniques):
+            members = rows[bounds[code]:bounds[code + 1]].astype(np.int64)
+            if use_bitmap:
+                bits = np.zeros(self.n, dtype=bool)
+                bits[members] = True
+                sets[str(value)] = np.packbits(bits)
+            else:
+                sets[str(value)] = members
+
+        # Values of every patient (CSR: patient rows -> value codes), for same_as()
+        order = np.lexsort((codes, rows))
+        indptr = np.searchsorted(rows[order], np.arange(self.n + 1))
+        self.attributes[name] = {
+            "bitmap": use_bitmap,
+            "sets": sets,
+            "values": np.array([str(value) for value in uniques], dtype=object),
+            "indptr": indptr,
+            "codes": codes[order],
+        }
+
+    def __contains__(self, pid):
+        return pid in self._rows.index
+
+    def row_of(self, patient_id):
+        return int(self._rows[patient_id])
+
+    def values_of(self, row, name):
+        """
+        Returns the values of an attribute of the patient at `row` (a list; empty if unknown).
+        """
+        attribute = self.attributes[name]
+        return list(attribute["values"][attribute["codes"][attribute["indptr"][row]:attribute["indptr"][row + 1]]])
+
+    def same_as(self, patient_id, attributes):
+        """
+        Predicates "same <attribute> as this patient" (any shared value for multi-valued ones).
+        """
+        row = self.row_of(patient_id)
+        return {name: self.values_of(row, name) for name in attributes}
+
+    def _any_of(self, name, values):
+        # Patients with any of the values: one bitmap or one sorted array
+        attribute = self.attributes[name]
+        sets = [attribute["sets"][value] for value in map(str, values) if value in attribute["sets"]]
+        if attribute["bitmap"]:
+            return np.bitwise_or.reduce(sets) if sets else np.zeros((self.n + 7) // 8, dtype=np.uint8)
+        if len(sets) == 1:
+            return sets[0]
+        return np.unique(np.concatenate(sets)) if sets else np.empty(0, dtype=np.int64)
+
+    def candidates(self, edat=None, **predicates):
+        """
+        Row numbers (sorted) of the patients that satisfy every predicate, or None without predicates.
+        predicates: attribute=value or attribute=[values] (see ATTRIBUTES);
+        edat=(min, max): age range, both included.
+        """
+        bitmaps, arrays = [], []
+        for name, values in predicates.items():
+            if name not in self.attributes:
+                raise ValueError(f"Atribut desconegut: {name} (opcions: {', '.join(ATTRIBUTES)})")
+            values = [values] if isinstance(values, str) or not hasattr(values, "__iter__") else list(values)
+            (bitmaps if self.attributes[name]["bitmap"] else arrays).append(self._any_of(name, values))
+        if edat is not None:
+            start = np.searchsorted(self._sorted_ages, edat[0], side="left")
+            end = np.searchsorted(self._sorted_ages, edat[1], side="right")
+            arrays.append(np.sort(self._age_rows[start:end]))
+        if not bitmaps and not arrays:
+            return None
+
+        bitmap = np.bitwise_and.reduce(bitmaps) if bitmaps else None
+        if not arrays:
+            return np.flatnonzero(np.unpackbits(bitmap, count=self.n))
+
+        # Intersect the sorted arrays from the smallest, then test the bitmap bits of the survivors only
+        arrays.sort(key=len)
+        rows = arrays[0]
+        for other in arrays[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        if bitmap is not None:
+            rows = rows[(bitmap[rows >> 3] >> (7 - (rows & 7))) & 1 == 1]
+        return rows
@@ -1,39 +1,165 @@
+import os
+import time
 import torch
 from transformers import AutoTokenizer, AutoModel
 import numpy as np
 import pickle
+import uuid
+from itertools import islice
+
+EMBEDDING_BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+ONNX_FOLDER = "dades/onnx"
+
+
+def _tmp_onnx_path(path):
+    # Private name for one writer (the .onnx extension is kept for the ONNX tools)
+    return f"{path[:-len('.onnx')]}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp.onnx"
+
+
+class _ClsEmbedding(torch.nn.Module):
+    # Model wrapper that only returns the CLS embedding (the graph exported to ONNX)
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0, :]
+
 
 class EmbeddingIndexer:
-    def __init__(self, model_name = "xlm-roberta-base", device=None):
-        self.device = device if device else ('cuda' if torch.cuda.is_available() else 'cpu')
+    """
+    backend: how the model is run
+        "torch"       PyTorch eager, fp32 (CPU or GPU)
+        "torch-int8"  PyTorch with the Linear layers dynamically quantized to int8 (CPU)
+        "onnx"        ONNX Runtime on a graph exported once to onnx_folder (CPU)
+        "onnx-int8"   the same graph with int8 weights (onnxruntime.quantization)
+    num_threads: intra-op threads of the backend (None = library default). For the torch
+    backends it is set with torch.set_num_threads, which applies to the whole process.
+    The quantized backends are approximations: see compare_backends() for their drift.
+    """
+
+    def __init__(self, model_name = "xlm-roberta-base", device=None, batch_size=16, max_length=512,
+                 backend="torch", num_threads=None, onnx_folder=ONNX_FOLDER):
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Backend d'inferència desconegut: {backend} (opcions: {', '.join(EMBEDDING_BACKENDS)})")
+        self.model_name = model_name
+        self.backend = backend
+        self.num_threads = num_threads
+        if backend == "torch":
+            self.device = device if device else ('cuda' if torch.cuda.is_available() else 'cpu')
+        else:
+            self.device = 'cpu'
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.model = None
+        self.session = None
+
+        if backend.startswith("onnx"):
+            self.session = self._onnx_session(onnx_folder)
+            return
+        if num_threads:
+            torch.set_num_threads(num_threads)
         self.model = AutoModel.from_pretrained(model_name)
-        self.model.to(self.device)
         self.model.eval()
+        if backend == "torch-int8":
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.to(self.device)
+
+    def _onnx_session(self, onnx_folder):
+        """
+        Exports the model to ONNX the first time (and quantizes it for "onnx-int8"),
+        then opens an ONNX Runtime session on the cached file.
+        Several workers can do this at once: each one writes its own temporary file and
+        moves it into place, so a session never opens a half-written graph.
+        """
+        import onnxruntime
+
+        os.makedirs(onnx_folder, exist_ok=True)
+        name = self.model_name.replace("/", "--")
+        path = os.path.join(onnx_folder, f"{name}.onnx")
+        if not os.path.exists(path):
+            model = _ClsEmbedding(AutoModel.from_pretrained(self.model_name)).eval()
+            sample = self.tokenizer(["text"], return_tensors="pt")
+            tmp_path = _tmp_onnx_path(path)
+            torch.onnx.export(
+                model,
+                (sample["input_ids"], sample["attention_mask"]),
+                tmp_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["cls_embedding"],
+                dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "cls_embedding": {0: "batch"}},
+                opset_version=17,
+            )
+            os.replace(tmp_path, path)
+        if self.backend == "onnx-int8":
+            quantized = os.path.join(onnx_folder, f"{name}-int8.onnx")
+            if not os.path.exists(quantized):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                tmp_path = _tmp_onnx_path(quantized)
+                quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8)
+                os.replace(tmp_path, quantized)
+            path = quantized
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        return onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
 
     def get_embedding(self, text):
-        inputs = self.tokenizer(
-            text,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=512
-        ).to(self.device)
+        encoded = self.tokenizer([text], truncation=True, max_length=self.max_length)
+        return self._embed_tokens(encoded)[0].flatten()
+
+    def _embed_tokens(self, encoded):
+        """
+        encoded: {"input_ids": [...], "attention_mask": [...]} of the texts of one batch.
+        Pads the batch only to its longest text and returns the CLS embeddings (n x hidden).
+        """
+        if self.session is not None:
+            inputs = self.tokenizer.pad(encoded, padding=True, return_tensors="np")
+            feed = {name: inputs[name].astype(np.int64) for name in ("input_ids", "attention_mask")}
+            return self.session.run(None, feed)[0]
+        inputs = self.tokenizer.pad(encoded, padding=True, return_tensors="pt").to(self.device)
         with torch.no_grad():
             outputs = self.model(**inputs)
-            emb = outputs.last_hidden_state[:, 0, :].cpu().numpy().flatten()
-        return emb
+            return outputs.last_hidden_state[:, 0, :].float().cpu().numpy()
+
+    def iter_embeddings(self, patient_texts, batch_size=None, window_batches=32):
+        """
+        patient_texts: dict {id_paciente: text} (or an iterable of (id_paciente, text) pairs)
+        Yields (id_paciente, embedding) pairs computed in batches of `batch_size` texts.
 
-    def build_embeddings(self, patient_texts):
+        The texts are read in windows of `window_batches` batches. Inside a window they are
+        sorted by token length, so each batch holds texts of similar length and little padding
+        is computed. Pairs are yielded in that order, not in the input order, and only one
+        window of tokenized texts is kept in memory. Empty texts are skipped.
+        """
+        batch_size = batch_size or self.batch_size
+        items = iter(patient_texts.items() if isinstance(patient_texts, dict) else patient_texts)
+        while True:
+            window = list(islice(items, batch_size * window_batches))
+            if not window:
+                return
+            window = [(pid, text) for pid, text in window if text.strip()]
+            if not window:
+                continue
+
+            encoded = self.tokenizer([text for _, text in window], truncation=True, max_length=self.max_length)
+            order = sorted(range(len(window)), key=lambda i: len(encoded["input_ids"][i]))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                embeddings = self._embed_tokens({key: [values[i] for i in batch] for key, values in encoded.items()})
+                for i, emb in zip(batch, embeddings):
+                    yield window[i][0], emb
+
+    def build_embeddings(self, patient_texts, batch_size=None):
         """
         patient_texts: dict {id_paciente: text}
-        Returns: dict {id_paciente: embedding (np.array)}
+        Returns: dict {id_paciente: embedding (np.array)}, in the order of patient_texts.
         """
-        embeddings = {}
-        for pid, text in patient_texts.items():
-            if text.strip():
-                embeddings[pid] = self.get_embedding(text)
-        return embeddings
+        embeddings = dict(self.iter_embeddings(patient_texts, batch_size))
+        return {pid: embeddings[pid] for pid in patient_texts if pid in embeddings}
 
     def save_embeddings(self, embeddings, filename="patient_embeddings.pkl"):
         with open(filename, "wb") as f:
@@ -41,4 +167,39 @@ class EmbeddingIndexer:
 
     def load_embeddings(self, filename="patient_embeddings.pkl"):
         with open(filename, "rb") as f:
-            return pickle.load(f)
\ No newline at end of file
+            return pickle.load(f)
+
+
+def compare_backends(patient_texts, model_name="xlm-roberta-base", backends=("torch-int8", "onnx", "onnx-int8"),
+                     num_threads=None, batch_size=16):
+    """
+    Equivalence check of the inference backends: embeds a sample of texts with the fp32 torch
+    model (on CPU) and with every backend, and measures the cosine similarity of each embedding
+    with its fp32 reference.
+    patient_texts: dict {id_paciente: text}
+    Returns {backend: {"seconds", "speedup", "mean_cosine", "min_cosine"}} ("torch" is the reference).
+    """
+    def embed(backend):
+        indexer = EmbeddingIndexer(model_name, device="cpu", batch_size=batch_size, backend=backend, num_threads=num_threads)
+        start = time.perf_counter()
+        embeddings = indexer.build_embeddings(patient_texts)
+        return embeddings, time.perf_counter() - start
+
+    reference, reference_seconds = embed("torch")
+    ids = list(reference)
+    reference_matrix = np.vstack([reference[pid] for pid in ids])
+    reference_matrix /= np.linalg.norm(reference_matrix, axis=1, keepdims=True)
+
+    results = {"torch": {"seconds": round(reference_seconds, 3), "speedup": 1.0, "mean_cosine": 1.0, "min_cosine": 1.0}}
+    for backend in backends:
+        embeddings, seconds = embed(backend)
+        matrix = np.vstack([embeddings[pid] for pid in ids])
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        cosines = np.sum(matrix * reference_matrix, axis=1)
+        results[backend] = {
+            "seconds": round(seconds, 3),
+            "speedup": round(reference_seconds / seconds, 2),
+            "mean_cosine": float(cosines.mean()),
+            "min_cosine": float(cosines.min()),
+        }
+    return results
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import uuid
+import numpy as np
+
+from similarity.file_lock import file_lock, remove_files, tmp_path
+
+EMBEDDINGS_FOLDER = "dades/embeddings"
+
+
+def text_hash(text):
+    """
+    Content hash of a patient text (sha256 of its UTF-8 bytes).
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Persistent patient-embedding index kept in `folder`:
+        embeddings-<uuid>.npy      float matrix, one row per patient (memory-mapped when loaded)
+        index.json                 model name and backend, patient ids, text hashes, the matrix file name
+                                   and the old matrix files not deleted yet ("stale")
+        index.lock                 held by the process that is refreshing the store
+
+    refresh() only re-embeds the patients whose text is new or changed and drops the patients
+    that are gone. A new matrix file is written for every change and index.json is replaced
+    atomically, so a reader always sees a matrix and an id list that belong together.
+    Refreshes of several processes are serialized by index.lock. The matrix that index.json
+    referenced before is deleted once this process no longer maps it; a file still mapped
+    elsewhere (which Windows does not let delete) stays in "stale" and is retried later.
+
+    dtype: type of the stored matrix (e.g. "float16" to halve its size); None keeps the type
+    of the model output. A matrix of another type is converted on the next refresh().
+    backend: EmbeddingIndexer backend that computes the embeddings. Like the model, it is part
+    of the index: the vectors of a quantized backend are never mixed with fp32 ones.
+    """
+
+    def __init__(self, folder=EMBEDDINGS_FOLDER, model_name="xlm-roberta-base", dtype=None, backend="torch"):
+        self.folder = folder
+        self.model_name = model_name
+        self.backend = backend
+        self.dtype = np.dtype(dtype) if dtype else None
+        self.index_path = os.path.join(folder, "index.json")
+        self.lock_path = os.path.join(folder, "index.lock")
+        self.ids = []
+        self.hashes = []
+        self.matrix = None
+        self._matrix_file = None
+        self._loaded_state = None
+        self.load()
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        path = tmp_path(self.index_path)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(path, self.index_path)
+
+    def _index_state(self):
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """
+        Loads the index; the matrix is memory-mapped (read-only, no copy).
+        An index built with another model or backend is ignored.
+        """
+        # The previous matrix is unmapped (unless someone else still holds it)
+        self.ids, self.hashes, self.matrix, self._matrix_file = [], [], None, None
+        self._loaded_state = self._index_state()
+        index = self._read_index()
+        if index is None:
+            return
+        # Indexes written before the backend was recorded were computed with torch
+        if (index["model"], index.get("backend", "torch")) != (self.model_name, self.backend):
+            print(f"L'índex d'embeddings és del model {index['model']} ({index.get('backend', 'torch')}): es tornarà a calcular.")
+            return
+        self.ids = index["ids"]
+        self.hashes = index["hashes"]
+        self._matrix_file = index["matrix"]
+        self.matrix = np.load(os.path.join(self.folder, self._matrix_file), mmap_mode="r") if self.ids else None
+
+    def changed_on_disk(self):
+        """
+        Checks whether index.json was rewritten (e.g. by another process) since it was loaded.
+        """
+        return self._index_state() != self._loaded_state
+
+    def reload(self):
+        """
+        Loads the index again under the store lock, so no refresh replaces it while it is read.
+        Returns the number of patients added, updated, removed and unchanged since the last load.
+        """
+        previous = dict(zip(self.ids, self.hashes))
+        with file_lock(self.lock_path):
+            self.load()
+        current = dict(zip(self.ids, self.hashes))
+        return {
+            "added": sum(pid not in previous for pid in current),
+            "updated": sum(pid in previous and previous[pid] != h for pid, h in current.items()),
+            "removed": sum(pid not in current for pid in previous),
+            "unchanged": sum(previous.get(pid) == h for pid, h in current.items()),
+        }
+
+    def __len__(self):
+        return len(self.ids)
+
+    def embeddings(self):
+        """
+        Returns {id_paciente: embedding}; the embeddings are views of the memory-mapped matrix.
+        """
+        return {pid: self.matrix[i] for i, pid in enumerate(self.ids)}
+
+    def changed_texts(self, patient_texts):
+        """
+        Returns {id_paciente: text} of the non-empty texts that are new or changed since the last refresh.
+        """
+        positions = {pid: i for i, pid in enumerate(self.ids)}
+        return {
+            pid: text for pid, text in patient_texts.items()
+            if text.strip() and (pid not in positions or self.hashes[positions[pid]] != text_hash(text))
+        }
+
+    def refresh(self, patient_texts, make_indexer, remove_stale=True):
+        """
+        patient_texts: dict {id_paciente: text} (see build_patient_texts)
+        make_indexer: function returning an EmbeddingIndexer (or any object with iter_embeddings,
+        like a ShardedEmbeddingJob); only called if a text has to be embedded
+        remove_stale: delete the replaced matrix file at the end; pass False if other objects
+        of this process (e.g. a search index) still map it, and call remove_stale() once they are gone.
+        Returns the number of patients added, updated, removed and unchanged.
+        """
+        with file_lock(self.lock_path):
+            # Another process may have refreshed the store since it was loaded
+            self.load()
+            stats = self._refresh(patient_texts, make_indexer)
+            if remove_stale:
+                self._remove_stale()
+            return stats
+
+    def _refresh(self, patient_texts, make_indexer):
+        positions = {pid: i for i, pid in enumerate(self.ids)}
+        texts = {pid: text for pid, text in patient_texts.items() if text.strip()}
+        hashes = {pid: text_hash(text) for pid, text in texts.items()}
+
+        changed = {pid: text for pid, text in texts.items() if pid not in positions or self.hashes[positions[pid]] != hashes[pid]}
+        stats = {
+            "added": sum(pid not in positions for pid in changed),
+            "updated": sum(pid in positions for pid in changed),
+            "removed": sum(pid not in texts for pid in self.ids),
+            "unchanged": len(texts) - len(changed),
+        }
+        converted = self.dtype is not None and self.matrix is not None and self.matrix.dtype != self.dtype
+        if not changed and not stats["removed"] and not converted:
+            return stats
+
+        new_embeddings = dict(make_indexer().iter_embeddings(changed)) if changed else {}
+        ids = list(texts)
+        sample = next(iter(new_embeddings.values())) if new_embeddings else self.matrix[0]
+        # Never overwrite a matrix file: other processes may have it memory-mapped
+        matrix_file = f"embeddings-{uuid.uuid4().hex}.npy"
+
+        # Write the new matrix row by row (unchanged rows are copied from the current file)
+        os.makedirs(self.folder, exist_ok=True)
+        if ids:
+            path = os.path.join(self.folder, matrix_file)
+            matrix = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype or sample.dtype, shape=(len(ids), len(sample)))
+            for i, pid in enumerate(ids):
+                matrix[i] = new_embeddings[pid] if pid in new_embeddings else self.matrix[positions[pid]]
+            matrix.flush()
+            del matrix
+
+        # The matrix referenced until now is only deleted by remove_stale()
+        previous = self._read_index() or {}
+        stale = previous.get("stale", []) + ([previous["matrix"]] if previous.get("matrix") else [])
+        self._write_index({"model": self.model_name, "backend": self.backend, "matrix": matrix_file, "ids": ids,
+                           "hashes": [hashes[pid] for pid in ids], "stale": stale})
+        self.load()
+        return stats
+
+    def remove_stale(self, blocking=True):
+        """
+        Deletes the matrix files replaced by earlier refreshes, except the ones that are still
+        in use. Call it after dropping the objects that mapped the previous matrix.
+        Without `blocking`, nothing is done while another process is refreshing the store.
+        """
+        with file_lock(self.lock_path, blocking=blocking) as locked:
+            if locked:
+                self._remove_stale()
+
+    def _remove_stale(self):
+        index = self._read_index()
+        if not index or not index.get("stale"):
+            return
+        kept = remove_files([os.path.join(self.folder, file) for file in index["stale"]])
+        index["stale"] = [os.path.basename(path) for path in kept]
+        self._write_index(index)
+        if index["matrix"] == self._matrix_file:
+            # Only the stale list changed: the loaded version is still current
+            self._loaded_state = self._index_state()
@@ -0,0 +1,75 @@
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+# Helpers to publish files that other processes may be reading or memory-mapping
+# (the embedding store, the neighbour table and the shards of an embedding job).
+
+
+def _try_lock(f):
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(f):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(path, blocking=True, poll=0.5):
+    """
+    Exclusive lock shared by every process (and node, on a shared disk) that uses the same path.
+    The lock is held by the open file, so the system releases it if the process dies.
+    Yields True when the lock is held; without `blocking` it yields False at once if another
+    process holds it.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+b") as f:
+        while not _try_lock(f):
+            if not blocking:
+                yield False
+                return
+            time.sleep(poll)
+        try:
+            yield True
+        finally:
+            _unlock(f)
+
+
+def tmp_path(path):
+    """
+    Temporary path next to `path`, unique to this process and call (written, then os.replace'd).
+    """
+    return f"{path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp"
+
+
+def remove_files(paths):
+    """
+    Removes files, ignoring the ones that are already gone or still in use (on Windows a
+    memory-mapped file cannot be deleted). Returns the paths that could not be removed.
+    """
+    kept = []
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            kept.append(path)
+    return kept
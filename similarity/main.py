@@ -1,24 +1,25 @@
-import pandas as pd
-from patient_text_builder import build_patient_texts, build_patient_texts
-from embedding_indexer import EmbeddingIndexer
-from patient_search import find_most_similar_patient
+# Run from the repository root: python -m similarity.main
+from data_io import TABLE_NAMES, read_tables
+from similarity.patient_text_builder import build_patient_texts, PATIENT_TEXT_COLUMNS
+from similarity.embedding_indexer import EmbeddingIndexer
+from similarity.embedding_store import EmbeddingStore
+from similarity.patient_search import PatientSearchIndex
 
 def main():
 
     # Load data
-    pacientes_df = pd.read_csv("dades/dades_preprocessades/Pacientes.csv", dtype={'id_paciente': str})
-    episodios_df = pd.read_csv("dades/dades_preprocessades/Episodios.csv", dtype={'id_paciente': str})
-    movimientos_df = pd.read_csv("dades/dades_preprocessades/Movimientos.csv", dtype={'id_paciente': str})
-    diagnosticos_df = pd.read_csv("dades/dades_preprocessades/Diagnosticos.csv", dtype={'id_paciente': str})
-    textos_df = pd.read_csv("dades/dades_preprocessades/Textos.csv", dtype={'id_paciente': str})
+    tables = read_tables(columns=PATIENT_TEXT_COLUMNS)
+    pacientes_df, episodios_df, movimientos_df, diagnosticos_df, textos_df = (tables[name] for name in TABLE_NAMES)
 
     # Create patient texts
     patient_texts = build_patient_texts(pacientes_df, episodios_df, movimientos_df, diagnosticos_df, textos_df)
 
-    # Build embeddings
-    indexer = EmbeddingIndexer()
-    patient_embeddings = indexer.build_embeddings(patient_texts)
-    indexer.save_embeddings(patient_embeddings)
+    # Update the stored embeddings (only new or changed patient texts are embedded)
+    store = EmbeddingStore()
+    stats = store.refresh(patient_texts, EmbeddingIndexer)
+    print(f"Embeddings: {stats['added']} nous, {stats['updated']} actualitzats, "
+          f"{stats['removed']} eliminats, {stats['unchanged']} sense canvis")
+    patient_embeddings = store.embeddings()
     
     # Buscar el pacient més similar
     query_id = input("Introduceix l'id del pacient a buscar: ").strip()
@@ -27,8 +28,15 @@ def main():
         print("El pacient no té textos clínics.")
         return
 
-    best_id, best_score = find_most_similar_patient(query_id, patient_embeddings)
+    similars = PatientSearchIndex(patient_embeddings).search(query_id, k=5)
+    if not similars:
+        print("No hi ha altres pacients per comparar.")
+        return
+
+    best_id, best_score = similars[0]
     print(f"\nEl paciente més similar a {query_id} es {best_id} (similitud: {best_score:.2%})")
+    for pid, score in similars[1:]:
+        print(f"  Altres similars: {pid} (similitud: {score:.2%})")
     print("\n--- Text del pacient consultat ---")
     print(patient_texts[query_id][:2500])
     print("\n--- Text del pacient més similar ---")
@@ -0,0 +1,325 @@
+import argparse
+import hashlib
+import json
+import os
+import uuid
+import numpy as np
+
+from similarity.embedding_store import EMBEDDINGS_FOLDER
+from similarity.file_lock import file_lock, remove_files, tmp_path
+from similarity.patient_search import PatientSearchIndex
+
+NEIGHBOURS_FOLDER = os.path.join(EMBEDDINGS_FOLDER, "neighbours")
+
+
+def embedding_hash(embedding):
+    # Content hash of one embedding row (detects the patients whose embedding changed)
+    return hashlib.blake2b(np.ascontiguousarray(embedding).tobytes(), digest_size=8).hexdigest()
+
+
+# Bytes per cell of a block x block score matrix while it is reduced to its top k: the float32
+# score and argpartition's int64 index, plus headroom for the copied top-k slices and the row blocks
+BLOCK_CELL_BYTES = 4 + 4 + 8 + 1
+
+
+def _block_rows(memory_mb):
+    # Rows per block so that the whole working set of one block x block of scores fits in the memory cap
+    return max(int(np.sqrt(memory_mb * 2**20 / BLOCK_CELL_BYTES)), 1)
+
+
+def _merge_top_k(positions, scores, new_positions, new_scores, k):
+    # Best k of two candidate lists per row; ties keep the lowest position (as PatientSearchIndex)
+    positions = np.concatenate([positions, new_positions], axis=1)
+    scores = np.concatenate([scores, new_scores], axis=1)
+    order = np.lexsort((positions, -scores), axis=1)[:, :k]
+    return np.take_along_axis(positions, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def pair_scores(matrix, rows, neighbours, memory_mb=512):
+    """
+    Cosine similarity of each row with its own neighbours (rows: n row numbers,
+    neighbours: n x k row numbers, -1 = none). Returns n x k float32 scores (-inf for -1).
+    """
+    scores = np.full(neighbours.shape, -np.inf, dtype=np.float32)
+    block = max(_block_rows(memory_mb) ** 2 // max(neighbours.shape[1] * matrix.shape[1], 1), 1)
+    for start in range(0, len(rows), block):
+        block_neighbours = neighbours[start:start + block]
+        valid = block_neighbours >= 0
+        queries = PatientSearchIndex._normalize(matrix[rows[start:start + block]]).astype(np.float32)
+        others = PatientSearchIndex._normalize(matrix[np.where(valid, block_neighbours, 0).ravel()]).astype(np.float32)
+        others = others.reshape(block_neighbours.shape + (-1,))
+        scores[start:start + block] = np.where(valid, np.einsum("nd,nkd->nk", queries, others), -np.inf)
+    return scores
+
+
+def blocked_top_k(matrix, k, query_rows=None, column_rows=None, memory_mb=512):
+    """
+    Top-k cosine neighbours of the query rows among the column rows of `matrix`
+    (a patient never is its own neighbour), computed block by block so that the scores of a
+    block and the arrays used to select their top k stay within `memory_mb`. The matrix can be memory-mapped.
+    query_rows / column_rows: row numbers (None = all rows).
+    Returns (positions, scores), both len(query_rows) x k, sorted by similarity;
+    rows with fewer than k candidates are padded with position -1 and score -inf.
+    """
+    n = len(matrix)
+    query_rows = np.arange(n) if query_rows is None else np.asarray(query_rows, dtype=np.int64)
+    column_rows = np.arange(n) if column_rows is None else np.asarray(column_rows, dtype=np.int64)
+    block = _block_rows(memory_mb)
+
+    positions = np.full((len(query_rows), k), -1, dtype=np.int64)
+    scores = np.full((len(query_rows), k), -np.inf, dtype=np.float32)
+    for q_start in range(0, len(query_rows), block):
+        q_rows = query_rows[q_start:q_start + block]
+        queries = PatientSearchIndex._normalize(matrix[q_rows]).astype(np.float32)
+        best_positions, best_scores = positions[q_start:q_start + block], scores[q_start:q_start + block]
+
+        for c_start in range(0, len(column_rows), block):
+            c_rows = column_rows[c_start:c_start + block]
+            columns = PatientSearchIndex._normalize(matrix[c_rows]).astype(np.float32)
+            block_scores = queries @ columns.T
+            # A patient is never its own neighbour: only the rows that are in both blocks are masked
+            _, q_self, c_self = np.intersect1d(q_rows, c_rows, assume_unique=True, return_indices=True)
+            block_scores[q_self, c_self] = -np.inf
+
+            # Best k of the block (negated in place for argpartition), merged with the best k so far
+            kk = min(k, len(c_rows))
+            if kk < len(c_rows):
+                np.negative(block_scores, out=block_scores)
+                top = np.argpartition(block_scores, kk - 1, axis=1)[:, :kk].copy()
+                top_scores = -np.take_along_axis(block_scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(len(c_rows)), block_scores.shape)
+                top_scores = block_scores
+            del block_scores
+            best_positions, best_scores = _merge_top_k(best_positions, best_scores, c_rows[top], top_scores, k)
+
+        best_positions[np.isneginf(best_scores)] = -1
+        positions[q_start:q_start + block], scores[q_start:q_start + block] = best_positions, best_scores
+    return positions, scores
+
+
+class NeighbourTable:
+    """
+    Precomputed top-k neighbours of every patient, kept in `folder`:
+        neighbours-<uuid>.npy   int32 matrix (patients x k): row number of each neighbour
+        scores-<uuid>.npy       float16 matrix (patients x k): its cosine similarity
+        table.json              k, patient ids, embedding hashes, the matrix file names, the
+                                version of the EmbeddingStore they come from (model, backend and
+                                text hash of every patient) and the replaced files not deleted yet
+        table.lock              held by the process that is updating the table
+
+    A lookup is a dictionary access and one row of each matrix (memory-mapped).
+    update() recomputes the table from the current embeddings, only for the patients
+    whose neighbours can have changed (see update()). Updates are published like the
+    EmbeddingStore ones: serialized by table.lock, with the replaced files deleted once unmapped.
+    matching_rows() tells which rows still hold for a newer version of the store.
+    """
+
+    def __init__(self, folder=NEIGHBOURS_FOLDER):
+        self.folder = folder
+        self.table_path = os.path.join(folder, "table.json")
+        self.lock_path = os.path.join(folder, "table.lock")
+        self._loaded_state = None
+        self.load()
+
+    def _table_state(self):
+        try:
+            stat = os.stat(self.table_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_table(self):
+        if not os.path.exists(self.table_path):
+            return None
+        with open(self.table_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_table(self, table):
+        path = tmp_path(self.table_path)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(table, f)
+        os.replace(path, self.table_path)
+
+    def load(self):
+        # The previous matrices are unmapped (unless someone else still holds them)
+        self.k = 0
+        self.ids = []
+        self.hashes = []
+        self.store_hashes = None
+        self.version = None
+        self.neighbours = None
+        self.scores = None
+        self._positions = {}
+        self._loaded_state = self._table_state()
+        table = self._read_table()
+        if table is None:
+            return
+        self.k = table["k"]
+        self.ids = table["ids"]
+        self.hashes = table["hashes"]
+        # Tables written before the store version was recorded never match a store
+        self.store_hashes = table.get("store_hashes")
+        self.version = table.get("version")
+        self._positions = {pid: i for i, pid in enumerate(self.ids)}
+        if self.ids:
+            self.neighbours = np.load(os.path.join(self.folder, table["neighbours"]), mmap_mode="r")
+            self.scores = np.load(os.path.join(self.folder, table["scores"]), mmap_mode="r")
+
+    def changed_on_disk(self):
+        """
+        Checks whether table.json was rewritten (e.g. by the offline job) since it was loaded.
+        """
+        return self._table_state() != self._loaded_state
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pid):
+        return pid in self._positions
+
+    def row_of(self, pid):
+        return self._positions.get(pid)
+
+    def matching_rows(self, ids, store_hashes, version):
+        """
+        Rows of the table that still hold for an EmbeddingStore with these ids, text hashes and
+        version ([model, backend]): the patient and all its neighbours have the same text (so the
+        same embedding) as when the table was computed.
+        Returns a boolean array over the rows of the table.
+        """
+        if not self.ids or self.store_hashes is None or self.version != version:
+            return np.zeros(len(self.ids), dtype=bool)
+        current = dict(zip(ids, store_hashes))
+        same = np.array([current.get(pid) == h for pid, h in zip(self.ids, self.store_hashes)], dtype=bool)
+        neighbours = np.asarray(self.neighbours)
+        return same & ((neighbours < 0) | same[neighbours]).all(axis=1)
+
+    def top_k(self, patient_id, k=None):
+        """
+        Returns the (at most k) nearest neighbours of a patient as [(id_paciente, similarity)],
+        or None if the patient is not in the table.
+        """
+        row = self._positions.get(patient_id)
+        if row is None:
+            return None
+        return [
+            (self.ids[position], float(score))
+            for position, score in zip(self.neighbours[row][:k], self.scores[row][:k]) if position >= 0
+        ]
+
+    def update(self, ids, matrix, k=10, memory_mb=512, full=False, store_hashes=None, version=None):
+        """
+        Recomputes the table for the patients `ids` with embeddings `matrix` (one row each,
+        e.g. the memory-mapped matrix of an EmbeddingStore).
+        store_hashes / version: text hashes and [model, backend] of the EmbeddingStore, recorded
+        so that readers can tell which rows still match the store (see matching_rows()).
+
+        Unless `full` (or k changed), only these rows are computed against every patient:
+          - new patients and patients whose embedding changed,
+          - patients with a removed or changed patient among their neighbours.
+        The other rows keep their neighbours and are only compared with the changed patients,
+        which can enter their top k.
+        Returns the number of rows recomputed, merged and unchanged.
+        """
+        store_hashes = list(store_hashes) if store_hashes is not None else None
+        with file_lock(self.lock_path):
+            # Another process may have updated the table since it was loaded
+            self.load()
+            stats = self._update(list(ids), matrix, k, memory_mb, full, store_hashes, version)
+            self._remove_stale()
+            return stats
+
+    def _update(self, ids, matrix, k, memory_mb, full, store_hashes, version):
+        hashes = [embedding_hash(row) for row in matrix] if ids else []
+        old_positions = self._positions
+        changed = np.array([pid not in old_positions or self.hashes[old_positions[pid]] != h for pid, h in zip(ids, hashes)], dtype=bool)
+        stats = {"recomputed": len(ids), "merged": 0, "unchanged": 0}
+
+        if full or k != self.k or not old_positions:
+            neighbours, scores = blocked_top_k(matrix, k, memory_mb=memory_mb)
+        else:
+            # Old neighbour lists with the positions of the new ids (-1: removed or changed patient)
+            remap = np.full(len(self.ids) + 1, -1, dtype=np.int64)
+            new_positions = {pid: i for i, pid in enumerate(ids)}
+            for old, pid in enumerate(self.ids):
+                if pid in new_positions and not changed[new_positions[pid]]:
+                    remap[old] = new_positions[pid]
+            kept = [old_positions.get(pid, -1) for pid in ids]
+            neighbours = remap[np.asarray(self.neighbours)[kept]]
+            old_valid = np.asarray(self.neighbours)[kept] >= 0
+            scores = np.full(neighbours.shape, -np.inf, dtype=np.float32)
+
+            recompute = changed | ((neighbours < 0) & old_valid).any(axis=1)
+            rows = np.flatnonzero(recompute)
+            merge = np.flatnonzero(~recompute)
+            changed_rows = np.flatnonzero(changed)
+            same_store = store_hashes == self.store_hashes and version == self.version
+            if not len(rows) and not len(changed_rows) and len(ids) == len(self.ids) and same_store:
+                return {"recomputed": 0, "merged": 0, "unchanged": len(ids)}
+            if len(rows):
+                neighbours[rows], scores[rows] = blocked_top_k(matrix, k, rows, memory_mb=memory_mb)
+            if len(merge):
+                # The stored scores are float16: the kept neighbours are scored again in float32
+                scores[merge] = pair_scores(matrix, merge, neighbours[merge], memory_mb)
+            if len(merge) and len(changed_rows):
+                new_neighbours, new_scores = blocked_top_k(matrix, k, merge, changed_rows, memory_mb=memory_mb)
+                neighbours[merge], scores[merge] = _merge_top_k(neighbours[merge], scores[merge], new_neighbours, new_scores, k)
+            stats = {
+                "recomputed": len(rows),
+                "merged": len(merge) if len(changed_rows) else 0,
+                "unchanged": 0 if len(changed_rows) else len(merge),
+            }
+
+        self._write(ids, hashes, k, neighbours, scores, store_hashes, version)
+        return stats
+
+    def _write(self, ids, hashes, k, neighbours, scores, store_hashes, version):
+        # New matrix files for every version (readers may have the old ones mapped);
+        # table.json is replaced atomically and the old files are only deleted by _remove_stale()
+        os.makedirs(self.folder, exist_ok=True)
+        file_version = uuid.uuid4().hex
+        files = {"neighbours": f"neighbours-{file_version}.npy", "scores": f"scores-{file_version}.npy"}
+        np.save(os.path.join(self.folder, files["neighbours"]), neighbours.astype(np.int32))
+        np.save(os.path.join(self.folder, files["scores"]), np.where(np.isneginf(scores), 0, scores).astype(np.float16))
+
+        previous = self._read_table() or {}
+        stale = previous.get("stale", []) + [previous[name] for name in files if previous.get(name)]
+        self._write_table({"k": k, "ids": ids, "hashes": hashes, "store_hashes": store_hashes, "version": version,
+                           **files, "stale": stale})
+        self.load()
+
+    def _remove_stale(self):
+        # Deletes the replaced matrix files that nobody maps any more; the others are retried next time
+        table = self._read_table()
+        if not table or not table.get("stale"):
+            return
+        kept = remove_files([os.path.join(self.folder, file) for file in table["stale"]])
+        table["stale"] = [os.path.basename(path) for path in kept]
+        self._write_table(table)
+
+
+def main():
+    from similarity.embedding_store import EmbeddingStore
+
+    parser = argparse.ArgumentParser(description="Computes the top-k neighbours of every patient from the stored embeddings.")
+    parser.add_argument("--model", default="xlm-roberta-base")
+    parser.add_argument("--backend", default="torch", help="EmbeddingIndexer backend of the stored embeddings (default: torch)")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per patient (default: 10)")
+    parser.add_argument("--memory-mb", type=int, default=512, help="Memory cap of the score blocks in MB (default: 512)")
+    parser.add_argument("--full", action="store_true", help="Recompute every row (default: only the rows that can have changed)")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(model_name=args.model, backend=args.backend)
+    if not len(store):
+        print("No hi ha embeddings calculats: executeu primer python -m similarity.main o similarity.sharded_embedding.")
+        return
+    table = NeighbourTable()
+    stats = table.update(store.ids, store.matrix, args.k, args.memory_mb, args.full,
+                         store.hashes, [store.model_name, store.backend])
+    print(f"Taula de veïns: {stats['recomputed']} files recalculades, {stats['merged']} combinades, "
+          f"{stats['unchanged']} sense canvis")
+
+
+if __name__ == "__main__":
+    main()
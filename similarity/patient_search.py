@@ -1,19 +1,298 @@
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
 
-def find_most_similar_patient(query_id, patient_embeddings):
+# Rows of a float16 matrix converted to float32 at a time when scoring
+SCORE_BLOCK_ROWS = 8192
+
+# Above this fraction of the patients, a candidate search scores every row and keeps the candidates
+CANDIDATE_GATHER_FRACTION = 0.2
+
+
+class PatientSearchIndex:
+    """
+    All patient embeddings as one contiguous matrix of L2-normalized rows, with the patient
+    ids in a parallel array. The cosine similarity of a query with every patient is then a
+    single matrix-vector product.
+    """
+
+    def __init__(self, patient_embeddings, dtype=None):
+        """
+        patient_embeddings: dict {id_paciente: embedding (np.array)}
+        dtype: type of the stored matrix (np.float16 halves its memory; scores are still float32)
+        """
+        ids = list(patient_embeddings)
+        if ids:
+            matrix = np.vstack([np.ravel(emb) for emb in patient_embeddings.values()])
+        else:
+            matrix = np.empty((0, 0))
+        self._build(ids, matrix, dtype)
+
+    @classmethod
+    def from_matrix(cls, ids, matrix, dtype=None):
+        """
+        Builds the index from a list of ids and the matrix of their embeddings (one row each),
+        e.g. the memory-mapped matrix of an EmbeddingStore, without a dict of per-patient arrays.
+        """
+        index = cls.__new__(cls)
+        index._build(list(ids), matrix if len(ids) else np.empty((0, 0)), dtype)
+        return index
+
+    def _build(self, ids, matrix, dtype):
+        self.ids = ids
+        self._positions = {pid: i for i, pid in enumerate(self.ids)}
+        # Normalized block by block straight into the stored type, so no float32 copy of the
+        # whole matrix is made on the way to a float16 index
+        self.matrix = np.empty(matrix.shape, dtype=dtype or np.result_type(matrix, np.float32))
+        for start in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            self.matrix[start:start + SCORE_BLOCK_ROWS] = self._normalize(matrix[start:start + SCORE_BLOCK_ROWS])
+
+    @staticmethod
+    def _normalize(vectors):
+        # Same as sklearn's normalize: rows with norm 0 are left as zeros
+        vectors = np.asarray(vectors, dtype=np.result_type(vectors, np.float32))
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def _scores(self, queries):
+        """
+        Cosine similarity of one query (1-D) or several (2-D, one row each) with every patient.
+        A float16 matrix is multiplied in float32 blocks (NumPy has no float16 BLAS).
+        """
+        if self.matrix.dtype != np.float16:
+            return self.matrix @ queries if queries.ndim == 1 else queries @ self.matrix.T
+        queries = queries.astype(np.float32)
+        blocks = [queries @ self.matrix[start:start + SCORE_BLOCK_ROWS].astype(np.float32).T
+                  for start in range(0, len(self.matrix), SCORE_BLOCK_ROWS)]
+        return np.concatenate(blocks, axis=-1) if blocks else np.empty(queries.shape[:-1] + (0,), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pid):
+        return pid in self._positions
+
+    def positions_of(self, patient_ids):
+        """
+        Sorted positions of the indexed patients among patient_ids (e.g. to build candidates).
+        """
+        return np.sort(np.array([self._positions[pid] for pid in patient_ids if pid in self._positions], dtype=np.int64))
+
+    def _top_k(self, scores, k, exclude=None, rows=None):
+        # Best k positions by score; ties keep the order of the ids (as the old loop did)
+        # rows: sorted positions of the scored patients, when only some candidates were scored
+        if exclude is not None:
+            scores = scores.copy()
+            scores[exclude] = -np.inf
+        k = min(k, len(scores) - (exclude is not None))
+        if k <= 0:
+            return []
+        if k < len(scores):
+            # Every candidate that could be among the best k (including ties with the k-th)
+            kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+            candidates = np.flatnonzero(scores >= kth)
+        else:
+            candidates = np.arange(len(scores))
+        best = candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+        if rows is not None:
+            return [(self.ids[rows[i]], float(scores[i])) for i in best]
+        return [(self.ids[i], float(scores[i])) for i in best]
+
+    def _search_rows(self, rows, query, k, exclude=None):
+        # Scores only the candidate rows, so a selective filter makes the search cheaper
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) > CANDIDATE_GATHER_FRACTION * len(self.ids):
+            # Copying most of the matrix costs more than scoring all of it
+            scores = self._scores(query if self.matrix.dtype == np.float16 else query.astype(self.matrix.dtype))[rows]
+        else:
+            matrix = self.matrix[rows]
+            if matrix.dtype == np.float16:
+                matrix = matrix.astype(np.float32)
+            scores = matrix @ query.astype(matrix.dtype)
+        if exclude is not None:
+            i = np.searchsorted(rows, exclude)
+            exclude = i if i < len(rows) and rows[i] == exclude else None
+        return self._top_k(scores, k, exclude, rows)
+
+    def search_vector(self, embedding, k=5, exclude_id=None, candidates=None):
+        """
+        Returns the k patients most similar to an embedding as [(id_paciente, cosine similarity)].
+        candidates: sorted positions to search among (e.g. from a PatientAttributeIndex filter).
+        """
+        query = self._normalize(np.ravel(embedding))
+        if candidates is not None:
+            return self._search_rows(candidates, query, k, self._positions.get(exclude_id))
+        scores = self._scores(query if self.matrix.dtype == np.float16 else query.astype(self.matrix.dtype))
+        return self._top_k(scores, k, self._positions.get(exclude_id))
+
+    def search(self, query_id, k=5, exclude_self=True, candidates=None):
+        """
+        Returns the k patients most similar to an indexed patient (the patient itself excluded).
+        candidates: sorted positions to search among (e.g. from a PatientAttributeIndex filter).
+        """
+        position = self._positions[query_id]
+        if candidates is not None:
+            return self._search_rows(candidates, self.matrix[position], k, position if exclude_self else None)
+        scores = self._scores(self.matrix[position])
+        return self._top_k(scores, k, position if exclude_self else None)
+
+    def search_batch(self, query_ids, k=5, exclude_self=True):
+        """
+        Searches several indexed patients with one matrix product.
+        Returns {query_id: [(id_paciente, cosine similarity)]}.
+        """
+        positions = [self._positions[pid] for pid in query_ids]
+        scores = self._scores(self.matrix[positions])
+        return {
+            pid: self._top_k(row, k, position if exclude_self else None)
+            for pid, position, row in zip(query_ids, positions, scores)
+        }
+
+
+class PQSearchIndex:
+    """
+    Product-quantized index: every normalized embedding is split in `m` sub-vectors and each
+    sub-vector is stored as the number (1 byte) of its closest centroid of a per-subspace
+    codebook, so a 768-dimensional patient takes m bytes instead of 3072.
+
+    A query is scored with asymmetric distance computation (ADC): the query is not quantized,
+    the products of its sub-vectors with every centroid are computed once (m x n_centroids table)
+    and the score of a patient is the sum of m table lookups. The best `rerank` candidates are
+    then scored again with the full vectors (`full_vectors`, typically the memory-mapped matrix
+    of the EmbeddingStore, so only the candidate rows are read).
+    """
+
+    def __init__(self, patient_embeddings, m=None, n_centroids=256, rerank=100, iterations=10, sample=50000, seed=0):
+        """
+        patient_embeddings: dict {id_paciente: embedding (np.array)}
+        """
+        ids = list(patient_embeddings)
+        matrix = np.vstack([np.ravel(emb) for emb in patient_embeddings.values()]) if ids else np.empty((0, 0))
+        self._build(ids, matrix, m, n_centroids, rerank, iterations, sample, seed)
+
+    @classmethod
+    def from_matrix(cls, ids, matrix, **params):
+        """
+        Builds the index from a list of ids and the matrix of their embeddings. The matrix is
+        kept (not copied) for re-ranking: pass a memory-mapped matrix to keep it on disk.
+        """
+        index = cls.__new__(cls)
+        defaults = {"m": None, "n_centroids": 256, "rerank": 100, "iterations": 10, "sample": 50000, "seed": 0}
+        index._build(list(ids), matrix if len(ids) else np.empty((0, 0)), **{**defaults, **params})
+        return index
+
+    def _build(self, ids, matrix, m, n_centroids, rerank, iterations, sample, seed):
+        self.ids = ids
+        self._positions = {pid: i for i, pid in enumerate(ids)}
+        self.rerank = rerank
+        self.full_vectors = matrix if rerank and len(ids) else None
+        dim = matrix.shape[1] if len(ids) else 0
+        self.m = m or max(dim // 8, 1)
+        if dim % self.m:
+            raise ValueError(f"La mida dels embeddings ({dim}) no és divisible pel nombre de subvectors ({self.m})")
+        self.dsub = dim // self.m
+
+        rng = np.random.default_rng(seed)
+        training = matrix[np.sort(rng.choice(len(ids), min(sample, len(ids)), replace=False))] if len(ids) else matrix
+        training = PatientSearchIndex._normalize(training).astype(np.float32)
+        n_centroids = min(n_centroids, max(len(training), 1))
+        self.codebooks = np.stack([
+            self._train_codebook(training[:, j * self.dsub:(j + 1) * self.dsub], n_centroids, iterations, rng)
+            for j in range(self.m)
+        ]) if len(ids) else np.empty((self.m, 0, self.dsub), dtype=np.float32)
+        self.codes = self._encode(matrix)
+
+    @staticmethod
+    def _train_codebook(vectors, n_centroids, iterations, rng):
+        # k-means of the sub-vectors of one subspace
+        centroids = vectors[rng.choice(len(vectors), n_centroids, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = PQSearchIndex._nearest(vectors, centroids)
+            counts = np.bincount(assignment, minlength=n_centroids)
+            for d in range(vectors.shape[1]):
+                sums = np.bincount(assignment, weights=vectors[:, d], minlength=n_centroids)
+                centroids[counts > 0, d] = sums[counts > 0] / counts[counts > 0]
+        return centroids
+
+    @staticmethod
+    def _nearest(vectors, centroids):
+        # Closest centroid (euclidean) of every vector
+        return np.argmin((centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T, axis=1)
+
+    def _encode(self, matrix):
+        # Codes stored one subspace per row (m x n), so scoring reads each row contiguously
+        codes = np.empty((self.m, len(self.ids)), dtype=np.uint8 if self.codebooks.shape[1] <= 256 else np.uint16)
+        for start in range(0, len(self.ids), SCORE_BLOCK_ROWS):
+            block = PatientSearchIndex._normalize(matrix[start:start + SCORE_BLOCK_ROWS]).astype(np.float32)
+            for j in range(self.m):
+                codes[j, start:start + len(block)] = self._nearest(block[:, j * self.dsub:(j + 1) * self.dsub], self.codebooks[j])
+        return codes
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pid):
+        return pid in self._positions
+
+    @property
+    def nbytes(self):
+        # Memory of the resident part of the index (codes and codebooks)
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def _query_vector(self, position):
+        if self.full_vectors is not None:
+            return np.asarray(self.full_vectors[position], dtype=np.float32)
+        return self.codebooks[np.arange(self.m), self.codes[:, position]].ravel()
+
+    def _adc_scores(self, query):
+        table = np.einsum("jkd,jd->jk", self.codebooks, query.reshape(self.m, self.dsub))
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for j in range(self.m):
+            scores += table[j, self.codes[j]]
+        return scores
+
+    def search_vector(self, embedding, k=5, exclude_id=None):
+        """
+        Returns the k patients most similar to an embedding as [(id_paciente, cosine similarity)].
+        """
+        query = PatientSearchIndex._normalize(np.ravel(embedding)).astype(np.float32)
+        scores = self._adc_scores(query)
+        exclude = self._positions.get(exclude_id)
+        if exclude is not None:
+            scores[exclude] = -np.inf
+        k = min(k, len(scores) - (exclude is not None))
+        if k <= 0:
+            return []
+
+        # ADC shortlist, then exact cosine of the shortlist with the full vectors
+        shortlist = max(k, self.rerank or 0)
+        candidates = np.arange(len(scores)) if shortlist >= len(scores) else np.argpartition(-scores, shortlist - 1)[:shortlist]
+        candidates = np.sort(candidates[scores[candidates] > -np.inf])
+        if self.full_vectors is not None:
+            scores = PatientSearchIndex._normalize(np.asarray(self.full_vectors[candidates])).astype(np.float32) @ query
+        else:
+            scores = scores[candidates]
+        best = np.lexsort((candidates, -scores))[:k]
+        return [(self.ids[candidates[i]], float(scores[i])) for i in best]
+
+    def search(self, query_id, k=5, exclude_self=True):
+        """
+        Returns the k patients most similar to an indexed patient (the patient itself excluded).
+        """
+        query = self._query_vector(self._positions[query_id])
+        return self.search_vector(query, k, query_id if exclude_self else None)
+
+    def search_batch(self, query_ids, k=5, exclude_self=True):
+        return {pid: self.search(pid, k, exclude_self) for pid in query_ids}
+
+
+def find_most_similar_patient(query_id, patient_embeddings, candidates=None):
     """
     Find the most similar patient to the given query_id based on cosine similarity of embeddings.
+    candidates: optional ids of the patients to consider (e.g. the result of an attribute filter).
     """
-    query_emb = patient_embeddings[query_id].reshape(1, -1)
-    best_id = None
-    best_score = -1
-
-    for pid, emb in patient_embeddings.items():
-        if pid == query_id:
-            continue
-        score = cosine_similarity(query_emb, emb.reshape(1, -1))[0][0]
-        if score > best_score:
-            best_score = score
-            best_id = pid
-
-    return best_id, best_score
\ No newline at end of file
+    index = patient_embeddings if isinstance(patient_embeddings, PatientSearchIndex) else PatientSearchIndex(patient_embeddings)
+    rows = index.positions_of(candidates) if candidates is not None else None
+    best = index.search(query_id, k=1, candidates=rows)
+    if not best:
+        return None, -1
+    return best[0]
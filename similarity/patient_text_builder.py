@@ -1,90 +1,115 @@
+import numpy as np
 import pandas as pd
 
-def build_patient_texts(pacientes_df, episodios_df, movimientos_df, diagnosticos_df, textos_df):
+from data_io import DATA_FOLDER, TABLE_NAMES, flag_mask, read_patient_tables
+
+# Columns of the preprocessed tables used to build the patient texts
+PATIENT_TEXT_COLUMNS = {
+    "Pacientes": ["id_paciente", "fecha_nacimiento", "sexo", "nacionalidad"],
+    "Episodios": ["id_episodio", "id_paciente", "tipo_episodio"],
+    "Movimientos": ["id_episodio", "servicio_medico", "unidad_tratamiento"],
+    "Diagnosticos": ["id_episodio", "diagnostico", "indica_diag_principal", "indica_motivo_consulta"],
+    "Textos": ["id_paciente", "texto_clinico"],
+}
+
+def safe_str(val):
+    if pd.isna(val):
+        return ""
+    return str(val)
+
+def _age(fecha_nacimiento, now):
+    # Age in years as text, as in the original per-patient loop ("No disponible" if the date cannot be parsed)
+    try:
+        return (now - pd.to_datetime(fecha_nacimiento)).days // 365
+    except:
+        return "No disponible"
+
+def _as_text(values):
+    # safe_str of every value, as an object array (categories are converted only once)
+    text = values.astype(str).to_numpy(dtype=object)
+    text[values.isna().to_numpy()] = ""
+    return text
+
+def _grouped(ids, values):
     """
-    Returns a dictionary with patient IDs as keys and concatenated clinical texts as values.
+    Returns {id_paciente: list of values}, keeping the table order inside each patient.
+    """
+    codes, keys = pd.factorize(ids)
+    order = np.argsort(codes, kind="stable")
+    values = values[order][codes[order] >= 0]
+    counts = np.bincount(codes[codes >= 0], minlength=len(keys))
+    return {key: group.tolist() for key, group in zip(keys, np.split(values, np.cumsum(counts)[:-1]))}
+
+def _unique_per_patient(df, column):
     """
+    df: rows with an 'id_paciente' column, in table order.
+    Returns {id_paciente: [values of `column` as text]}, unique values in order of appearance
+    (the same as Series.unique() on the rows of each patient).
+    """
+    unique_rows = df[["id_paciente", column]].drop_duplicates()
+    return _grouped(unique_rows["id_paciente"], _as_text(unique_rows[column]))
+
+def _with_patient(df, episodios_df):
+    # Rows of a per-episode table with the id_paciente of their episode, in table order
+    pairs = episodios_df[["id_episodio", "id_paciente"]].drop_duplicates()
+    rows = df.reset_index(drop=True)
+    rows["_row"] = range(len(rows))
+    return rows.merge(pairs, on="id_episodio").sort_values("_row", kind="stable")
+
+def _labelled(label, values):
+    return label + ", ".join(values) + ". " if values else ""
+
+def _build_patient_texts(pacientes_df, episodios_df, movimientos_df, diagnosticos_df, textos_df):
     from datetime import datetime
 
-    # Auxiliar function
-    def safe_str(val):
-        if pd.isna(val):
-            return ""
-        return str(val)
+    now = datetime.now()
+
+    # Demographic information (first row of each patient); the age is computed once per distinct date
+    pacientes = pacientes_df.drop_duplicates("id_paciente").set_index("id_paciente")
+    codes, fechas = pd.factorize(pacientes["fecha_nacimiento"], use_na_sentinel=False)
+    edades = [_age(fecha, now) for fecha in fechas]
+    info_basica = {
+        id_paciente: (
+            f"Informació demogràfica: "
+            f"Edat {edades[code]} años, "
+            f"Sexe {safe_str(sexo)}, "
+            f"Nacionalitat {safe_str(nacionalidad)}. "
+        )
+        for id_paciente, code, sexo, nacionalidad in zip(pacientes.index, codes, pacientes["sexo"], pacientes["nacionalidad"])
+    }
+
+    # Diagnostics, by kind
+    diags = _with_patient(diagnosticos_df, episodios_df)
+    principal = flag_mask(diags["indica_diag_principal"])
+    motivo = flag_mask(diags["indica_motivo_consulta"])
+    diags_principales = _unique_per_patient(diags[principal], "diagnostico")
+    motivos = _unique_per_patient(diags[motivo], "diagnostico")
+    otros_diags = _unique_per_patient(diags[~principal & ~motivo], "diagnostico")
+
+    # Episode types, services and units
+    tipos_episodio = _unique_per_patient(episodios_df, "tipo_episodio")
+    movs = _with_patient(movimientos_df, episodios_df)
+    servicios = _unique_per_patient(movs, "servicio_medico")
+    unidades = _unique_per_patient(movs, "unidad_tratamiento")
+
+    # Clinical texts, concatenated in table order
+    textos = textos_df[textos_df["texto_clinico"].notna()]
+    textos = {id_paciente: " ".join(texts) for id_paciente, texts in _grouped(textos["id_paciente"], _as_text(textos["texto_clinico"])).items()}
 
     patient_texts = {}
-
-    # Get unique patient IDs from the clinical texts
-    unique_patients = textos_df['id_paciente'].unique()
-
-    for id_paciente in unique_patients:
-        # Demographic information
-        paciente_info = pacientes_df[pacientes_df['id_paciente'] == id_paciente]
-        if not paciente_info.empty:
-            paciente = paciente_info.iloc[0]
-            # Calculate age
-            try:
-                fecha_nac = pd.to_datetime(paciente['fecha_nacimiento'])
-                edad = (datetime.now() - fecha_nac).days // 365
-            except:
-                edad = "No disponible"
-
-            info_basica = (
-                f"Informació demogràfica: "
-                f"Edat {edad} años, "
-                f"Sexe {safe_str(paciente['sexo'])}, "
-                f"Nacionalitat {safe_str(paciente['nacionalidad'])}. "
-            )
-        else:
-            info_basica = ""
-
-        # Diagnostics
-        diags_df = diagnosticos_df[diagnosticos_df['id_episodio'].isin(
-            episodios_df[episodios_df['id_paciente'] == id_paciente]['id_episodio']
-        )]
-        diags_principales = [safe_str(d) for d in diags_df[diags_df['indica_diag_principal'] == "Si"]['diagnostico'].unique()]
-        diags_principales_str = "Diagnostics principals: " + ", ".join(diags_principales) + ". " if diags_principales else ""
-        motivos = [safe_str(d) for d in diags_df[diags_df['indica_motivo_consulta'] == "Si"]['diagnostico'].unique()]
-        motivos_str = "Motius de consulta: " + ", ".join(motivos) + ". " if motivos else ""
-
-        # Other diagnostics
-        otros_diags = [safe_str(d) for d in diags_df[
-            (diags_df['indica_diag_principal'] != "Si") &
-            (diags_df['indica_motivo_consulta'] != "Si")
-        ]['diagnostico'].unique()]
-        otros_diags_str = "Altres diagnostics: " + ", ".join(otros_diags) + ". " if otros_diags else ""
-
-        # Episodes
-        episodios_paciente = episodios_df[episodios_df['id_paciente'] == id_paciente]
-
-        # Episode types
-        tipos_episodio = [safe_str(t) for t in episodios_paciente['tipo_episodio'].unique()]
-        tipos_str = "Tipos de episodio: " + ", ".join(tipos_episodio) + ". " if tipos_episodio else ""
-
-        # Movements and services
-        movs_paciente = movimientos_df[
-            movimientos_df['id_episodio'].isin(episodios_paciente['id_episodio'])
-        ]
-        servicios = [safe_str(s) for s in movs_paciente['servicio_medico'].unique()]
-        unidades = [safe_str(u) for u in movs_paciente['unidad_tratamiento'].unique()]
-
-        servicios_str = "Serveis mèdics: " + ", ".join(servicios) + ". " if servicios else ""
-        unidades_str = "Unitats de tractament: " + ", ".join(unidades) + ". " if unidades else ""
-
-        # Clinical texts
-        textos_paciente = textos_df[textos_df['id_paciente'] == id_paciente]
-        textos_str = " ".join(safe_str(t) for t in textos_paciente['texto_clinico'] if pd.notnull(t))
+    for id_paciente in textos_df["id_paciente"].dropna().unique():
+        textos_str = textos.get(id_paciente, "")
         textos_str = "Textos clínics: " + textos_str if textos_str.strip() else ""
 
         # Concatenate all information
         texto_completo = (
-            f"{info_basica} "
-            f"{diags_principales_str} "
-            f"{motivos_str} "
-            f"{otros_diags_str} "
-            f"{tipos_str} "
-            f"{servicios_str} "
-            f"{unidades_str} "
+            f"{info_basica.get(id_paciente, '')} "
+            f"{_labelled('Diagnostics principals: ', diags_principales.get(id_paciente))} "
+            f"{_labelled('Motius de consulta: ', motivos.get(id_paciente))} "
+            f"{_labelled('Altres diagnostics: ', otros_diags.get(id_paciente))} "
+            f"{_labelled('Tipos de episodio: ', tipos_episodio.get(id_paciente))} "
+            f"{_labelled('Serveis mèdics: ', servicios.get(id_paciente))} "
+            f"{_labelled('Unitats de tractament: ', unidades.get(id_paciente))} "
             f"{textos_str}"
         ).strip()
 
@@ -92,4 +117,47 @@ def build_patient_texts(pacientes_df, episodios_df, movimientos_df, diagnosticos
         if texto_completo:
             patient_texts[str(id_paciente)] = texto_completo
 
-    return patient_texts
\ No newline at end of file
+    return patient_texts
+
+def _patient_chunk(tables, patient_ids):
+    # Rows of the five tables that belong to a group of patients
+    pacientes_df, episodios_df, movimientos_df, diagnosticos_df, textos_df = tables
+    episodios = episodios_df[episodios_df["id_paciente"].isin(patient_ids)]
+    return (
+        pacientes_df[pacientes_df["id_paciente"].isin(patient_ids)],
+        episodios,
+        movimientos_df[movimientos_df["id_episodio"].isin(episodios["id_episodio"])],
+        diagnosticos_df[diagnosticos_df["id_episodio"].isin(episodios["id_episodio"])],
+        textos_df[textos_df["id_paciente"].isin(patient_ids)],
+    )
+
+def build_patient_texts(pacientes_df, episodios_df, movimientos_df, diagnosticos_df, textos_df, n_jobs=1, chunk_size=50000):
+    """
+    Returns a dictionary with patient IDs as keys and concatenated clinical texts as values.
+
+    The tables are aggregated per patient with groupby / merge operations, in one pass.
+    With n_jobs > 1 the patients are split in chunks of `chunk_size` that are built in
+    parallel processes; the result (and its order) is the same.
+    """
+    tables = (pacientes_df, episodios_df, movimientos_df, diagnosticos_df, textos_df)
+    patients = textos_df["id_paciente"].dropna().unique()
+    if n_jobs <= 1 or len(patients) <= chunk_size:
+        return _build_patient_texts(*tables)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunks = [_patient_chunk(tables, patients[start:start + chunk_size]) for start in range(0, len(patients), chunk_size)]
+    patient_texts = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        for texts in executor.map(_build_patient_texts, *zip(*chunks)):
+            patient_texts.update(texts)
+    return patient_texts
+
+def build_patient_text(id_paciente, folder=DATA_FOLDER):
+    """
+    Lazy mode of build_patient_texts: reads only the rows of one patient and returns their text
+    ("" if the patient has no clinical texts).
+    """
+    tables = read_patient_tables(id_paciente, folder, PATIENT_TEXT_COLUMNS)
+    patient_texts = build_patient_texts(*(tables[name] for name in TABLE_NAMES))
+    return patient_texts.get(str(id_paciente), "")
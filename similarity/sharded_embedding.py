@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+from similarity.embedding_store import EMBEDDINGS_FOLDER, text_hash
+from similarity.file_lock import file_lock, tmp_path
+
+JOBS_FOLDER = os.path.join(EMBEDDINGS_FOLDER, "jobs")
+
+
+def shard_of(pid, n_shards):
+    # Stable shard of a patient (the same in every process and node)
+    return zlib.crc32(str(pid).encode("utf-8")) % n_shards
+
+
+def _default_indexer(model_name, indexer_options):
+    from similarity.embedding_indexer import EmbeddingIndexer
+    return EmbeddingIndexer(model_name, **indexer_options)
+
+
+# Model of each worker process, loaded once by _init_worker
+_worker_indexer = None
+
+
+def _init_worker(make_indexer):
+    global _worker_indexer
+    _worker_indexer = make_indexer()
+
+
+def _shard_name(folder, shard):
+    return os.path.join(folder, f"shard-{shard:05d}")
+
+
+def _write_shard(folder, shard, embeddings):
+    # Matrix first, then the id list: a shard is complete when its .json exists
+    name = _shard_name(folder, shard)
+    ids = list(embeddings)
+    matrix = np.vstack([embeddings[pid] for pid in ids]) if ids else np.empty((0, 0), dtype=np.float32)
+    path = tmp_path(name + ".npy")
+    with open(path, "wb") as f:
+        np.save(f, matrix)
+    os.replace(path, name + ".npy")
+    path = tmp_path(name + ".json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    os.replace(path, name + ".json")
+
+
+def _embed_shard(folder, shard, texts):
+    # The shard is claimed with its lock file: a shard that another process (or node) is
+    # embedding, or that is already complete, is skipped. Returns None when skipped.
+    name = _shard_name(folder, shard)
+    with file_lock(name + ".lock", blocking=False) as claimed:
+        if not claimed or os.path.exists(name + ".json"):
+            return None
+        _write_shard(folder, shard, dict(_worker_indexer.iter_embeddings(texts)))
+        return shard
+
+
+class ShardedEmbeddingJob:
+    """
+    Embeds a set of patient texts split in `n_shards` shards, on a pool of `workers` processes
+    with one model each (and `threads` intra-op threads per model).
+
+    Every shard is written to the job folder as shard-NNNNN.npy / shard-NNNNN.json when it is
+    finished. The shard plan (ids and text hashes) is stored in plan.json, so:
+      - a job that crashed is resumed by running it again: completed shards are skipped;
+      - several nodes that share the folder can run the same job with node_index / n_nodes,
+        each one taking the shards with shard % n_nodes == node_index.
+    A process holds shard-NNNNN.lock while it embeds a shard, so no shard is embedded twice at
+    the same time.
+
+    iter_embeddings() runs the pending shards, waits for the ones other processes are still
+    embedding and yields the merged embeddings, so the job can be passed to
+    EmbeddingStore.refresh() in place of an EmbeddingIndexer.
+    """
+
+    def __init__(self, folder=JOBS_FOLDER, model_name="xlm-roberta-base", n_shards=64, workers=None, threads=None,
+                 indexer_options=None, make_indexer=None):
+        self.model_name = model_name
+        self.n_shards = n_shards
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads or max((os.cpu_count() or 1) // self.workers, 1)
+        options = {"num_threads": self.threads, **(indexer_options or {})}
+        self.backend = options.get("backend", "torch")
+        self.make_indexer = make_indexer or partial(_default_indexer, model_name, options)
+        self.base_folder = folder
+        self.folder = None
+
+    def _plan(self, patient_texts):
+        """
+        Creates (or reuses) the job folder of these texts and returns {shard: [ids]}.
+        The folder name is a hash of the model, the backend, the shard count and the texts, so
+        every node that builds the same texts finds the same job.
+        """
+        ids = sorted(patient_texts)
+        digest = hashlib.sha256(json.dumps([self.model_name, self.backend, self.n_shards,
+                                            [(pid, text_hash(patient_texts[pid])) for pid in ids]]).encode("utf-8"))
+        self.folder = os.path.join(self.base_folder, digest.hexdigest()[:16])
+        os.makedirs(self.folder, exist_ok=True)
+
+        shards = {}
+        for pid in ids:
+            shards.setdefault(shard_of(pid, self.n_shards), []).append(pid)
+        plan_path = os.path.join(self.folder, "plan.json")
+        if not os.path.exists(plan_path):
+            path = tmp_path(plan_path)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"model": self.model_name, "backend": self.backend, "n_shards": self.n_shards, "shards": shards}, f)
+            os.replace(path, plan_path)
+        return shards
+
+    def completed_shards(self):
+        return {
+            int(file[len("shard-"):-len(".json")]) for file in os.listdir(self.folder)
+            if file.startswith("shard-") and file.endswith(".json")
+        }
+
+    def run(self, patient_texts, node_index=0, n_nodes=1, wait=False):
+        """
+        Embeds the pending shards of this node that no other process is embedding.
+        wait: then waits until every pending shard is complete; the shards that another process
+        claimed but did not finish (e.g. it crashed) are embedded here.
+        Returns the number of shards embedded by this process.
+        """
+        shards = self._plan(patient_texts)
+        done = self.completed_shards()
+        pending = [shard for shard in sorted(shards) if shard % n_nodes == node_index and shard not in done]
+        if done:
+            print(f"Reprenent la feina: {len(done)} de {len(shards)} fragments ja calculats.")
+
+        embedded = self._embed(patient_texts, shards, pending)
+        while wait:
+            left = [shard for shard in pending if shard not in self.completed_shards()]
+            if not left:
+                break
+            print(f"Esperant {len(left)} fragments que calculen altres processos...")
+            for shard in left:
+                with file_lock(_shard_name(self.folder, shard) + ".lock"):
+                    pass
+            embedded += self._embed(patient_texts, shards, [shard for shard in left if shard not in self.completed_shards()])
+        return embedded
+
+    def _embed(self, patient_texts, shards, pending):
+        if not pending:
+            return 0
+        tasks = [(shard, {pid: patient_texts[pid] for pid in shards[shard]}) for shard in pending]
+        if self.workers == 1:
+            _init_worker(self.make_indexer)
+            return sum(_embed_shard(self.folder, shard, texts) is not None for shard, texts in tasks)
+
+        # "spawn": the model libraries do not support being forked once their threads are running
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(self.make_indexer,)) as executor:
+            futures = [executor.submit(_embed_shard, self.folder, shard, texts) for shard, texts in tasks]
+            embedded = 0
+            for finished, future in enumerate(futures, 1):
+                embedded += future.result() is not None
+                print(f"Fragments calculats: {finished}/{len(tasks)}")
+        return embedded
+
+    def merged(self):
+        """
+        Yields (id_paciente, embedding) from the completed shard files, in shard order.
+        """
+        for shard in sorted(self.completed_shards()):
+            name = _shard_name(self.folder, shard)
+            with open(name + ".json", "r", encoding="utf-8") as f:
+                ids = json.load(f)
+            if ids:
+                matrix = np.load(name + ".npy", mmap_mode="r")
+                for pid, emb in zip(ids, matrix):
+                    yield pid, np.array(emb)
+
+    def iter_embeddings(self, patient_texts):
+        self.run(patient_texts, wait=True)
+        yield from self.merged()
+
+    def clear(self):
+        # Removes the shard files of the job (once they are merged into the EmbeddingStore)
+        if self.folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def main():
+    from data_io import TABLE_NAMES, read_tables
+    from similarity.embedding_store import EmbeddingStore
+    from similarity.patient_text_builder import PATIENT_TEXT_COLUMNS, build_patient_texts
+
+    parser = argparse.ArgumentParser(description="Sharded multi-process embedding of the patient texts.")
+    parser.add_argument("--model", default="xlm-roberta-base")
+    parser.add_argument("--shards", type=int, default=64, help="Number of shards (default: 64)")
+    parser.add_argument("--workers", type=int, help="Worker processes of this node (default: one per CPU)")
+    parser.add_argument("--threads", type=int, help="Intra-op threads per worker (default: CPUs / workers)")
+    parser.add_argument("--backend", default="torch", help="EmbeddingIndexer backend (default: torch)")
+    parser.add_argument("--node-index", type=int, default=0, help="Index of this node (default: 0)")
+    parser.add_argument("--nodes", type=int, default=1, help="Nodes sharing the job folder (default: 1)")
+    parser.add_argument("--no-merge", action="store_true",
+                        help="Only embed the shards of this node; the merge is done by a later run without this flag")
+    args = parser.parse_args()
+
+    tables = read_tables(columns=PATIENT_TEXT_COLUMNS)
+    patient_texts = build_patient_texts(*(tables[name] for name in TABLE_NAMES))
+    store = EmbeddingStore(model_name=args.model, backend=args.backend)
+    changed = store.changed_texts(patient_texts)
+    print(f"{len(changed)} textos nous o modificats de {len(patient_texts)} pacients.")
+
+    job = ShardedEmbeddingJob(model_name=args.model, n_shards=args.shards, workers=args.workers, threads=args.threads,
+                              indexer_options={"backend": args.backend})
+    if changed:
+        job.run(changed, args.node_index, args.nodes)
+    if args.no_merge:
+        return
+
+    # Waits for the shards other nodes are embedding (and embeds the ones nobody claimed),
+    # then everything is merged into the store
+    stats = store.refresh(patient_texts, lambda: job)
+    job.clear()
+    print(f"Embeddings: {stats['added']} nous, {stats['updated']} actualitzats, "
+          f"{stats['removed']} eliminats, {stats['unchanged']} sense canvis")
+
+
+if __name__ == "__main__":
+    main()
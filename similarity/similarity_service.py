@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+
+from data_io import TABLE_NAMES
+from similarity.ann_index import update_ann_index
+from similarity.attribute_filter import PatientAttributeIndex
+from similarity.embedding_store import EMBEDDINGS_FOLDER, EmbeddingStore
+from similarity.neighbour_table import NEIGHBOURS_FOLDER, NeighbourTable
+from similarity.patient_search import PatientSearchIndex, PQSearchIndex
+from similarity.patient_text_builder import build_patient_texts
+
+# Above this fraction of the store newer than the neighbour table, the table is not used
+MAX_NEWER_FRACTION = 0.2
+
+
+class _NeighbourLookup:
+    """
+    The rows of a NeighbourTable that still match a version of the EmbeddingStore (the patient
+    and its neighbours were not re-embedded or removed since the table was computed).
+    The store patients that are newer than the table (new or re-embedded) can have entered the
+    top k of those rows, so they are searched exactly at lookup time and merged in.
+    """
+
+    def __init__(self, table, store):
+        self.table = table
+        self.k = table.k
+        self._valid = table.matching_rows(store.ids, store.hashes, [store.model_name, store.backend])
+        table_hashes = dict(zip(table.ids, table.store_hashes or []))
+        newer = [i for i, (pid, h) in enumerate(zip(store.ids, store.hashes)) if table_hashes.get(pid) != h]
+        self._newer = None
+        if len(newer) > MAX_NEWER_FRACTION * len(store.ids):
+            self._valid[:] = False
+        elif newer and self._valid.any():
+            self._newer = PatientSearchIndex.from_matrix([store.ids[i] for i in newer], store.matrix[newer])
+            self._matrix = store.matrix
+            self._rows = {pid: i for i, pid in enumerate(store.ids)}
+
+    def top_k(self, patient_id, k):
+        """
+        Returns the k neighbours of a patient, or None if the table cannot answer for it.
+        """
+        row = self.table.row_of(patient_id)
+        if row is None or not self._valid[row] or k > self.k:
+            return None
+        neighbours = self.table.top_k(patient_id, k)
+        if self._newer is not None:
+            neighbours += self._newer.search_vector(self._matrix[self._rows[patient_id]], k, exclude_id=patient_id)
+            neighbours = sorted(neighbours, key=lambda neighbour: -neighbour[1])[:k]
+        return neighbours
+
+
+class SimilarityService:
+    """
+    Answers "which patients are most similar to this one" from a prebuilt index.
+
+    At startup it memory-maps the stored embeddings (see EmbeddingStore) and builds the
+    search index, without loading the embedding model. A lookup is then one matrix-vector
+    product. refresh() reloads the stored embeddings and swaps in a new index; it can run in a
+    background thread driven by a DatasetCache and by the changes of the store on disk.
+
+    Embedding the texts is the job of the offline command (python -m similarity.main or
+    similarity.sharded_embedding), so the server processes never load the model. With
+    embed=True, refresh() instead rebuilds the patient texts and embeds the new or changed
+    ones in this process (serialized with other processes by the store lock).
+
+    index_backend: "exact" (PatientSearchIndex), "pq" (PQSearchIndex: product-quantized codes in
+    memory, re-ranked with the memory-mapped vectors) or an approximate index of ann_index.py
+    ("auto", "hnsw" or "ivf"); index_params are passed to the index (e.g. {"dtype": "float16"} for "exact").
+    An approximate index is saved in <folder>/ann and only updated with the changes of the store.
+    store_dtype: type of the stored embedding matrix (see EmbeddingStore).
+    neighbours_folder: NeighbourTable precomputed by python -m similarity.neighbour_table; when it
+    has the patient (and at least k neighbours) top_k() is a table lookup instead of a search.
+    Only the rows that match the current store are used; the others fall back to the index.
+    indexer_options: extra EmbeddingIndexer arguments (e.g. {"backend": "onnx", "num_threads": 8}).
+
+    top_k() also accepts attribute filters (see PatientAttributeIndex), e.g.
+    top_k(pid, same_as=["sexo", "age_band"], diagnostico_principal="I10"): the candidates are
+    selected on the attribute indexes first and only their embeddings are scored. The filters
+    are available after the first refresh(), which reads the ATTRIBUTE_COLUMNS of the tables.
+    """
+
+    def __init__(self, folder=EMBEDDINGS_FOLDER, model_name="xlm-roberta-base", index_backend="exact", index_params=None,
+                 indexer_options=None, store_dtype=None, neighbours_folder=NEIGHBOURS_FOLDER, embed=False):
+        self.folder = folder
+        self.model_name = model_name
+        self.embed = embed
+        self.indexer_options = indexer_options or {}
+        self.index_backend = index_backend
+        self.index_params = index_params or {}
+        self._indexer = None
+        self._refresh_lock = threading.Lock()
+        self._watcher = None
+        self._store = EmbeddingStore(folder, model_name, store_dtype, self.indexer_options.get("backend", "torch"))
+        self._index = self._build_index()
+        self._neighbours = _NeighbourLookup(NeighbourTable(neighbours_folder), self._store)
+        # (attribute index, embedding matrix) of the same version of the store; set by refresh()
+        self._attributes = None
+
+    def _build_index(self):
+        store = self._store
+        if self.index_backend == "exact":
+            return PatientSearchIndex.from_matrix(store.ids, store.matrix, **self.index_params)
+        if self.index_backend == "pq":
+            return PQSearchIndex.from_matrix(store.ids, store.matrix, **self.index_params)
+        # The saved approximate index is updated with the changes of the store (no full rebuild)
+        version = [store.model_name, store.backend, str(store.matrix.dtype) if store.matrix is not None else None]
+        index, _ = update_ann_index(os.path.join(self.folder, "ann"), store.ids, store.hashes, store.matrix,
+                                    version, self.index_backend, **self.index_params)
+        return index
+
+    def _make_indexer(self):
+        # The model is only loaded the first time a text has to be embedded
+        if self._indexer is None:
+            from similarity.embedding_indexer import EmbeddingIndexer
+            self._indexer = EmbeddingIndexer(self.model_name, **self.indexer_options)
+        return self._indexer
+
+    def top_k(self, patient_id, k=5, same_as=None, **filters):
+        """
+        Returns the k most similar patients as [(id_paciente, similarity)],
+        or None if the patient has no embedding yet.
+        same_as: attributes that the similar patients must share with this one (e.g. ["sexo", "age_band"]);
+        filters: other predicates of PatientAttributeIndex.candidates() (e.g. edat=(40, 59), area_salud="3").
+        """
+        index = self._index
+        patient_id = str(patient_id)
+        if same_as or filters:
+            return self._filtered_top_k(index, patient_id, k, same_as or [], filters)
+        neighbours = self._neighbours.top_k(patient_id, k)
+        if neighbours is not None:
+            return neighbours
+        if patient_id not in index:
+            return None
+        return index.search(patient_id, k)
+
+    def _filtered_top_k(self, index, patient_id, k, same_as, filters):
+        # Candidates from the attribute indexes, then exact scoring of those candidates only
+        if self._attributes is None:
+            raise RuntimeError("Els filtres per atributs encara no estan disponibles (l'índex no s'ha actualitzat).")
+        attributes, matrix = self._attributes
+        if patient_id not in index or patient_id not in attributes:
+            return None
+        rows = attributes.candidates(**{**attributes.same_as(patient_id, same_as), **filters})
+        if not len(rows):
+            return []
+        candidate_ids = [attributes.ids[row] for row in rows]
+        if isinstance(index, PatientSearchIndex):
+            return index.search(patient_id, k, candidates=index.positions_of(candidate_ids))
+        # Approximate / PQ index: exact search over the stored vectors of the candidates
+        subset = PatientSearchIndex.from_matrix(candidate_ids, matrix[rows])
+        return subset.search_vector(matrix[attributes.row_of(patient_id)], k, exclude_id=patient_id)
+
+    def refresh(self, tables):
+        """
+        tables: dict {table name: DataFrame} with the PATIENT_TEXT_COLUMNS and ATTRIBUTE_COLUMNS of every table.
+        Reloads (or, with embed=True, updates) the stored embeddings and swaps in a new search
+        index and attribute index.
+        Returns the statistics of EmbeddingStore.reload() (or EmbeddingStore.refresh()).
+        """
+        with self._refresh_lock:
+            if self.embed:
+                patient_texts = build_patient_texts(*(tables[name] for name in TABLE_NAMES))
+                stats = self._store.refresh(patient_texts, self._make_indexer, remove_stale=False)
+            else:
+                stats = self._store.reload()
+            if stats["added"] or stats["updated"] or stats["removed"]:
+                self._index = self._build_index()
+            store = self._store
+            self._attributes = (PatientAttributeIndex(store.ids, tables["Pacientes"], tables["Episodios"], tables["Diagnosticos"]), store.matrix)
+            # The neighbour table may have been rewritten by the offline job
+            self._neighbours = _NeighbourLookup(NeighbourTable(self._neighbours.table.folder), store)
+            # The old index (e.g. the full vectors of a PQ index) no longer maps the replaced matrix
+            self._store.remove_stale(blocking=False)
+            return stats
+
+    def start_background_refresh(self, dataset_cache, interval=60):
+        """
+        Every `interval` seconds, refreshes the index in a daemon thread if the
+        DatasetCache loaded a new version of the tables or the stored embeddings (or the
+        neighbour table) changed.
+        """
+        if self._watcher is not None:
+            return
+
+        def watch():
+            last_store = None
+            while True:
+                store = dataset_cache.get()
+                if store is not last_store or self._store.changed_on_disk() or self._neighbours.table.changed_on_disk():
+                    try:
+                        stats = self.refresh(store.tables)
+                        print(f"Índex de similitud actualitzat: {stats}")
+                        last_store = store
+                    except Exception as e:
+                        print(f"Error actualitzant l'índex de similitud: {e}")
+                time.sleep(interval)
+
+        self._watcher = threading.Thread(target=watch, name="similarity-refresh", daemon=True)
+        self._watcher.start()
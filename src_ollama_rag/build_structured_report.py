@@ -2,23 +2,33 @@
 import pandas as pd
 from datetime import datetime
 
+def format_date(value):
+    """
+    Formats a date read from a columnar table (datetime) as in the CSV files (YYYY-MM-DD).
+    Any other value is returned unchanged.
+    """
+    if isinstance(value, datetime) and pd.notna(value):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
 def calculate_age(birth_date_str):
     """
     Calculate the age of a patient based on their birth date.
     """
     try:
-        birth_date = datetime.strptime(birth_date_str, "%Y-%m-%d")
+        birth_date = datetime.strptime(format_date(birth_date_str), "%Y-%m-%d")
         today = datetime.today()
         return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
     except:
         return "Desconeguda"
 
 
-def build_structured_info(id_paciente, pacientes, episodios):
+def build_structured_info(id_paciente, store):
     """
-    Build structured information about a patient and their episodes.
+    Build structured information about a patient and their episodes (from a PatientStore).
     """
-    patient_info = pacientes[pacientes['id_paciente'] == id_paciente].iloc[0]
+    patient_info = store.patient(id_paciente).iloc[0]
 
     sexe = "Home" if str(patient_info['sexo']) == "1" else "Dona"
     edat = calculate_age(patient_info['fecha_nacimiento'])
@@ -27,15 +37,15 @@ def build_structured_info(id_paciente, pacientes, episodios):
     dades_identificatives.append(f"ID pacient: {patient_info.get('id_paciente', 'No disponible')}")
     dades_identificatives.append(f"Edat: {edat}")
     dades_identificatives.append(f"Sexe: {sexe}")
-    dades_identificatives.append(f"Data de naixement: {patient_info.get('fecha_nacimiento', 'No disponible')}")
+    dades_identificatives.append(f"Data de naixement: {format_date(patient_info.get('fecha_nacimiento', 'No disponible'))}")
     if pd.notna(patient_info.get('fecha_fallecimiento')) and patient_info.get('fecha_fallecimiento') != "":
-        dades_identificatives.append(f"Data de defunció: {patient_info['fecha_fallecimiento']}")
+        dades_identificatives.append(f"Data de defunció: {format_date(patient_info['fecha_fallecimiento'])}")
 
     linia_temporal = []
-    patient_episodes = episodios[episodios['id_paciente'] == id_paciente]
+    patient_episodes = store.episodes(id_paciente)
     patient_episodes = patient_episodes.sort_values(by='fecha_inicio_episodio')
     for _, ep in patient_episodes.iterrows():
-        fecha_fin = ep['fecha_fin_episodio'] if pd.notna(ep['fecha_fin_episodio']) and ep['fecha_fin_episodio'] != "" else "en curs"
-        linia_temporal.append(f"- {ep['fecha_inicio_episodio']} -> {fecha_fin} | Tipus: {ep.get('tipo_episodio', 'Desconegut')} | ID Episodi: {ep['id_episodio']}")
+        fecha_fin = format_date(ep['fecha_fin_episodio']) if pd.notna(ep['fecha_fin_episodio']) and ep['fecha_fin_episodio'] != "" else "en curs"
+        linia_temporal.append(f"- {format_date(ep['fecha_inicio_episodio'])} -> {fecha_fin} | Tipus: {ep.get('tipo_episodio', 'Desconegut')} | ID Episodi: {ep['id_episodio']}")
 
     return "\n".join(dades_identificatives), "\n".join(linia_temporal)
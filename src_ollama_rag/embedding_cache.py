@@ -0,0 +1,152 @@
+# embedding_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+# Default location of the cache (rag_processor.EMBEDDING_CACHE_PATH)
+EMBEDDING_CACHE_PATH = os.path.join("dades", "rag_cache", "embeddings.sqlite")
+
+
+class CachedEmbeddingFunction:
+    """
+    Wraps a ChromaDB embedding function with a disk-backed cache of its embeddings.
+
+    Every text is keyed by (model, sha256(text)) in a SQLite file, so a note, a repeated
+    boilerplate text or a retrieval query that was embedded before (in this or an earlier
+    process) is not sent to Ollama again. Only the missing texts are embedded, in one call.
+
+    The cache is bounded to `max_mb` of embeddings: when it grows beyond that, the least
+    recently used entries are evicted. hits / misses count the texts served from the cache
+    and the texts embedded since the wrapper was created (see stats()).
+    """
+
+    def __init__(self, embedding_function, model_name, path=EMBEDDING_CACHE_PATH, max_mb=512):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.path = path
+        self.max_bytes = int(max_mb * 2**20)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # One connection shared by the threads of the process (calls are serialized by _lock);
+        # other processes wait on the SQLite file lock
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, text_hash TEXT NOT NULL, embedding BLOB NOT NULL,"
+            " last_used REAL NOT NULL, PRIMARY KEY (model, text_hash))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._db.commit()
+        # Running estimate of the cache size (bytes of embeddings), kept by _put / _evict so that
+        # the table is only scanned when the estimate goes over max_bytes
+        self._size = self._stored_bytes()
+
+    def _stored_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def __call__(self, input):
+        """
+        Embeddings of a list of texts, in the same order (as the wrapped function).
+        """
+        texts = list(input)
+        keys = [self.text_hash(text) for text in texts]
+        with self._lock:
+            found = self._get(set(keys))
+            missing = {key: text for key, text in zip(keys, texts) if key not in found}
+            n_missing = sum(key in missing for key in keys)
+            self.hits += len(keys) - n_missing
+            self.misses += n_missing
+
+        if missing:
+            embeddings = self.embedding_function(list(missing.values()))
+            computed = {key: np.asarray(embedding, dtype=np.float32) for key, embedding in zip(missing, embeddings)}
+            with self._lock:
+                self._put(computed)
+            found.update(computed)
+        return [found[key].tolist() for key in keys]
+
+    def _get(self, keys):
+        # Cached embeddings of these keys; marks them as used now (LRU)
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._db.execute(
+                f"SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                [self.model_name, *chunk],
+            ).fetchall()
+            found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+        if found:
+            now = time.time()
+            self._db.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                                 [(now, self.model_name, key) for key in found])
+            self._db.commit()
+        return found
+
+    def _put(self, embeddings):
+        now = time.time()
+        rows = [(self.model_name, key, embedding.tobytes(), now) for key, embedding in embeddings.items()]
+        self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+        self._size += sum(len(row[2]) for row in rows)
+        self._evict()
+        self._db.commit()
+
+    def _evict(self):
+        # Removes the least recently used entries (of any model) until the cache fits in max_bytes.
+        # The estimate can be off (replaced entries, other processes): it is checked against the
+        # table before evicting.
+        if self._size <= self.max_bytes:
+            return
+        size = self._size = self._stored_bytes()
+        if size <= self.max_bytes:
+            return
+        excess = size - self.max_bytes
+        evicted = []
+        for model, key, length in self._db.execute(
+                "SELECT model, text_hash, LENGTH(embedding) FROM embeddings ORDER BY last_used"):
+            if excess <= 0:
+                break
+            evicted.append((model, key))
+            excess -= length
+        self._db.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", evicted)
+        self.evictions += len(evicted)
+        self._size = self.max_bytes + excess
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self):
+        """
+        Hit / miss counters of this process and the current size of the cache.
+        """
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings").fetchone()
+            self._size = size
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "mb": round(size / 2**20, 2),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM embeddings")
+            self._db.commit()
+            self._size = 0
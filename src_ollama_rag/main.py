@@ -3,7 +3,8 @@ import time
 import traceback
 from src_ollama_rag.build_structured_report import build_structured_info
 from src_ollama_rag.generate_narrative import generate_summary_with_rag
-from src_ollama_rag.utils import load_datasets, build_clinical_record, extract_free_texts
+from src_ollama_rag.utils import load_patient_store, build_clinical_record, extract_free_texts, REPORT_COLUMNS
+from data_io import parse_id
 from src_ollama_rag.rag_processor import index_patient_texts, retrieve_relevant_chunks, OLLAMA_EMBED_MODEL
 from src_ollama_rag.ollama_runner import is_ollama_running, start_ollama_server
 
@@ -50,35 +51,40 @@ def main():
         print("Invalid patient ID.")
         return
 
-    # Load datasets
+    # Ids are integers in the tables; the text id is only used for files and collections
+    patient_key = parse_id(patient_id)
+    if patient_key is None:
+        print(f"Patient ID '{patient_id}' not found in the dataset.")
+        return
+
+    # Load datasets (only the rows of the patient)
     try:
-        patients, episodes, movements, diagnoses, texts_df = load_datasets()
+        store = load_patient_store(columns=REPORT_COLUMNS, patient_id=patient_key)
     except Exception as e:
         print(f"Error loading datasets: {e}")
         traceback.print_exc()
         return
 
     # Validate patient existence
-    if patient_id not in patients['id_paciente'].values:
+    if not store.has_patient(patient_key):
         print(f"Patient ID '{patient_id}' not found in the dataset.")
         return
 
     # Build structured data
-    structured_data, episode_timeline = build_structured_info(patient_id, patients, episodes)
+    structured_data, episode_timeline = build_structured_info(patient_key, store)
 
     # Build complete clinical record (for indexing)
-    clinical_record_dict = build_clinical_record(patient_id, patients, episodes, movements, diagnoses, texts_df)
+    clinical_record_dict = build_clinical_record(patient_key, store)
     full_clinical_text = extract_free_texts(clinical_record_dict)
 
     # --- RAG STEP: Prepare and index patient texts ---
     record_for_indexing = {'text_entries': []}
 
-    if texts_df is not None and not texts_df.empty:
-        patient_texts_df = texts_df[texts_df['id_paciente'] == patient_id]
-        if not patient_texts_df.empty and 'texto_nota' in patient_texts_df.columns:
-            note_texts = patient_texts_df['texto_nota'].dropna().astype(str).tolist()
-            if note_texts:
-                record_for_indexing['text_entries'] = note_texts
+    patient_texts_df = store.patient_texts(patient_key)
+    if not patient_texts_df.empty and 'texto_nota' in patient_texts_df.columns:
+        note_texts = patient_texts_df['texto_nota'].dropna().astype(str).tolist()
+        if note_texts:
+            record_for_indexing['text_entries'] = note_texts
     
     if not record_for_indexing['text_entries'] and full_clinical_text:
         chunks = split_into_chunks(full_clinical_text)
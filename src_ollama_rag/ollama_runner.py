@@ -1,5 +1,4 @@
 # ollama_runner.py
-import ollama
 import requests
 import subprocess
 import time
@@ -42,6 +41,8 @@ def run_ollama(prompt, model="gemma3:4b", temperature=0.1):
     if not is_ollama_running():
         start_ollama_server()
 
+    import ollama  # Imported on first use: it is only needed to generate text
+
     response = ollama.generate(
         model=model,
         prompt=prompt,
@@ -1,7 +1,8 @@
 # pipeline.py
 from src_ollama_rag.build_structured_report import build_structured_info
 from src_ollama_rag.generate_narrative import generate_summary_with_rag
-from src_ollama_rag.utils import load_datasets, build_clinical_record, extract_free_texts
+from src_ollama_rag.utils import load_patient_store, build_clinical_record, extract_free_texts, REPORT_COLUMNS
+from data_io import parse_id
 from src_ollama_rag.ollama_runner import is_ollama_running, start_ollama_server
 from src_ollama_rag.rag_processor import index_patient_texts, retrieve_relevant_chunks
 from src_ollama_rag.main import split_into_chunks
@@ -9,7 +10,7 @@ import time
 import traceback
 
 
-def run_pipeline(patient_id: str):
+def run_pipeline(patient_id: str, store=None):
     """
     Executes the full clinical summary pipeline for a given patient.
 
@@ -25,6 +26,8 @@ def run_pipeline(patient_id: str):
 
     Args:
         patient_id (str): The unique identifier of the patient.
+        store (PatientStore, optional): Already loaded datasets (e.g. from a DatasetCache).
+            If not given, the datasets are read from disk.
 
     Returns:
         bool | None: Returns True if the report was successfully created,
@@ -44,31 +47,37 @@ def run_pipeline(patient_id: str):
             print(f"Error en engegar Ollama: {e}")
             return
 
-    # --- Load clinical data ---
+    # Ids are integers in the tables; the text id is only used for files and collections
+    patient_key = parse_id(patient_id)
+    if patient_key is None:
+        print(f"ID de pacient '{patient_id}' no trobat.")
+        return False
+
+    # --- Load clinical data (only the rows of the patient, if no store is given) ---
     try:
-        patients, episodes, movements, diagnoses, texts_df = load_datasets()
+        if store is None:
+            store = load_patient_store(columns=REPORT_COLUMNS, patient_id=patient_key)
     except Exception as e:
         print(f"Error carregant datasets: {e}")
         traceback.print_exc()
         return
 
-    if patient_id not in patients['id_paciente'].values:
+    if not store.has_patient(patient_key):
         print(f"ID de pacient '{patient_id}' no trobat.")
         return False
 
     # --- Build structured summary and extract clinical text ---
-    structured_data, episode_timeline = build_structured_info(patient_id, patients, episodes)
-    clinical_record = build_clinical_record(patient_id, patients, episodes, movements, diagnoses, texts_df)
+    structured_data, episode_timeline = build_structured_info(patient_key, store)
+    clinical_record = build_clinical_record(patient_key, store)
     full_text = extract_free_texts(clinical_record)
 
     # --- Prepare record for indexing ---
     record = {'text_entries': []}
-    if texts_df is not None and not texts_df.empty:
-        patient_df = texts_df[texts_df['id_paciente'] == patient_id]
-        if not patient_df.empty and 'texto_nota' in patient_df.columns:
-            notes = patient_df['texto_nota'].dropna().astype(str).tolist()
-            if notes:
-                record['text_entries'] = notes
+    patient_df = store.patient_texts(patient_key)
+    if not patient_df.empty and 'texto_nota' in patient_df.columns:
+        notes = patient_df['texto_nota'].dropna().astype(str).tolist()
+        if notes:
+            record['text_entries'] = notes
 
     if not record['text_entries'] and full_text:
         chunks = split_into_chunks(full_text)
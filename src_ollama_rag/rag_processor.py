@@ -1,55 +1,109 @@
 # rag_processor.py
 # ollama pull bge-m3
 # pip install chromadb
-import ollama
-import chromadb
-from chromadb.utils import embedding_functions
+import hashlib
+import os
+import threading
 import traceback
 
+from data_io import DATA_FOLDER
+from src_ollama_rag.embedding_cache import EMBEDDING_CACHE_PATH
+
 OLLAMA_EMBED_MODEL = "bge-m3"
 
-# --- ChromaDB Client Initialization ---
-try:
-    client = chromadb.Client()
-except Exception as e:
-    print(f"[DEBUG RAG CLIENT] CRITICAL ERROR initializing ChromaDB client: {e}")
-    traceback.print_exc()
-    raise RuntimeError("Failed to initialize ChromaDB") from e
+# Folder of the persistent ChromaDB store (None: in-memory store, lost when the process ends).
+# The patient collections are kept between reports and restarts: a report only embeds the
+# notes that are not in the collection yet. It lives next to the preprocessed tables.
+CHROMA_FOLDER = os.path.join(os.path.dirname(DATA_FOLDER), "chroma")
+
+# The Ollama embeddings are cached on disk at EMBEDDING_CACHE_PATH (None: no cache), shared by
+# indexing and retrieval, with a size cap in MB (least recently used embeddings are evicted first)
+EMBEDDING_CACHE_MB = 512
+
+# --- ChromaDB Client (created on first use, one per process) ---
+# chromadb is only imported when a patient is indexed or queried, so importing this module
+# (e.g. from app.py) does not pay for it.
+_client = None
+_embedding_function = None
+_init_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the process-wide ChromaDB client, creating it the first time.
+    """
+    global _client
+    with _init_lock:
+        if _client is None:
+            try:
+                import chromadb
+                _client = chromadb.PersistentClient(path=CHROMA_FOLDER) if CHROMA_FOLDER else chromadb.Client()
+            except Exception as e:
+                print(f"[DEBUG RAG CLIENT] CRITICAL ERROR initializing ChromaDB client: {e}")
+                traceback.print_exc()
+                raise RuntimeError("Failed to initialize ChromaDB") from e
+    return _client
 
 
 # --- Auxiliar functions ---
 def get_ollama_embedding_function():
     """
-    Creates and returns an OllamaEmbeddingFunction instance.
+    Returns the process-wide OllamaEmbeddingFunction instance (created on first use).
     This function is used to generate embeddings for text data.
+    It is wrapped in a CachedEmbeddingFunction (see embedding_cache.py), so texts embedded
+    before are read from the disk cache instead of being sent to Ollama again.
     """
-    try:
-        ef = embedding_functions.OllamaEmbeddingFunction(
-            url="http://localhost:11434/api/embeddings",
-            model_name=OLLAMA_EMBED_MODEL
-        )
-        return ef
-    except Exception as e_ef:
-        print(f"[DEBUG RAG EF] ERROR creating OllamaEmbeddingFunction: {e_ef}")
-        traceback.print_exc()
-        raise
+    global _embedding_function
+    with _init_lock:
+        if _embedding_function is None:
+            try:
+                from chromadb.utils import embedding_functions
+                _embedding_function = embedding_functions.OllamaEmbeddingFunction(
+                    url="http://localhost:11434/api/embeddings",
+                    model_name=OLLAMA_EMBED_MODEL
+                )
+                if EMBEDDING_CACHE_PATH:
+                    from src_ollama_rag.embedding_cache import CachedEmbeddingFunction
+                    _embedding_function = CachedEmbeddingFunction(_embedding_function, OLLAMA_EMBED_MODEL,
+                                                                  EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MB)
+            except Exception as e_ef:
+                print(f"[DEBUG RAG EF] ERROR creating OllamaEmbeddingFunction: {e_ef}")
+                traceback.print_exc()
+                raise
+    return _embedding_function
+
+def document_id(text: str) -> str:
+    """
+    Content-addressed id of a text entry: the same note always gets the same id,
+    so it is embedded only once per collection.
+    """
+    return "doc_" + hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def entries_hash(text_entries: list) -> str:
+    """
+    Hash of the set of text entries of a patient (and of the embedding model that indexes them).
+    """
+    digest = hashlib.sha256(OLLAMA_EMBED_MODEL.encode("utf-8"))
+    for doc_id in sorted({document_id(text) for text in text_entries}):
+        digest.update(doc_id.encode("utf-8"))
+    return digest.hexdigest()
+
 
 def create_or_get_collection_for_patient(collection_name: str, ef_to_use):
     """
     Creates or retrieves a collection for a specific patient in ChromaDB.
+    An existing collection is kept (with its embeddings): see index_patient_texts(). A collection
+    embedded with another model (see its "embed_model" metadata) is dropped and created again,
+    since its vectors cannot be compared with the ones of OLLAMA_EMBED_MODEL.
     """
+    client = get_client()
     try:
-        client.delete_collection(name=collection_name)
-    except chromadb.errors.NotFoundError: 
-        print(f"The collection '{collection_name}' did not exist and will be created.")
-    except Exception as e_del:
-        print(f"Failed to delete '{collection_name}' (error: {e_del}). Will attempt to create it.")
-
-    try:
-        collection = client.create_collection(name=collection_name, embedding_function=ef_to_use)
-        return collection
-    except chromadb.errors.DuplicateCollectionError: 
-        collection = client.get_collection(name=collection_name, embedding_function=ef_to_use)
+        collection = client.get_or_create_collection(name=collection_name, embedding_function=ef_to_use)
+        if (collection.metadata or {}).get("embed_model") != OLLAMA_EMBED_MODEL and collection.count():
+            print(f"[RAG INDEX] Collection '{collection_name}' was embedded with another model: rebuilding it.")
+            client.delete_collection(name=collection_name)
+            collection = client.create_collection(name=collection_name, embedding_function=ef_to_use)
         return collection
     except Exception as e_create:
         print(f"Critical error creating/getting collection '{collection_name}': {e_create}")
@@ -61,6 +115,10 @@ def index_patient_texts(id_paciente: str, clinical_record: dict):
     """
     Indexes the clinical text entries for a given patient in ChromaDB using Ollama embeddings.
     Raises an error if no text entries are found.
+
+    The collection is reused when its content hash (see entries_hash()) matches the entries;
+    otherwise only the new entries are embedded and upserted, and the entries that are no
+    longer in the record are deleted.
     """
     collection_name = f"pacient_{id_paciente.replace('-', '_')}_ollama_rag_data"
 
@@ -83,21 +141,37 @@ def index_patient_texts(id_paciente: str, clinical_record: dict):
         print("Failed to create or retrieve patient collection. Aborting indexing.")
         return
 
-    # Create metadata and unique IDs for each document
-    metadatas = [{"source": f"clinical_record_{id_paciente}", "doc_idx": i} for i in range(len(text_entries))]
-    ids = [f"doc_{id_paciente}_{i}" for i in range(len(text_entries))]
+    content_hash = entries_hash(text_entries)
+    if (patient_collection.metadata or {}).get("content_hash") == content_hash:
+        print(f"[RAG INDEX] Collection '{collection_name}' is up to date ({patient_collection.count()} documents).")
+        return
+
+    # Content-addressed IDs (repeated notes are stored once) and metadata for each document
+    documents = {}
+    for i, text in enumerate(text_entries):
+        documents.setdefault(document_id(text), (text, {"source": f"clinical_record_{id_paciente}", "doc_idx": i}))
 
     try:
-        patient_collection.add(
-            documents=text_entries,
-            metadatas=metadatas,
-            ids=ids
-        )
+        existing = set(patient_collection.get(include=[])["ids"])
+        new_ids = [doc_id for doc_id in documents if doc_id not in existing]
+        stale_ids = [doc_id for doc_id in existing if doc_id not in documents]
+        if stale_ids:
+            patient_collection.delete(ids=stale_ids)
+        if new_ids:
+            # Only the new documents are sent to the embedding function
+            patient_collection.upsert(
+                documents=[documents[doc_id][0] for doc_id in new_ids],
+                metadatas=[documents[doc_id][1] for doc_id in new_ids],
+                ids=new_ids
+            )
+        patient_collection.modify(metadata={"content_hash": content_hash, "embed_model": OLLAMA_EMBED_MODEL})
+        print(f"[RAG INDEX] '{collection_name}': {len(new_ids)} new, {len(stale_ids)} removed, "
+              f"{len(existing) - len(stale_ids)} reused documents.")
         current_count = patient_collection.count()
         if current_count <= 0:
-            print(f"[WARNING] .add() completed but collection is still empty for '{collection_name}'.")
+            print(f"[WARNING] .upsert() completed but collection is still empty for '{collection_name}'.")
     except Exception as e_add:
-        print(f"[ERROR] Failed during patient_collection.add(): {e_add}")
+        print(f"[ERROR] Failed during patient_collection.upsert(): {e_add}")
         traceback.print_exc()
 
 
@@ -114,11 +188,13 @@ def retrieve_relevant_chunks(patient_id: str, query_text: str, n_results: int =
     Returns:
         list: A list of retrieved document strings.
     """
+    import chromadb
+
     collection_name = f"pacient_{patient_id.replace('-', '_')}_ollama_rag_data"
 
     try:
         embedding_function = get_ollama_embedding_function()
-        collection = client.get_collection(name=collection_name, embedding_function=embedding_function)
+        collection = get_client().get_collection(name=collection_name, embedding_function=embedding_function)
 
         doc_count = collection.count()
         if doc_count == 0:
@@ -133,6 +209,8 @@ def retrieve_relevant_chunks(patient_id: str, query_text: str, n_results: int =
         results = collection.query(query_texts=[query_text], n_results=num_to_retrieve)
         retrieved_docs = results.get("documents", [[]])[0] if results else []
         print(f"[RAG RETRIEVE] Retrieved {len(retrieved_docs)} documents.")
+        if hasattr(embedding_function, "stats"):
+            print(f"[RAG CACHE] {embedding_function.stats()}")
         return retrieved_docs
 
     except chromadb.errors.NotFoundError:
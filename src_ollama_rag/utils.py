@@ -1,43 +1,67 @@
 # utils.py
-import pandas as pd
-import os
+from data_io import DATA_FOLDER, TABLE_SCHEMAS, read_patient_tables, read_tables
+from patient_store import PatientStore
 
-DATA_FOLDER = "dades/dades_preprocessades"
+# Columns read for a report request (see pipeline.run_pipeline); build_clinical_record keeps
+# every column of the movements and diagnoses of an episode
+REPORT_COLUMNS = {
+    "Pacientes": ["id_paciente", "sexo", "fecha_nacimiento", "fecha_fallecimiento"],
+    "Episodios": ["id_episodio", "id_paciente", "tipo_episodio", "fecha_inicio_episodio", "fecha_fin_episodio"],
+    "Movimientos": list(TABLE_SCHEMAS["Movimientos"]),
+    "Diagnosticos": list(TABLE_SCHEMAS["Diagnosticos"]),
+    "Textos": ["id_episodio", "id_paciente", "texto_clinico"],
+}
 
-def load_datasets():
+def load_datasets(columns=None, folder=DATA_FOLDER, patient_id=None):
     """
-    Load datasets from CSV files and return them as pandas DataFrames.
+    Load the preprocessed datasets (CSV, Parquet, Arrow or SQLite) and return them as pandas DataFrames.
+    `columns` optionally maps each table name to the only columns that have to be read.
+    With `patient_id` (lazy mode) only the rows of that patient are returned; from SQLite
+    only those rows are read.
     """
-    pacientes = pd.read_csv(os.path.join(DATA_FOLDER, "Pacientes.csv"), dtype={"id_paciente": str})
-    episodios = pd.read_csv(os.path.join(DATA_FOLDER, "Episodios.csv"), dtype={"id_paciente": str, "id_episodio": str})
-    movimientos = pd.read_csv(os.path.join(DATA_FOLDER, "Movimientos.csv"), dtype={"id_episodio": str, "id_movimiento": str})
-    diagnosticos = pd.read_csv(os.path.join(DATA_FOLDER, "Diagnosticos.csv"), dtype={"id_episodio": str, "movimiento_asociado": str})
-    textos = pd.read_csv(os.path.join(DATA_FOLDER, "Textos.csv"), dtype={"id_paciente": str, "id_episodio": str})
-    return pacientes, episodios, movimientos, diagnosticos, textos
+    if patient_id is not None:
+        tables = read_patient_tables(patient_id, folder, columns)
+    else:
+        tables = read_tables(folder, columns)
+    return tables["Pacientes"], tables["Episodios"], tables["Movimientos"], tables["Diagnosticos"], tables["Textos"]
 
-def build_clinical_record(id_paciente, pacientes, episodios, movimientos, diagnosticos, textos):
+def load_patient_store(columns=None, folder=DATA_FOLDER, patient_id=None):
     """
-    Build a clinical record for a given patient ID by aggregating information from various datasets.
+    Load the preprocessed datasets grouped by patient and episode (see patient_store.py).
+    With `patient_id` the store only holds the rows of that patient (see load_datasets).
+    """
+    return PatientStore(*load_datasets(columns, folder, patient_id))
+
+def _fill_empty(df):
+    """
+    Replaces missing values by "" (also in categorical and datetime columns).
+    """
+    return df.astype(object).fillna("")
+
+def build_clinical_record(id_paciente, store):
+    """
+    Build a clinical record for a given patient ID by aggregating information from the
+    datasets of a PatientStore (only the rows of the patient are read).
     """
     record = {}
 
-    patient_info = pacientes[pacientes['id_paciente'] == id_paciente]
-    record['patient_info'] = patient_info.iloc[0].fillna("").to_dict() if not patient_info.empty else {}
+    patient_info = store.patient(id_paciente)
+    record['patient_info'] = _fill_empty(patient_info).iloc[0].to_dict() if not patient_info.empty else {}
 
-    patient_episodes = episodios[episodios['id_paciente'] == id_paciente]
+    patient_episodes = store.episodes(id_paciente)
     episodes_list = []
     for _, episode in patient_episodes.iterrows():
         id_episodio = episode['id_episodio']
         episode_info = episode.fillna("").to_dict()
 
-        episode_movements = movimientos[movimientos['id_episodio'] == id_episodio]
-        episode_info['movements'] = episode_movements.fillna("").to_dict(orient='records')
+        episode_movements = store.movements(id_episodio)
+        episode_info['movements'] = _fill_empty(episode_movements).to_dict(orient='records')
 
-        episode_diagnosticos = diagnosticos[diagnosticos['id_episodio'] == id_episodio]
-        episode_info['diagnostics'] = episode_diagnosticos.fillna("").to_dict(orient='records')
+        episode_diagnosticos = store.diagnoses(id_episodio)
+        episode_info['diagnostics'] = _fill_empty(episode_diagnosticos).to_dict(orient='records')
 
-        episode_texts = textos[textos['id_episodio'] == id_episodio]
-        episode_info['texts'] = episode_texts.fillna("").to_dict(orient='records')
+        episode_texts = store.episode_texts(id_episodio)
+        episode_info['texts'] = _fill_empty(episode_texts).to_dict(orient='records')
 
         episodes_list.append(episode_info)
 